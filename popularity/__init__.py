@@ -21,13 +21,16 @@ import logging
 from django.contrib.contenttypes.models import ContentType
 from django.db.models.signals import post_save, pre_delete
 
-from models import ViewTracker
+from models import ViewTracker, ViewShard
+from bloom import add_known
 
 VERSION = (0, 1, None)
 
 def post_save_handler(signal, sender, instance, created, raw, **kwargs):
     if created:
         ct = ContentType.objects.get_for_model(sender)
+        add_known(ct, instance.pk)
+        
         if ViewTracker.objects.filter(content_type=ct, object_id=instance.pk).count() == 0:
             v=ViewTracker(content_type=ct, object_id=instance.pk).save()
             logging.debug('%s automatically created for object %s' % (v, instance))
@@ -37,6 +40,7 @@ def post_save_handler(signal, sender, instance, created, raw, **kwargs):
 def pre_delete_handler(signal, sender, instance, **kwargs):
     ct = ContentType.objects.get_for_model(sender)
     tracker = ViewTracker.objects.filter(content_type=ct, object_id=instance.pk).delete()
+    ViewShard.objects.filter(content_type=ct, object_id=instance.pk).delete()
     logging.debug('ViewTracker automatically deleted for object %s' % instance)
 
 def register(mymodel):
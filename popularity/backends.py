@@ -0,0 +1,440 @@
+# This file is part of django-popularity.
+#
+# django-popularity: A generic view- and popularity tracking pluggable for Django.
+# Copyright (C) 2008-2010 Mathijs de Bruin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Counter backends take view increments out of the request path of
+    ViewTracker.add_view_for. Pending increments are moved into the
+    ViewTracker table by the backend's reconcile() method. """
+
+import atexit
+import logging
+import os
+import random
+import threading
+import Queue
+
+from datetime import datetime
+from time import sleep
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+
+# Settings for counter backends:
+# - POPULARITY_COUNTER_BACKEND; dotted path to the counter backend class,
+#   views are written directly to the database when not set
+# - POPULARITY_COUNTER_CACHE; cache URI used by CacheCounterBackend, defaults to CACHE_BACKEND
+# - POPULARITY_COUNTER_TIMEOUT; number of seconds CacheCounterBackend keeps pending counts
+# - POPULARITY_QUEUE_WORKERS; number of threads writing views queued by QueueCounterBackend
+# - POPULARITY_QUEUE_SIZE; maximum number of views in the queue
+# - POPULARITY_QUEUE_OVERFLOW; what to do with views when the queue is full: 'block' until
+#   there is room, 'drop' them or 'sample' them, keeping one in POPULARITY_QUEUE_SAMPLE
+# - POPULARITY_QUEUE_BATCH; maximum number of queued views combined in a single write
+
+from django.conf import settings
+POPULARITY_COUNTER_BACKEND = getattr(settings, 'POPULARITY_COUNTER_BACKEND', None)
+POPULARITY_COUNTER_CACHE = getattr(settings, 'POPULARITY_COUNTER_CACHE', None)
+POPULARITY_COUNTER_TIMEOUT = int(getattr(settings, 'POPULARITY_COUNTER_TIMEOUT', 7*24*3600))
+POPULARITY_QUEUE_WORKERS = int(getattr(settings, 'POPULARITY_QUEUE_WORKERS', 1))
+POPULARITY_QUEUE_SIZE = int(getattr(settings, 'POPULARITY_QUEUE_SIZE', 10000))
+POPULARITY_QUEUE_OVERFLOW = getattr(settings, 'POPULARITY_QUEUE_OVERFLOW', 'block')
+POPULARITY_QUEUE_SAMPLE = int(getattr(settings, 'POPULARITY_QUEUE_SAMPLE', 10))
+POPULARITY_QUEUE_BATCH = int(getattr(settings, 'POPULARITY_QUEUE_BATCH', 1000))
+
+from buffer import POPULARITY_BUFFERED, get_buffer
+from hll import HyperLogLog
+
+class BaseCounterBackend(object):
+    """ Interface for counter backends. """
+
+    def incr(self, content_type_id, object_id, count=1, viewed=None, viewer=None):
+        """ Adds `count` views for the given object by viewer, which is None 
+            unless unique viewers are counted. """
+        raise NotImplementedError
+
+    def pending(self, content_type_id, object_id):
+        """ Returns the number of views for the given object that have not
+            been written to the ViewTracker table yet. """
+        return 0
+
+    def reconcile(self):
+        """ Writes pending views to the ViewTracker table and returns the
+            number of objects written. """
+        return 0
+
+class BufferedCounterBackend(BaseCounterBackend):
+    """ Counts views in the in-process ViewBuffer. """
+
+    def incr(self, content_type_id, object_id, count=1, viewed=None, viewer=None):
+        get_buffer().add(content_type_id, object_id, count, viewed, viewer)
+
+    def pending(self, content_type_id, object_id):
+        return get_buffer().pending(content_type_id, object_id)
+
+    def reconcile(self):
+        return get_buffer().flush()
+
+class CacheCounterBackend(BaseCounterBackend):
+    """ Counts views with atomic increments in a Django cache, which is
+        shared between processes when using memcached.
+
+        Every counted object is registered once in a numbered slot, allocated
+        with an atomic increment as well, so reconcile() knows which counters
+        to read. A slot which is allocated but not yet set is read again by
+        the next reconcile(), so objects registering concurrently are kept.
+        The counters are only decremented by the amount written to the
+        database, so views counted during reconciliation are kept.
+
+        Pending views are lost when the cache evicts or expires them before
+        reconcile() runs; views are marked as viewed at reconciliation time.
+        Viewers are not counted. """
+
+    prefix = 'popularity'
+
+    def __init__(self, cache=None, timeout=None):
+        if cache is None:
+            if POPULARITY_COUNTER_CACHE:
+                from django.core.cache import get_cache
+                cache = get_cache(POPULARITY_COUNTER_CACHE)
+            else:
+                from django.core.cache import cache
+
+        if timeout is None:
+            timeout = POPULARITY_COUNTER_TIMEOUT
+
+        self.cache = cache
+        self.timeout = timeout
+
+    def _counter_key(self, content_type_id, object_id):
+        return '%s:views:%d:%d' % (self.prefix, content_type_id, object_id)
+
+    def _registered_key(self, content_type_id, object_id):
+        return '%s:registered:%d:%d' % (self.prefix, content_type_id, object_id)
+
+    def _slot_key(self, slot):
+        return '%s:slot:%d' % (self.prefix, slot)
+
+    def _add(self, key, count):
+        """ Atomically adds count to the value of key, creating it if necessary. """
+        try:
+            return self.cache.incr(key, count)
+        except ValueError:
+            if self.cache.add(key, count, self.timeout):
+                return count
+
+            # Another process created the key in the meantime
+            return self.cache.incr(key, count)
+
+    def incr(self, content_type_id, object_id, count=1, viewed=None, viewer=None):
+        self._add(self._counter_key(content_type_id, object_id), count)
+
+        if self.cache.add(self._registered_key(content_type_id, object_id), 1, self.timeout):
+            slot = self._add('%s:slots' % self.prefix, 1)
+            self.cache.set(self._slot_key(slot), (content_type_id, object_id), self.timeout)
+
+    def pending(self, content_type_id, object_id):
+        return self.cache.get(self._counter_key(content_type_id, object_id)) or 0
+
+    def reconcile(self):
+        """ Moves the counts for all registered objects into the ViewTracker
+            table. Only one reconcile() should run at a time. """
+        from models import ViewTracker
+
+        start = self.cache.get('%s:reconciled' % self.prefix) or 0
+        end = self.cache.get('%s:slots' % self.prefix) or 0
+
+        if end < start:
+            # The slot counter expired and started over
+            start = 0
+
+        slot_keys = [self._slot_key(slot) for slot in xrange(start + 1, end + 1)]
+        slots = self.cache.get_many(slot_keys)
+
+        # A slot can be allocated by incr() before its object is set; stop
+        # before the first missing slot so the next run reads it. A slot
+        # that is still missing on the next run was evicted and is skipped.
+        stalled = self.cache.get('%s:stalled' % self.prefix)
+        for slot in xrange(start + 1, end + 1):
+            if self._slot_key(slot) not in slots:
+                if slot == stalled:
+                    logging.warn('View counter slot %d disappeared before reconciliation.' % slot)
+                    continue
+
+                self.cache.set('%s:stalled' % self.prefix, slot, self.timeout)
+                slot_keys = slot_keys[:slot - start - 1]
+                end = slot - 1
+                break
+
+        objects = set([slots[key] for key in slot_keys if key in slots])
+
+        # Objects counted from now on register again
+        for content_type_id, object_id in objects:
+            self.cache.delete(self._registered_key(content_type_id, object_id))
+
+        counter_keys = dict([(self._counter_key(content_type_id, object_id), (content_type_id, object_id))
+                             for content_type_id, object_id in objects])
+        counts = self.cache.get_many(counter_keys.keys())
+
+        now = datetime.now()
+        deltas = [counter_keys[key] + (count, now) for key, count in counts.iteritems() if count]
+
+        ViewTracker.objects.apply_deltas(deltas)
+
+        for key, count in counts.iteritems():
+            if count:
+                try:
+                    self.cache.decr(key, count)
+                except ValueError:
+                    logging.warn('View counter %s disappeared during reconciliation.' % key)
+
+        for key in slot_keys:
+            self.cache.delete(key)
+
+        self.cache.set('%s:reconciled' % self.prefix, end, self.timeout)
+
+        logging.debug('Reconciled view counts for %d objects.' % len(deltas))
+
+        return len(deltas)
+
+class QueueCounterBackend(BaseCounterBackend):
+    """ Puts views in a bounded in-process queue, which is drained by a pool
+        of worker threads. Workers combine the views of up to `batch` queued
+        items per object and write them with a single apply_deltas() call, 
+        so slow writes delay the workers instead of the requests.
+
+        When the queue is full, the `overflow` policy applies: 'block' waits
+        for room, 'drop' discards the view and 'sample' discards it, except 
+        for one in `sample` views which waits for room and counts `sample` 
+        times. Workers are started by the first view counted in a process,
+        so they survive forking; queued views are written at process exit. """
+
+    # Number of attempts to write a batch and seconds to wait in between
+    write_attempts = 3
+    write_interval = 1.0
+
+    def __init__(self, workers=None, size=None, overflow=None, sample=None, batch=None):
+        if workers is None:
+            workers = POPULARITY_QUEUE_WORKERS
+        if size is None:
+            size = POPULARITY_QUEUE_SIZE
+        if overflow is None:
+            overflow = POPULARITY_QUEUE_OVERFLOW
+        if sample is None:
+            sample = POPULARITY_QUEUE_SAMPLE
+        if batch is None:
+            batch = POPULARITY_QUEUE_BATCH
+
+        if overflow not in ('block', 'drop', 'sample'):
+            raise ImproperlyConfigured('Unknown queue overflow policy %s' % overflow)
+
+        self.workers = workers
+        self.size = size
+        self.overflow = overflow
+        self.sample = sample
+        self.batch = batch
+
+        # Number of views dropped because the queue was full
+        self.dropped = 0
+
+        self.queue = Queue.Queue(size)
+
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._pid = None
+
+        atexit.register(self.reconcile)
+
+    def _start(self):
+        self._lock.acquire()
+        try:
+            if self._pid != os.getpid():
+                if self._pid is not None:
+                    # The queue was inherited from the parent of a fork
+                    self.queue = Queue.Queue(self.size)
+                    self._pending = {}
+
+                self._pid = os.getpid()
+
+                for i in xrange(self.workers):
+                    worker = threading.Thread(target=self._work, name='popularity-queue-%d' % i)
+                    worker.setDaemon(True)
+                    worker.start()
+        finally:
+            self._lock.release()
+
+    def _add_pending(self, key, count):
+        self._lock.acquire()
+        try:
+            count += self._pending.get(key, 0)
+
+            if count:
+                self._pending[key] = count
+            elif key in self._pending:
+                del self._pending[key]
+        finally:
+            self._lock.release()
+
+    def incr(self, content_type_id, object_id, count=1, viewed=None, viewer=None):
+        if self._pid != os.getpid():
+            self._start()
+
+        if not viewed:
+            viewed = datetime.now()
+
+        key = (content_type_id, object_id)
+
+        # Counted as pending first, so workers never make it negative
+        self._add_pending(key, count)
+
+        if self.overflow == 'block':
+            self.queue.put(key + (count, viewed, viewer))
+            return
+
+        try:
+            self.queue.put_nowait(key + (count, viewed, viewer))
+        except Queue.Full:
+            if self.overflow == 'sample' and random.random() * self.sample < 1:
+                self._add_pending(key, count * (self.sample - 1))
+                self.queue.put(key + (count * self.sample, viewed, viewer))
+            else:
+                self._add_pending(key, -count)
+
+                self._lock.acquire()
+                try:
+                    self.dropped += count
+                finally:
+                    self._lock.release()
+
+    def pending(self, content_type_id, object_id):
+        return self._pending.get((content_type_id, object_id), 0)
+
+    def _process(self, block=True):
+        """ Writes up to `batch` queued items and returns the number of 
+            objects written. Raises Queue.Empty when not blocking and the
+            queue is empty. """
+        from django.db import connection
+        from models import ViewTracker
+
+        items = [self.queue.get(block)]
+        try:
+            while len(items) < self.batch:
+                try:
+                    items.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            deltas = {}
+            for content_type_id, object_id, count, viewed, viewer in items:
+                key = (content_type_id, object_id)
+                if key in deltas:
+                    deltas[key][0] += count
+                    deltas[key][1] = max(deltas[key][1], viewed)
+                else:
+                    deltas[key] = [count, viewed, None]
+
+                if viewer is not None:
+                    if deltas[key][2] is None:
+                        deltas[key][2] = HyperLogLog()
+                    deltas[key][2].add(viewer)
+
+            for attempt in xrange(self.write_attempts):
+                try:
+                    ViewTracker.objects.apply_deltas([key + tuple(delta) for key, delta in deltas.iteritems()])
+                    break
+                except:
+                    logging.exception('Writing %d queued view counts failed.' % len(deltas))
+
+                    # Start over with a new connection
+                    connection.close()
+                    sleep(self.write_interval)
+            else:
+                logging.error('Dropped %d queued view counts after %d attempts.' % (len(deltas), self.write_attempts))
+
+            for key, (count, viewed, sketch) in deltas.iteritems():
+                self._add_pending(key, -count)
+
+            return len(deltas)
+        finally:
+            for item in items:
+                self.queue.task_done()
+
+    def _work(self):
+        while True:
+            try:
+                self._process()
+            except:
+                logging.exception('Queue worker failed.')
+
+    def reconcile(self):
+        """ Writes the queued views in the calling thread, and waits for the
+            workers to finish writing theirs. In the child of a fork, views
+            queued by the parent are discarded instead; the parent writes
+            them, and its workers, which never finish their tasks, were not
+            forked along. """
+        if self._pid != os.getpid():
+            self._lock.acquire()
+            try:
+                if self._pid is not None and self._pid != os.getpid():
+                    logging.debug('Discarding %d views queued before forking.' % self.queue.qsize())
+
+                    self.queue = Queue.Queue(self.size)
+                    self._pending = {}
+            finally:
+                self._lock.release()
+
+            return 0
+
+        written = 0
+        while True:
+            try:
+                written += self._process(block=False)
+            except Queue.Empty:
+                break
+
+        self.queue.join()
+
+        return written
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def get_backend():
+    """ Returns the configured counter backend, or None if views should be
+        written to the database directly. """
+    global _backend
+
+    if _backend is None:
+        if POPULARITY_COUNTER_BACKEND:
+            path = POPULARITY_COUNTER_BACKEND
+        elif POPULARITY_BUFFERED:
+            path = 'popularity.backends.BufferedCounterBackend'
+        else:
+            return None
+
+        module, attr = path.rsplit('.', 1)
+        try:
+            backend_class = getattr(import_module(module), attr)
+        except (ImportError, AttributeError), e:
+            raise ImproperlyConfigured('Error loading counter backend %s: %s' % (path, e))
+
+        _backend_lock.acquire()
+        try:
+            if _backend is None:
+                _backend = backend_class()
+        finally:
+            _backend_lock.release()
+
+    return _backend
@@ -0,0 +1,171 @@
+# This file is part of django-popularity.
+#
+# django-popularity: A generic view- and popularity tracking pluggable for Django.
+# Copyright (C) 2008-2010 Mathijs de Bruin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Benchmarks for recording views and ranking objects, run on trackers seeded
+    in bulk. Used by the popularity_benchmark command, which runs them on a
+    test database. """
+
+import logging
+import random
+
+from time import time
+from datetime import datetime, timedelta
+
+from django.template import Context, Template
+from django.contrib.contenttypes.models import ContentType
+
+from models import ViewTracker, POPULARITY_LISTSIZE
+
+# Number of trackers seeded per call of apply_deltas
+SEED_CHUNK_SIZE = 10000
+
+# Views are spread over this period before seeding
+SEED_PERIOD = timedelta(days=30)
+
+def seed(rows, start=0):
+    """ Creates trackers for the object ids start + 1 up to rows, with random
+        numbers of views and view times, for the ContentType model (which is
+        always installed). Trackers for the ids up to start are assumed to
+        exist already, so larger tables can be seeded incrementally. """
+    ct = ContentType.objects.get_for_model(ContentType)
+    now = datetime.now()
+    period = SEED_PERIOD.days * 86400 + SEED_PERIOD.seconds
+
+    # The same trackers for every run
+    generator = random.Random(start)
+
+    for first in xrange(start + 1, rows + 1, SEED_CHUNK_SIZE):
+        last = min(first + SEED_CHUNK_SIZE, rows + 1)
+
+        deltas = []
+        for object_id in xrange(first, last):
+            views = int(generator.paretovariate(1.2))
+            viewed = now - timedelta(seconds=generator.randrange(period))
+
+            deltas.append((ct.pk, object_id, views, viewed))
+
+        ViewTracker.objects.apply_deltas(deltas)
+
+    logging.debug('Seeded %d trackers.' % (rows - start))
+
+def measure(function, repeat):
+    """ Calls function repeat times and returns a dictionary with the
+        minimal, median and maximal duration in milliseconds. """
+    durations = []
+    for i in xrange(repeat):
+        started = time()
+        function()
+        durations.append((time() - started) * 1000)
+
+    durations.sort()
+
+    return {'repeat' : repeat,
+            'min_ms' : durations[0],
+            'median_ms' : durations[len(durations) / 2],
+            'max_ms' : durations[-1]}
+
+def _render(source):
+    template = Template('{% load popularity_tags %}' + source)
+
+    def render():
+        return template.render(Context({'objects' : list(ContentType.objects.all()),
+                                        'object' : ContentType.objects.get_for_model(ContentType)}))
+
+    return render
+
+def get_benchmarks(views=1000):
+    """ Returns a list of (name, function, count) tuples, count being the
+        number of operations done by a call of function. """
+    objects = list(ContentType.objects.all())
+    qs = ViewTracker.objects.all()
+
+    def add_views():
+        for i in xrange(views):
+            ViewTracker.add_view_for(objects[i % len(objects)])
+
+    def get_views():
+        for obj in objects:
+            ViewTracker.get_views_for(obj)
+
+    def top(getter, **kwargs):
+        return lambda: list(getattr(qs, getter)(**kwargs))
+
+    def select(method, field, **kwargs):
+        return lambda: list(getattr(qs, method)(**kwargs).order_by('-' + field)[:POPULARITY_LISTSIZE])
+
+    benchmarks = [
+        ('add_view_for', add_views, views),
+        ('get_views_for', get_views, len(objects)),
+        ('get_most_popular', top('get_most_popular'), 1),
+        ('get_most_popular_indexed', top('get_most_popular', mode='indexed'), 1),
+        ('get_most_viewed', top('get_most_viewed'), 1),
+        ('get_recently_viewed', top('get_recently_viewed'), 1),
+        ('get_recently_added', top('get_recently_added'), 1),
+        ('select_age', select('select_age', 'age'), 1),
+        ('select_relviews', select('select_relviews', 'relviews'), 1),
+        ('select_relage', select('select_relage', 'relage'), 1),
+        ('select_novelty', select('select_novelty', 'novelty'), 1),
+        ('select_popularity', select('select_popularity', 'popularity'), 1),
+        ('select_relpopularity', select('select_relpopularity', 'relpopularity'), 1),
+        ('select_random', select('select_random', 'random'), 1),
+        ('select_relevance', select('select_relevance', 'relevance'), 1),
+        ('select_ordering', select('select_ordering', 'ordering', relview=0.5, relevance=0.5), 1),
+    ]
+
+    for tag in ('most_popular', 'most_viewed', 'recently_viewed', 'recently_added'):
+        source = '{%% %s_for_model contenttypes.ContentType as trackers %%}{%% for tracker in trackers %%}{{ tracker.views }}{%% endfor %%}' % tag
+        benchmarks.append(('tag_%s_for_model' % tag, _render(source), 1))
+
+    benchmarks.append(('tag_views_for_object', _render('{% views_for_object object as views %}{{ views }}'), 1))
+    benchmarks.append(('tag_views_for_objects', _render('{% views_for_objects objects as views %}{% for object in objects %}{{ object.views }}{% endfor %}'), 1))
+
+    return benchmarks
+
+def run(sizes, repeat=5, views=1000, names=None):
+    """ Seeds tables of each of the given sizes, smallest first, and runs
+        the benchmarks (or only those in names) on them. Returns a list of
+        result dictionaries with the number of rows, the benchmark name, the
+        durations of measure() and the number of operations per second.
+
+        Trackers are added to and removed from the current database, so only
+        use this on a test database. """
+    ViewTracker.objects.all().delete()
+
+    results = []
+    seeded = 0
+    for rows in sorted(sizes):
+        seed(rows, seeded)
+        seeded = rows
+
+        for name, function, count in get_benchmarks(views):
+            if names and name not in names:
+                continue
+
+            # Once to fill caches
+            function()
+
+            result = measure(function, repeat)
+            result.update({'rows' : rows,
+                           'benchmark' : name,
+                           'per_second' : count * 1000 / max(result['median_ms'], 1e-6)})
+
+            logging.debug('%(benchmark)s on %(rows)d rows: %(median_ms).2f ms' % result)
+
+            results.append(result)
+
+    return results
@@ -0,0 +1,183 @@
+# This file is part of django-popularity.
+#
+# django-popularity: A generic view- and popularity tracking pluggable for Django.
+# Copyright (C) 2008-2010 Mathijs de Bruin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Per model Bloom filters of existing primary keys, so views can be added
+    by ID without querying the (large) table of the viewed model. """
+
+import os
+import logging
+import threading
+
+from hashlib import md5
+from math import ceil, log
+from time import time
+
+# Settings for the filters of known IDs:
+# - POPULARITY_BLOOM_REFRESH; number of seconds after which a filter is rebuilt in
+#   the background, 0 to check every ID in the database instead
+# - POPULARITY_BLOOM_ERROR_RATE; fraction of unknown IDs which are mistaken for known ones
+
+from django.conf import settings
+POPULARITY_BLOOM_REFRESH = int(getattr(settings, 'POPULARITY_BLOOM_REFRESH', 300))
+POPULARITY_BLOOM_ERROR_RATE = float(getattr(settings, 'POPULARITY_BLOOM_ERROR_RATE', 0.001))
+
+class BloomFilter(object):
+    """ Set of integers without false negatives, which holds `capacity`
+        values with a false positive rate of `error_rate`. """
+
+    def __init__(self, capacity, error_rate=None):
+        if error_rate is None:
+            error_rate = POPULARITY_BLOOM_ERROR_RATE
+
+        capacity = max(capacity, 1)
+
+        self.bits = int(ceil(-capacity * log(error_rate) / (log(2) ** 2)))
+        self.hashes = max(1, int(round(self.bits * log(2) / capacity)))
+
+        self._array = bytearray((self.bits + 7) / 8)
+
+    def _positions(self, value):
+        # Double hashing, with two 64 bit halves of an MD5 digest
+        digest = md5(str(value)).hexdigest()
+        a = int(digest[:16], 16)
+        b = int(digest[16:], 16) | 1
+
+        return [(a + i * b) % self.bits for i in xrange(self.hashes)]
+
+    def add(self, value):
+        for position in self._positions(value):
+            self._array[position / 8] |= 1 << (position % 8)
+
+    def __contains__(self, value):
+        for position in self._positions(value):
+            if not self._array[position / 8] & (1 << (position % 8)):
+                return False
+
+        return True
+
+# Filters by content type id, as (built, filter) tuples
+_filters = {}
+_filters_lock = threading.Lock()
+
+# Content type ids of the filters being rebuilt, with the id of the process rebuilding them
+_rebuilding = {}
+
+def _build_filter(ct):
+    model = ct.model_class()
+    ids = model._default_manager.values_list('pk', flat=True).order_by()
+
+    bloom = BloomFilter(ids.count())
+    for pk in ids.iterator():
+        bloom.add(pk)
+
+    logging.debug('Bloom filter built for %s, using %d bytes.' % (model.__name__, len(bloom._array)))
+
+    return bloom
+
+def rebuild_filter(ct):
+    """ Builds the BloomFilter for the model of the ContentType ct, which is
+        used from then on, and returns it. """
+    entry = (time(), _build_filter(ct))
+
+    _filters_lock.acquire()
+    try:
+        _filters[ct.pk] = entry
+        _rebuilding.pop(ct.pk, None)
+    finally:
+        _filters_lock.release()
+
+    return entry[1]
+
+def _rebuild(ct):
+    from django.db import connection
+
+    try:
+        rebuild_filter(ct)
+    except:
+        logging.exception('Building the Bloom filter for %s failed.' % ct)
+
+        _filters_lock.acquire()
+        try:
+            _rebuilding.pop(ct.pk, None)
+        finally:
+            _filters_lock.release()
+    finally:
+        # Connections are per thread, this one is not used again
+        connection.close()
+
+def _start_rebuild(ct):
+    thread = threading.Thread(target=_rebuild, args=(ct,), name='popularity-bloom-%d' % ct.pk)
+    thread.setDaemon(True)
+    thread.start()
+
+def get_filter(ct):
+    """ Returns the BloomFilter with the primary keys of the model of the
+        ContentType ct, or None when it has not been built yet. Filters are
+        built in a background thread when they are missing or older than
+        POPULARITY_BLOOM_REFRESH seconds; meanwhile the old one is used. """
+    entry = _filters.get(ct.pk)
+
+    if not entry or entry[0] + POPULARITY_BLOOM_REFRESH < time():
+        _filters_lock.acquire()
+        try:
+            entry = _filters.get(ct.pk)
+
+            # Threads rebuilding filters do not survive forking
+            start = (not entry or entry[0] + POPULARITY_BLOOM_REFRESH < time()) and _rebuilding.get(ct.pk) != os.getpid()
+            if start:
+                _rebuilding[ct.pk] = os.getpid()
+        finally:
+            _filters_lock.release()
+
+        if start:
+            _start_rebuild(ct)
+
+    return entry and entry[1]
+
+def add_known(ct, object_id):
+    """ Adds object_id to the filter for ct, if it has been built. """
+    entry = _filters.get(ct.pk)
+
+    if entry:
+        entry[1].add(object_id)
+
+def get_existing(ct, object_ids):
+    """ Returns the set of object_ids for which an object of the model of
+        ContentType ct exists. IDs missing from the filter, for instance of
+        objects created by other processes since it was built, are checked
+        in the database with a single query, as are all IDs while the first
+        filter is being built. """
+    object_ids = set(object_ids)
+
+    bloom = None
+    if POPULARITY_BLOOM_REFRESH:
+        bloom = get_filter(ct)
+
+    if bloom is not None:
+        existing = set([object_id for object_id in object_ids if object_id in bloom])
+    else:
+        existing = set()
+
+    missing = object_ids - existing
+    if missing:
+        model = ct.model_class()
+        for object_id in model._default_manager.filter(pk__in=missing).values_list('pk', flat=True):
+            existing.add(object_id)
+            add_known(ct, object_id)
+
+    return existing
@@ -0,0 +1,204 @@
+# This file is part of django-popularity.
+#
+# django-popularity: A generic view- and popularity tracking pluggable for Django.
+# Copyright (C) 2008-2010 Mathijs de Bruin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import atexit
+import logging
+import os
+import threading
+
+from datetime import datetime
+
+from hll import HyperLogLog
+
+# Settings for buffered view counting:
+# - POPULARITY_BUFFERED; when True, add_view_for only adds views to an in-process buffer
+# - POPULARITY_BUFFER_INTERVAL; maximum number of seconds views stay in the buffer
+# - POPULARITY_BUFFER_SIZE; number of distinct objects in the buffer that triggers a flush
+
+from django.conf import settings
+POPULARITY_BUFFERED = bool(getattr(settings, 'POPULARITY_BUFFERED', False))
+POPULARITY_BUFFER_INTERVAL = float(getattr(settings, 'POPULARITY_BUFFER_INTERVAL', 10))
+POPULARITY_BUFFER_SIZE = int(getattr(settings, 'POPULARITY_BUFFER_SIZE', 1000))
+
+class ViewBuffer(object):
+    """ Write-behind buffer for view counts. Views are summed in memory per
+        (content_type_id, object_id) and written to the ViewTracker table
+        in bulk, so the number of writes depends on the number of distinct
+        objects viewed rather than on the number of views.
+
+        The buffer is flushed when it holds `size` distinct objects,
+        `interval` seconds after the first unflushed view and at process exit.
+        Views buffered before a fork are only written by the parent process. """
+
+    def __init__(self, interval=None, size=None):
+        if interval is None:
+            interval = POPULARITY_BUFFER_INTERVAL
+        if size is None:
+            size = POPULARITY_BUFFER_SIZE
+
+        self.interval = interval
+        self.size = size
+
+        self._lock = threading.Lock()
+        self._deltas = {}
+        self._timer = None
+        self._pid = os.getpid()
+
+        atexit.register(self.flush)
+
+    def _check_fork(self):
+        """ Drops the views inherited from the parent process after a fork,
+            which are written by the parent. """
+        if self._pid == os.getpid():
+            return
+
+        # Other threads, like the timer, do not survive the fork
+        self._lock = threading.Lock()
+        self._deltas = {}
+        self._timer = None
+        self._pid = os.getpid()
+
+        logging.debug('Dropped the view counts buffered by the parent process.')
+
+    def add(self, content_type_id, object_id, count=1, viewed=None, viewer=None):
+        """ Adds `count` views for the given object to the buffer. Viewers are
+            collected in a HyperLogLog sketch per object. """
+        if not viewed:
+            viewed = datetime.now()
+
+        key = (content_type_id, object_id)
+
+        self._check_fork()
+
+        self._lock.acquire()
+        try:
+            self._merge(key, count, viewed)
+            
+            if viewer is not None:
+                entry = self._deltas[key]
+                if entry[2] is None:
+                    entry[2] = HyperLogLog()
+                entry[2].add(viewer)
+            
+            full = len(self._deltas) >= self.size
+
+            if not full and not self._timer and self.interval > 0:
+                self._timer = threading.Timer(self.interval, self._timed_flush)
+                self._timer.setDaemon(True)
+                self._timer.start()
+        finally:
+            self._lock.release()
+
+        if full:
+            self.flush()
+
+    def pending(self, content_type_id, object_id):
+        """ Returns the number of views for the given object that have not
+            been written to the database yet. """
+        self._check_fork()
+
+        entry = self._deltas.get((content_type_id, object_id))
+
+        if entry:
+            return entry[0]
+
+        return 0
+
+    def flush(self):
+        """ Writes all buffered views to the database. Views that could not be
+            written are put back in the buffer. """
+        self._check_fork()
+
+        self._lock.acquire()
+        try:
+            deltas = self._deltas
+            self._deltas = {}
+
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+        finally:
+            self._lock.release()
+
+        if not deltas:
+            return 0
+
+        try:
+            self._write(deltas)
+        except:
+            logging.exception('Flushing %d buffered view counts failed, keeping them buffered.' % len(deltas))
+
+            self._lock.acquire()
+            try:
+                for key, (count, viewed, sketch) in deltas.iteritems():
+                    self._merge(key, count, viewed, sketch)
+            finally:
+                self._lock.release()
+
+            return 0
+
+        logging.debug('Flushed view counts for %d objects.' % len(deltas))
+
+        return len(deltas)
+
+    def _merge(self, key, count, viewed, sketch=None):
+        """ Adds a delta to the buffer; the caller should hold the lock. """
+        entry = self._deltas.get(key)
+
+        if entry:
+            entry[0] += count
+            entry[1] = max(entry[1], viewed)
+
+            if entry[2] is None:
+                entry[2] = sketch
+            elif sketch is not None:
+                entry[2].merge(sketch)
+        else:
+            self._deltas[key] = [count, viewed, sketch]
+
+    def _write(self, deltas):
+        from models import ViewTracker
+
+        ViewTracker.objects.apply_deltas([(content_type_id, object_id, count, viewed, sketch) 
+                                          for (content_type_id, object_id), (count, viewed, sketch) in deltas.iteritems()])
+
+    def _timed_flush(self):
+        from django.db import connection
+
+        try:
+            self.flush()
+        finally:
+            # The timer runs in its own thread, with its own connection
+            connection.close()
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+def get_buffer():
+    """ Returns the process-wide ViewBuffer. """
+    global _buffer
+
+    if _buffer is None:
+        _buffer_lock.acquire()
+        try:
+            if _buffer is None:
+                _buffer = ViewBuffer()
+        finally:
+            _buffer_lock.release()
+
+    return _buffer
@@ -16,16 +16,16 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from models import ViewTracker
+from leaderboards import get_leaderboard
 
 def most_popular(request):
-    return {'most_popular' : ViewTracker.objects.get_most_popular() }
+    return {'most_popular' : get_leaderboard('most_popular') }
 
 def recently_added(request):
-    return {'recently_added' : ViewTracker.objects.get_recently_added() }
+    return {'recently_added' : get_leaderboard('recently_added') }
 
 def recently_viewed(request):
-    return {'recently_viewed' : ViewTracker.objects.get_recently_viewed() }
+    return {'recently_viewed' : get_leaderboard('recently_viewed') }
 
 def most_viewed(request):
-    return {'most_viewed' : ViewTracker.objects.get_most_viewed() }
+    return {'most_viewed' : get_leaderboard('most_viewed') }
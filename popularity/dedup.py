@@ -0,0 +1,147 @@
+# This file is part of django-popularity.
+#
+# django-popularity: A generic view- and popularity tracking pluggable for Django.
+# Copyright (C) 2008-2010 Mathijs de Bruin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Suppression of repeated views of an object by the same viewer, before
+    they are counted. """
+
+import threading
+
+from math import exp
+from time import time
+
+from bloom import BloomFilter
+
+# Settings for repeated views:
+# - POPULARITY_DEDUP_WINDOW; number of seconds in which repeated views by the same
+#   viewer are dropped, 0 to count all views
+# - POPULARITY_DEDUP_CAPACITY; number of views remembered per window, which fixes the memory used
+# - POPULARITY_DEDUP_ERROR_RATE; fraction of first views mistaken for repeated ones at capacity
+
+from django.conf import settings
+POPULARITY_DEDUP_WINDOW = float(getattr(settings, 'POPULARITY_DEDUP_WINDOW', 0))
+POPULARITY_DEDUP_CAPACITY = int(getattr(settings, 'POPULARITY_DEDUP_CAPACITY', 100000))
+POPULARITY_DEDUP_ERROR_RATE = float(getattr(settings, 'POPULARITY_DEDUP_ERROR_RATE', 0.001))
+
+class RepeatFilter(object):
+    """ Remembers (viewer, object) pairs in two Bloom filters, the current
+        and the previous generation. A new generation starts every `window`
+        seconds, or as soon as the current one holds `capacity` pairs, so
+        memory use is fixed and the false positive rate stays bounded.
+
+        Repeated views are dropped for at least `window` seconds after the
+        first, unless more than `capacity` views arrive in that window. """
+
+    def __init__(self, window=None, capacity=None, error_rate=None):
+        if window is None:
+            window = POPULARITY_DEDUP_WINDOW
+        if capacity is None:
+            capacity = POPULARITY_DEDUP_CAPACITY
+        if error_rate is None:
+            error_rate = POPULARITY_DEDUP_ERROR_RATE
+
+        self.window = window
+        self.capacity = capacity
+        self.error_rate = error_rate
+
+        # Number of views checked and dropped
+        self.checked = 0
+        self.dropped = 0
+
+        self._lock = threading.Lock()
+
+        self._current = BloomFilter(capacity, error_rate)
+        self._current_count = 0
+        self._previous = BloomFilter(capacity, error_rate)
+        self._previous_count = 0
+        self._started = time()
+
+    def _rotate(self, now):
+        self._previous, self._previous_count = self._current, self._current_count
+        self._current, self._current_count = BloomFilter(self.capacity, self.error_rate), 0
+        self._started = now
+
+    def is_repeat(self, viewer, content_type_id, object_id):
+        """ Returns whether viewer viewed the object before, remembering the
+            view if not. """
+        if isinstance(viewer, unicode):
+            viewer = viewer.encode('utf-8')
+
+        key = '%s:%d:%d' % (viewer, content_type_id, object_id)
+        now = time()
+
+        self._lock.acquire()
+        try:
+            elapsed = now - self._started
+
+            if elapsed >= 2 * self.window:
+                # The previous generation is too old as well
+                self._rotate(now)
+                self._rotate(now)
+            elif elapsed >= self.window or self._current_count >= self.capacity:
+                self._rotate(now)
+
+            self.checked += 1
+
+            if key in self._current or key in self._previous:
+                self.dropped += 1
+                return True
+
+            self._current.add(key)
+            self._current_count += 1
+
+            return False
+        finally:
+            self._lock.release()
+
+    def _false_positive_rate(self, bloom, count):
+        return (1 - exp(-float(bloom.hashes) * count / bloom.bits)) ** bloom.hashes
+
+    def stats(self):
+        """ Returns a dictionary with the number of views checked and dropped,
+            the memory used by the filters in bytes and the estimated false
+            positive rate: the fraction of first views dropped. """
+        current = self._false_positive_rate(self._current, self._current_count)
+        previous = self._false_positive_rate(self._previous, self._previous_count)
+
+        return {
+            'checked' : self.checked,
+            'dropped' : self.dropped,
+            'memory' : len(self._current._array) + len(self._previous._array),
+            'false_positive_rate' : current + previous - current * previous,
+        }
+
+_filter = None
+_filter_lock = threading.Lock()
+
+def get_repeat_filter():
+    """ Returns the process-wide RepeatFilter, or None when
+        POPULARITY_DEDUP_WINDOW is not set. """
+    global _filter
+
+    if _filter is None:
+        if not POPULARITY_DEDUP_WINDOW:
+            return None
+
+        _filter_lock.acquire()
+        try:
+            if _filter is None:
+                _filter = RepeatFilter()
+        finally:
+            _filter_lock.release()
+
+    return _filter
@@ -0,0 +1,395 @@
+# This file is part of django-popularity.
+#
+# django-popularity: A generic view- and popularity tracking pluggable for Django.
+# Copyright (C) 2008-2010 Mathijs de Bruin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Database specific SQL used by django-popularity. """
+
+import re
+import threading
+
+from math import log1p, exp
+
+from django.db import connections, transaction, IntegrityError
+from django.db.backends.signals import connection_created
+
+# Maybe they wrote their own mysql backend that *is* mysql?
+from django.conf import settings
+POPULARITY_COMPATABILITY_OVERRIDE = getattr(settings, 'POPULARITY_COMPATABILITY_OVERRIDE', None) or ()
+
+# Upsert update kinds: how an existing column value is combined with the new one
+ADD = 'add'
+GREATEST = 'greatest'
+LOGADDEXP = 'logaddexp'
+REPLACE = 'replace'
+
+# Above this difference between two log-space values, the smaller one is left out
+# of their logaddexp: EXP() of less than about -745 underflows, which PostgreSQL 
+# reports as an error instead of returning 0
+LOGADDEXP_CUTOFF = 700
+
+class BaseDialect(object):
+    """ Generic SQL, used for database engines without a specific dialect. """
+
+    # Maximum number of parameters in a single statement
+    max_params = 999
+
+    # Maximum number of rows in a single statement
+    max_rows = 1000
+
+    # SQL for the ranking expressions of ViewTrackerQuerySet, None if unsupported:
+    # - sql_now; datetime literal, formatted with the database value of the datetime
+    # - sql_age; number of seconds between 'added' and %(now)s
+    # - sql_exp; name of the exponential function
+    # - sql_random; random value in the range [0, 1]
+    sql_now = "'%s'"
+    sql_age = None
+    sql_exp = 'EXP'
+    sql_random = None
+
+    # Suffix locking the rows selected until the end of the transaction
+    sql_for_update = ''
+
+    # Query plans, see explain():
+    # - sql_explain; prefix returning the plan of a query, None if unsupported
+    # - plan_full_scan; pattern for a step reading every row of a table
+    # - plan_sort; pattern for a step sorting rows
+    sql_explain = None
+    plan_full_scan = None
+    plan_sort = None
+
+    def __init__(self, connection, using):
+        self.connection = connection
+        self.using = using
+
+    def divide(self, numerator, denominator):
+        """ SQL for a floating point division, which is NULL when dividing by zero. """
+        return '(%s * 1.0 / NULLIF(%s, 0))' % (numerator, denominator)
+
+    def quote(self, name):
+        return self.connection.ops.quote_name(name)
+
+    def explain(self, sql, params=()):
+        """ Returns the plan of a query as a list of strings, one per step. """
+        assert self.sql_explain, 'Query plans are not supported for this database engine.'
+
+        cursor = self.connection.cursor()
+        cursor.execute(self.sql_explain + sql, params)
+
+        return [' '.join([unicode(value) for value in row]) for row in cursor.fetchall()]
+
+    def is_sorted_scan(self, plan):
+        """ Returns whether a plan, as returned by explain(), reads all rows
+            of a table and sorts them instead of reading them from an index
+            in order. """
+        plan = '\n'.join(plan)
+
+        return bool(re.search(self.plan_full_scan, plan, re.M) and re.search(self.plan_sort, plan, re.M))
+
+    def chunk_size(self, columns):
+        return max(1, min(self.max_rows, self.max_params / len(columns)))
+
+    def upsert(self, table, keys, columns, rows, update):
+        """ Inserts `rows` (sequences of values for `columns`) into `table`,
+            combining them with existing rows with the same values for the
+            `keys` columns. `update` is a list of (column, kind) pairs, 
+            kind being one of ADD, GREATEST, LOGADDEXP or REPLACE. LOGADDEXP
+            stores log(exp(old) + exp(new)) for values in log space, like the 
+            scores; when they are more than LOGADDEXP_CUTOFF apart the larger
+            one is kept, as EXP() of the difference would underflow. When 
+            `update` is empty, existing rows are left alone without being locked.
+
+            Rows are written in chunks, each in its own statement and - unless
+            transactions are managed - in their own transaction, so row locks
+            are held as briefly as possible. Rows are sorted first, so that
+            concurrent writers lock rows in the same order. """
+        rows = sorted(rows)
+
+        size = self.chunk_size(columns)
+        for start in xrange(0, len(rows), size):
+            self._upsert_chunk(table, keys, columns, rows[start:start+size], update)
+            transaction.commit_unless_managed(using=self.using)
+
+        return len(rows)
+
+    def _upsert_chunk(self, table, keys, columns, rows, update):
+        """ Fallback: update each row and insert it if it does not exist yet. """
+        cursor = self.connection.cursor()
+
+        for row in rows:
+            values = dict(zip(columns, row))
+
+            assignments = []
+            params = []
+            for column, kind in update:
+                assignments.append(self._update_sql(column, kind))
+                params.extend([values[column]] * self._update_params(kind))
+
+            where = ' AND '.join(['%s = %%s' % self.quote(key) for key in keys])
+            key_params = [values[key] for key in keys]
+
+            if assignments:
+                cursor.execute('UPDATE %s SET %s WHERE %s' % (self.quote(table), ', '.join(assignments), where), params + key_params)
+
+                if cursor.rowcount:
+                    continue
+            else:
+                cursor.execute('SELECT 1 FROM %s WHERE %s' % (self.quote(table), where), key_params)
+
+                if cursor.fetchone():
+                    continue
+
+            # Only the INSERT is undone when it fails, not the rows before it
+            sid = transaction.savepoint(using=self.using)
+            try:
+                cursor.execute(self._insert_sql(table, columns, 1), row)
+            except IntegrityError:
+                # Somebody else inserted the row in the meantime
+                transaction.savepoint_rollback(sid, using=self.using)
+
+                if assignments:
+                    cursor.execute('UPDATE %s SET %s WHERE %s' % (self.quote(table), ', '.join(assignments), where), params + key_params)
+            else:
+                transaction.savepoint_commit(sid, using=self.using)
+
+    def _update_sql(self, column, kind):
+        column = self.quote(column)
+
+        if kind == ADD:
+            return '%s = %s + %%s' % (column, column)
+        if kind == GREATEST:
+            return '%s = CASE WHEN %s < %%s THEN %%s ELSE %s END' % (column, column, column)
+        if kind == LOGADDEXP:
+            return '%s = %s' % (column, self.logaddexp(column, '%s'))
+
+        assert kind == REPLACE, 'Unknown update kind %s' % kind
+        return '%s = %%s' % column
+
+    def _update_params(self, kind):
+        if kind == LOGADDEXP:
+            return self.logaddexp('value', '%s').count('%s')
+        if kind == GREATEST:
+            return 2
+        return 1
+
+    def greatest(self, a, b):
+        return 'CASE WHEN %(a)s < %(b)s THEN %(b)s ELSE %(a)s END' % {'a': a, 'b': b}
+
+    def logaddexp(self, a, b):
+        """ SQL for log(exp(a) + exp(b)), which does not overflow for large a 
+            and b, nor underflow when they are far apart. """
+        return 'CASE WHEN ABS(%(a)s - %(b)s) > %(cutoff)d THEN %(greatest)s ' \
+               'ELSE %(greatest)s + LN(1 + EXP(-ABS(%(a)s - %(b)s))) END' % \
+               {'a': a, 'b': b, 'greatest': self.greatest(a, b), 'cutoff': LOGADDEXP_CUTOFF}
+
+    def _insert_sql(self, table, columns, count):
+        row = '(%s)' % ', '.join(['%s'] * len(columns))
+
+        return 'INSERT INTO %s (%s) VALUES %s' % (self.quote(table),
+                                                  ', '.join([self.quote(column) for column in columns]),
+                                                  ', '.join([row] * count))
+
+class ConflictDialect(BaseDialect):
+    """ Databases supporting INSERT ... ON CONFLICT (PostgreSQL >= 9.5, SQLite >= 3.24). """
+
+    _GREATEST = 'GREATEST'
+
+    def _upsert_chunk(self, table, keys, columns, rows, update):
+        assignments = []
+        for column, kind in update:
+            old = '%s.%s' % (self.quote(table), self.quote(column))
+            new = 'EXCLUDED.%s' % self.quote(column)
+
+            if kind == ADD:
+                value = '%s + %s' % (old, new)
+            elif kind == GREATEST:
+                value = '%s(%s, %s)' % (self._GREATEST, old, new)
+            elif kind == LOGADDEXP:
+                value = self.logaddexp(old, new)
+            else:
+                value = new
+
+            assignments.append('%s = %s' % (self.quote(column), value))
+
+        if assignments:
+            action = 'UPDATE SET %s' % ', '.join(assignments)
+        else:
+            action = 'NOTHING'
+
+        sql = '%s ON CONFLICT (%s) DO %s' % (self._insert_sql(table, columns, len(rows)),
+                                              ', '.join([self.quote(key) for key in keys]),
+                                              action)
+
+        params = []
+        for row in rows:
+            params.extend(row)
+
+        self.connection.cursor().execute(sql, params)
+
+class PostgreSQLDialect(ConflictDialect):
+    max_params = 65535
+
+    sql_for_update = ' FOR UPDATE'
+
+    sql_now = "TIMESTAMP '%s'"
+    sql_age = 'EXTRACT(EPOCH FROM (%(now)s - added))'
+    sql_random = 'RANDOM()'
+
+    sql_explain = 'EXPLAIN '
+    plan_full_scan = r'Seq Scan'
+    plan_sort = r'\bSort\b'
+
+    def greatest(self, a, b):
+        return 'GREATEST(%s, %s)' % (a, b)
+
+def _exp(x):
+    if x is None:
+        return None
+
+    return exp(x)
+
+def _logaddexp(a, b):
+    if a < b:
+        a, b = b, a
+
+    if a - b > LOGADDEXP_CUTOFF:
+        return a
+
+    return a + log1p(exp(b - a))
+
+class SQLiteDialect(ConflictDialect):
+    # SQLite's MAX() is a scalar function when given more than one argument
+    _GREATEST = 'MAX'
+
+    sql_age = '((julianday(%(now)s) - julianday(added)) * 86400.0)'
+    sql_exp = 'popularity_exp'
+    # RANDOM() returns a 64 bit signed integer
+    sql_random = '(ABS(RANDOM()) / 9223372036854775807.0)'
+
+    # SQLite before 3.36 writes 'SCAN TABLE'; scans of an index end in 'USING (COVERING) INDEX'
+    sql_explain = 'EXPLAIN QUERY PLAN '
+    plan_full_scan = r'SCAN (TABLE )?\S+( AS \S+)?$'
+    plan_sort = r'USE TEMP B-TREE FOR (RIGHT PART OF )?ORDER BY'
+
+    # Python functions registered for every SQLite connection
+    functions = (
+        ('popularity_exp', 1, _exp),
+        ('popularity_logaddexp', 2, _logaddexp),
+    )
+
+    def __init__(self, connection, using):
+        super(SQLiteDialect, self).__init__(connection, using)
+
+        # The functions are registered when connecting, but the connection
+        # might have been opened before we were imported. Dialects are 
+        # created once per connection by get_dialect().
+        if connection.connection is not None:
+            _register_functions(None, connection)
+
+    def logaddexp(self, a, b):
+        return 'popularity_logaddexp(%s, %s)' % (a, b)
+
+def _register_functions(sender, connection, **kwargs):
+    if connection.settings_dict['ENGINE'] == 'django.db.backends.sqlite3':
+        for name, args, function in SQLiteDialect.functions:
+            connection.connection.create_function(name, args, function)
+
+connection_created.connect(_register_functions)
+
+class MySQLDialect(BaseDialect):
+    max_params = 65535
+
+    sql_for_update = ' FOR UPDATE'
+
+    sql_age = 'TIMESTAMPDIFF(SECOND, added, %(now)s)'
+    sql_random = 'RAND()'
+
+    # The access type of a step, following the table and partitions, is ALL for full scans
+    sql_explain = 'EXPLAIN '
+    plan_full_scan = r' ALL '
+    plan_sort = r'Using filesort'
+
+    def greatest(self, a, b):
+        return 'GREATEST(%s, %s)' % (a, b)
+
+    def _upsert_chunk(self, table, keys, columns, rows, update):
+        # MySQL evaluates the assignments from left to right, so a column
+        # referenced in a later assignment already has its new value.
+        assignments = []
+        for column, kind in update:
+            old = self.quote(column)
+            new = 'VALUES(%s)' % self.quote(column)
+
+            if kind == ADD:
+                value = '%s + %s' % (old, new)
+            elif kind == GREATEST:
+                value = 'GREATEST(%s, %s)' % (old, new)
+            elif kind == LOGADDEXP:
+                value = self.logaddexp(old, new)
+            else:
+                value = new
+
+            assignments.append('%s = %s' % (old, value))
+
+        # MySQL uses the unique keys of the table itself
+        if assignments:
+            sql = '%s ON DUPLICATE KEY UPDATE %s' % (self._insert_sql(table, columns, len(rows)),
+                                                     ', '.join(assignments))
+        else:
+            sql = self._insert_sql(table, columns, len(rows)).replace('INSERT', 'INSERT IGNORE', 1)
+
+        params = []
+        for row in rows:
+            params.extend(row)
+
+        self.connection.cursor().execute(sql, params)
+
+DIALECTS = {
+    'django.db.backends.mysql': MySQLDialect,
+    'django.db.backends.postgresql_psycopg2': PostgreSQLDialect,
+    'django.db.backends.postgresql': PostgreSQLDialect,
+    'django.db.backends.sqlite3': SQLiteDialect,
+}
+
+# Dialects by database alias, for every thread as connections can be per thread
+_dialects = threading.local()
+
+def get_dialect(using=None):
+    """ Returns the dialect for the database with alias `using`, which is 
+        created once for every connection. """
+    using = using or 'default'
+    connection = connections[using]
+
+    if not hasattr(_dialects, 'by_alias'):
+        _dialects.by_alias = {}
+
+    dialect = _dialects.by_alias.get(using)
+    if dialect is not None and dialect.connection is connection:
+        return dialect
+
+    engine = connection.settings_dict['ENGINE']
+
+    if engine in DIALECTS:
+        dialect_class = DIALECTS[engine]
+    elif engine in POPULARITY_COMPATABILITY_OVERRIDE:
+        dialect_class = MySQLDialect
+    else:
+        dialect_class = BaseDialect
+
+    dialect = dialect_class(connection, using)
+    _dialects.by_alias[using] = dialect
+
+    return dialect
@@ -0,0 +1,130 @@
+# This file is part of django-popularity.
+#
+# django-popularity: A generic view- and popularity tracking pluggable for Django.
+# Copyright (C) 2008-2010 Mathijs de Bruin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Cached lists of most popular, most viewed, recently viewed and recently
+    added objects, as used by the context processors and template tags. """
+
+import logging
+import random
+
+from time import time, sleep
+
+from django.contrib.contenttypes.models import ContentType
+
+from models import ViewTracker, POPULARITY_LISTSIZE, hydrate
+
+# Settings for leaderboards:
+# - POPULARITY_LEADERBOARD_TIMEOUT; number of seconds lists are cached, 0 disables caching
+# - POPULARITY_LEADERBOARD_JITTER; fraction of the timeout randomly added to it, so
+#   lists cached at the same time are not all refreshed at the same time
+# - POPULARITY_LEADERBOARD_STALE; number of seconds an expired list may still be used
+#   while another process refreshes it, 0 to wait for the refresh instead
+# - POPULARITY_LEADERBOARD_CACHE; cache URI, defaults to CACHE_BACKEND
+
+from django.conf import settings
+POPULARITY_LEADERBOARD_TIMEOUT = int(getattr(settings, 'POPULARITY_LEADERBOARD_TIMEOUT', 0))
+POPULARITY_LEADERBOARD_JITTER = float(getattr(settings, 'POPULARITY_LEADERBOARD_JITTER', 0.1))
+POPULARITY_LEADERBOARD_STALE = int(getattr(settings, 'POPULARITY_LEADERBOARD_STALE', 60))
+POPULARITY_LEADERBOARD_CACHE = getattr(settings, 'POPULARITY_LEADERBOARD_CACHE', None)
+
+if POPULARITY_LEADERBOARD_CACHE:
+    from django.core.cache import get_cache
+    cache = get_cache(POPULARITY_LEADERBOARD_CACHE)
+else:
+    from django.core.cache import cache
+
+# Maximum number of seconds a refresh may take before another process takes over
+REFRESH_TIMEOUT = 30
+
+# Number of times and interval in seconds to check for a list being refreshed
+# by another process, when no stale list is available
+REFRESH_POLLS = 20
+REFRESH_POLL_INTERVAL = 0.05
+
+KINDS = {
+    'most_popular' : 'get_most_popular',
+    'most_viewed' : 'get_most_viewed',
+    'recently_viewed' : 'get_recently_viewed',
+    'recently_added' : 'get_recently_added',
+}
+
+def _get_list(kind, model, limit):
+    if model:
+        qs = ViewTracker.objects.get_for_model(model)
+    else:
+        qs = ViewTracker.objects.all()
+
+    return getattr(qs, KINDS[kind])(limit=limit)
+
+def get_leaderboard(kind, model=None, limit=None):
+    """ Returns the list of trackers of the given kind ('most_popular', 'most_viewed',
+        'recently_viewed' or 'recently_added'), optionally for a model.
+
+        When POPULARITY_LEADERBOARD_TIMEOUT is set, the list is cached. When it
+        expires, only one process refreshes it; others use the expired list
+        for at most POPULARITY_LEADERBOARD_STALE seconds, or wait for the
+        refreshed list. Cached lists include the content objects of the 
+        trackers, and leave out trackers of deleted objects. Without caching,
+        the QuerySet is returned as is. """
+    assert kind in KINDS, 'Unknown leaderboard %s' % kind
+
+    if not limit:
+        limit = POPULARITY_LISTSIZE
+    limit = int(limit)
+
+    if not POPULARITY_LEADERBOARD_TIMEOUT:
+        return _get_list(kind, model, limit)
+
+    if model:
+        key = 'popularity:leaderboard:%s:%d:%d' % (kind, ContentType.objects.get_for_model(model).pk, limit)
+    else:
+        key = 'popularity:leaderboard:%s:all:%d' % (kind, limit)
+
+    # Entries are (expires, trackers) tuples, kept in the cache until they are too stale
+    entry = cache.get(key)
+    if entry and entry[0] > time():
+        return entry[1]
+
+    if cache.add(key + ':refresh', 1, REFRESH_TIMEOUT):
+        try:
+            # Cache the content objects along with the trackers
+            trackers, missing = hydrate(list(_get_list(kind, model, limit)))
+
+            timeout = POPULARITY_LEADERBOARD_TIMEOUT * (1 + random.random() * POPULARITY_LEADERBOARD_JITTER)
+            cache.set(key, (time() + timeout, trackers), int(timeout) + 1 + POPULARITY_LEADERBOARD_STALE)
+        finally:
+            cache.delete(key + ':refresh')
+
+        logging.debug('Leaderboard %s refreshed.' % key)
+
+        return trackers
+
+    # Another process is refreshing the list
+    if entry and POPULARITY_LEADERBOARD_STALE:
+        return entry[1]
+
+    for i in xrange(REFRESH_POLLS):
+        sleep(REFRESH_POLL_INTERVAL)
+
+        entry = cache.get(key)
+        if entry and entry[0] > time():
+            return entry[1]
+
+    logging.warn('Leaderboard %s was not refreshed in time, retrieving it once more.' % key)
+
+    return list(_get_list(kind, model, limit))
@@ -0,0 +1,87 @@
+# This file is part of django-popularity.
+#
+# django-popularity: A generic view- and popularity tracking pluggable for Django.
+# Copyright (C) 2008-2010 Mathijs de Bruin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+
+from datetime import datetime
+from optparse import make_option
+
+import django
+
+from django.conf import settings
+from django.db import connection
+from django.utils import simplejson
+from django.core.management.base import BaseCommand, CommandError
+
+from popularity import benchmarks
+from popularity.backends import get_backend
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--rows', dest='rows', default='10000',
+            help='Comma separated numbers of trackers to run the benchmarks on, like 10000,1000000,10000000.'),
+        make_option('--repeat', dest='repeat', type='int', default=5,
+            help='Number of times every benchmark is run.'),
+        make_option('--views', dest='views', type='int', default=1000,
+            help='Number of views added by the add_view_for benchmark.'),
+        make_option('--output', dest='output', default=None,
+            help='File to write the results to as JSON, instead of standard output.'),
+        make_option('--noinput', action='store_false', dest='interactive', default=True,
+            help='Do not ask before removing an existing test database.'),
+    )
+    help = 'Measures recording views and ranking objects on a test database with seeded trackers, writing the results as JSON.'
+    args = '[benchmark ...]'
+
+    def handle(self, *names, **options):
+        try:
+            sizes = [int(rows) for rows in options['rows'].split(',')]
+        except ValueError:
+            raise CommandError('--rows should be a comma separated list of numbers.')
+
+        verbosity = int(options.get('verbosity', 1))
+        started = datetime.now()
+
+        # Never seed the tables of the actual database
+        old_name = settings.DATABASES['default']['NAME']
+        connection.creation.create_test_db(verbosity, autoclobber=not options['interactive'])
+        try:
+            results = benchmarks.run(sizes, options['repeat'], options['views'], names)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity)
+
+        backend = get_backend()
+
+        report = {
+            'started' : started.isoformat(),
+            'django' : django.get_version(),
+            'engine' : settings.DATABASES['default']['ENGINE'],
+            'backend' : backend and backend.__class__.__name__,
+            'results' : results,
+        }
+
+        if options['output']:
+            output = open(options['output'], 'w')
+        else:
+            output = sys.stdout
+
+        try:
+            simplejson.dump(report, output, indent=2, sort_keys=True)
+            output.write('\n')
+        finally:
+            if options['output']:
+                output.close()
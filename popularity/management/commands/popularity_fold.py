@@ -0,0 +1,31 @@
+# This file is part of django-popularity.
+#
+# django-popularity: A generic view- and popularity tracking pluggable for Django.
+# Copyright (C) 2008-2010 Mathijs de Bruin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from django.core.management.base import NoArgsCommand
+
+from popularity.models import ViewShard
+
+class Command(NoArgsCommand):
+    help = 'Adds the views in ViewShards to their ViewTrackers and removes the shards.'
+
+    def handle_noargs(self, **options):
+        count = ViewShard.objects.fold()
+
+        if int(options.get('verbosity', 1)) > 0:
+            print 'Folded %d shards.' % count
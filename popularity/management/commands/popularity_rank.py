@@ -0,0 +1,45 @@
+# This file is part of django-popularity.
+#
+# django-popularity: A generic view- and popularity tracking pluggable for Django.
+# Copyright (C) 2008-2010 Mathijs de Bruin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from popularity import models
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--full', action='store_true', dest='full', default=False,
+            help='Score all trackers instead of those viewed since the previous run.'),
+    )
+    help = 'Stores the scores of the ranking profiles in POPULARITY_RANKING_PROFILES for the trackers viewed since the previous run.'
+    args = '[profile ...]'
+
+    def handle(self, *profiles, **options):
+        if not profiles:
+            profiles = sorted(models.POPULARITY_RANKING_PROFILES)
+
+        for profile in profiles:
+            if profile not in models.POPULARITY_RANKING_PROFILES:
+                raise CommandError('Unknown ranking profile %s' % profile)
+
+        for profile in profiles:
+            count = models.RankingScore.objects.refresh(profile, full=options.get('full', False))
+
+            if int(options.get('verbosity', 1)) > 0:
+                print 'Computed %d scores for ranking profile %s.' % (count, profile)
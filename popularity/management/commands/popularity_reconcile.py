@@ -0,0 +1,39 @@
+# This file is part of django-popularity.
+#
+# django-popularity: A generic view- and popularity tracking pluggable for Django.
+# Copyright (C) 2008-2010 Mathijs de Bruin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+
+from django.core.management.base import NoArgsCommand
+
+from popularity.backends import get_backend
+
+class Command(NoArgsCommand):
+    help = 'Writes the view counts pending in the counter backend to the ViewTracker table.'
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        backend = get_backend()
+
+        if not backend:
+            if verbosity > 0:
+                print 'No counter backend configured, nothing to reconcile.'
+            return
+
+        count = backend.reconcile()
+
+        if verbosity > 0:
+            print 'Reconciled view counts for %d objects.' % count
@@ -0,0 +1,310 @@
+# This file is part of django-popularity.
+#
+# django-popularity: A generic view- and popularity tracking pluggable for Django.
+# Copyright (C) 2008-2010 Mathijs de Bruin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Timing and query counts of the methods, template tags and views of
+    popularity, emitted to a metrics sink. """
+
+import logging
+import socket
+import threading
+
+from collections import deque
+from functools import wraps
+from time import time
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connections
+from django.utils.importlib import import_module
+
+# Settings for metrics:
+# - POPULARITY_METRICS_SINK; dotted path to the metrics sink class, nothing is
+#   measured when not set
+# - POPULARITY_METRICS_SIZE; number of measurements MemorySink keeps per name
+# - POPULARITY_METRICS_PREFIX; prefix of the names sent by StatsdSink
+# - POPULARITY_STATSD_HOST, POPULARITY_STATSD_PORT; address StatsdSink sends to
+
+from django.conf import settings
+POPULARITY_METRICS_SINK = getattr(settings, 'POPULARITY_METRICS_SINK', None)
+POPULARITY_METRICS_SIZE = int(getattr(settings, 'POPULARITY_METRICS_SIZE', 1000))
+POPULARITY_METRICS_PREFIX = getattr(settings, 'POPULARITY_METRICS_PREFIX', 'popularity')
+POPULARITY_STATSD_HOST = getattr(settings, 'POPULARITY_STATSD_HOST', 'localhost')
+POPULARITY_STATSD_PORT = int(getattr(settings, 'POPULARITY_STATSD_PORT', 8125))
+
+class BaseMetricsSink(object):
+    """ Interface for metrics sinks. """
+
+    def timing(self, name, milliseconds, queries):
+        """ Records a call of name which took the given number of milliseconds
+            and database queries. """
+        raise NotImplementedError
+
+class MemorySink(BaseMetricsSink):
+    """ Keeps the last POPULARITY_METRICS_SIZE measurements of every name in
+        memory, from which percentiles are computed. """
+
+    def __init__(self, size=None):
+        if size is None:
+            size = POPULARITY_METRICS_SIZE
+
+        self.size = size
+
+        self._lock = threading.Lock()
+        self._measurements = {}
+
+    def timing(self, name, milliseconds, queries):
+        self._lock.acquire()
+        try:
+            if name not in self._measurements:
+                self._measurements[name] = deque(maxlen=self.size)
+
+            self._measurements[name].append((milliseconds, queries))
+        finally:
+            self._lock.release()
+
+    def _percentile(self, values, percentile):
+        return values[min(len(values) - 1, int(len(values) * percentile / 100.0))]
+
+    def stats(self):
+        """ Returns a dictionary with the number of measurements, the 50th and
+            99th percentile of the duration in milliseconds and of the number
+            of queries, by name. """
+        self._lock.acquire()
+        try:
+            measurements = dict([(name, list(values)) for name, values in self._measurements.iteritems()])
+        finally:
+            self._lock.release()
+
+        stats = {}
+        for name, values in measurements.iteritems():
+            durations = sorted([milliseconds for milliseconds, queries in values])
+            queries = sorted([queries for milliseconds, queries in values])
+
+            stats[name] = {'count' : len(values),
+                           'p50_ms' : self._percentile(durations, 50),
+                           'p99_ms' : self._percentile(durations, 99),
+                           'p50_queries' : self._percentile(queries, 50),
+                           'p99_queries' : self._percentile(queries, 99)}
+
+        return stats
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._measurements = {}
+        finally:
+            self._lock.release()
+
+class LoggingSink(BaseMetricsSink):
+    """ Logs every measurement at debug level. """
+
+    def __init__(self):
+        self.logger = logging.getLogger('popularity.metrics')
+
+    def timing(self, name, milliseconds, queries):
+        self.logger.debug('%s: %.2f ms, %d queries' % (name, milliseconds, queries))
+
+class StatsdSink(BaseMetricsSink):
+    """ Sends the durations and the numbers of queries as statsd timers,
+        named <prefix>.<name> and <prefix>.<name>.queries, over UDP, from
+        which the statsd daemon computes the percentiles. """
+
+    def __init__(self, host=None, port=None, prefix=None):
+        if host is None:
+            host = POPULARITY_STATSD_HOST
+        if port is None:
+            port = POPULARITY_STATSD_PORT
+        if prefix is None:
+            prefix = POPULARITY_METRICS_PREFIX
+
+        self.address = (host, port)
+        self.prefix = prefix
+
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def timing(self, name, milliseconds, queries):
+        data = '%(prefix)s.%(name)s:%(milliseconds)f|ms\n%(prefix)s.%(name)s.queries:%(queries)d|ms' % \
+                {'prefix' : self.prefix, 'name' : name, 'milliseconds' : milliseconds, 'queries' : queries}
+
+        try:
+            self._socket.sendto(data, self.address)
+        except socket.error, e:
+            # Metrics are not worth failing a request for
+            logging.debug('Could not send metrics to statsd: %s' % e)
+
+class _CountingCursor(object):
+    """ Counts the queries executed by a cursor, for the current thread. """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, *args, **kwargs):
+        _local.queries = getattr(_local, 'queries', 0) + 1
+        return self.cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        _local.queries = getattr(_local, 'queries', 0) + 1
+        return self.cursor.executemany(*args, **kwargs)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+def _count_queries():
+    """ Wraps the cursors of the connections of the current thread (Django's
+        connections are thread local), so queries are counted without DEBUG. """
+    for connection in connections.all():
+        if not getattr(connection, '_popularity_counting', False):
+            cursor = connection.cursor
+
+            connection.cursor = lambda cursor=cursor: _CountingCursor(cursor())
+            connection._popularity_counting = True
+
+_local = threading.local()
+
+_sink = None
+_sink_lock = threading.Lock()
+
+def get_sink():
+    """ Returns the configured metrics sink, or None when nothing should be
+        measured. """
+    global _sink
+
+    if _sink is None:
+        if not POPULARITY_METRICS_SINK:
+            return None
+
+        path = POPULARITY_METRICS_SINK
+        module, attr = path.rsplit('.', 1)
+        try:
+            sink_class = getattr(import_module(module), attr)
+        except (ImportError, AttributeError), e:
+            raise ImproperlyConfigured('Error loading metrics sink %s: %s' % (path, e))
+
+        _sink_lock.acquire()
+        try:
+            if _sink is None:
+                _sink = sink_class()
+        finally:
+            _sink_lock.release()
+
+    return _sink
+
+def measuring():
+    """ Returns whether a call is being measured in the current thread, whose
+        measurement includes the queries run by QuerySets it uses. """
+    return getattr(_local, 'depth', 0) > 0
+
+def measure(name, function, *args, **kwargs):
+    """ Calls function with the given arguments, emitting its duration and
+        number of queries to the metrics sink as name. """
+    sink = get_sink()
+
+    if sink is None:
+        return function(*args, **kwargs)
+
+    _count_queries()
+
+    queries = getattr(_local, 'queries', 0)
+    started = time()
+    _local.depth = getattr(_local, 'depth', 0) + 1
+    try:
+        return function(*args, **kwargs)
+    finally:
+        _local.depth -= 1
+        sink.timing(name, (time() - started) * 1000, getattr(_local, 'queries', 0) - queries)
+
+def _measure_iterator(sink, name, iterator):
+    _count_queries()
+
+    milliseconds = 0.0
+    queries = 0
+    try:
+        while True:
+            before = getattr(_local, 'queries', 0)
+            started = time()
+            try:
+                item = iterator.next()
+            finally:
+                milliseconds += (time() - started) * 1000
+                queries += getattr(_local, 'queries', 0) - before
+
+            yield item
+    finally:
+        sink.timing(name, milliseconds, queries)
+
+def measure_iterator(name, iterator):
+    """ Returns an iterator over the items of iterator, emitting the time and
+        queries it takes to produce them, but not the time spent by the code
+        using them, to the metrics sink as name, once the iterator is 
+        exhausted or discarded. Nothing is emitted within a measured call. """
+    sink = get_sink()
+
+    if sink is None or measuring():
+        return iterator
+
+    return _measure_iterator(sink, name, iterator)
+
+def instrument(name):
+    """ Decorator emitting the duration and number of queries of every call
+        of the decorated function to the metrics sink, as name. Calls are
+        not measured when there is no sink. """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            return measure(name, function, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+def instrument_lazy(name):
+    """ Decorator for QuerySet methods which may return a QuerySet, which 
+        only queries the database when it is used. Such a QuerySet is given
+        name as its 'metric', under which it measures the queries it runs
+        (see ViewTrackerQuerySet.iterator). Other results are measured as
+        the call of the method, as with instrument. """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            sink = get_sink()
+
+            if sink is None:
+                return function(*args, **kwargs)
+
+            _count_queries()
+
+            queries = getattr(_local, 'queries', 0)
+            started = time()
+            _local.depth = getattr(_local, 'depth', 0) + 1
+            try:
+                result = function(*args, **kwargs)
+            finally:
+                _local.depth -= 1
+
+            if hasattr(result, '_metric'):
+                result._metric = name
+            else:
+                sink.timing(name, (time() - started) * 1000, getattr(_local, 'queries', 0) - queries)
+
+            return result
+
+        return wrapper
+
+    return decorator
@@ -18,25 +18,156 @@
 
 import logging
 
-from datetime import datetime
+from random import randrange, uniform
+from datetime import datetime, timedelta
 
-from math import log
+from math import log, log1p, exp
 
-from django.db import models, connection
-from django.db.models.expressions import F
+from django.db import models, transaction
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
 
 # Settings for popularity:
 # - POPULARITY_LISTSIZE; default size of the lists returned by get_most_popular etc.
 # - POPULARITY_CHARAGE; characteristic age used for measuring the popularity
+# - POPULARITY_CANDIDATES; default number of candidates get_top_ordering retrieves 
+#   for every weighted value
 
 from django.conf import settings
 POPULARITY_CHARAGE = float(getattr(settings, 'POPULARITY_CHARAGE', 3600))
 POPULARITY_LISTSIZE = int(getattr(settings, 'POPULARITY_LISTSIZE', 10))
+POPULARITY_CANDIDATES = int(getattr(settings, 'POPULARITY_CANDIDATES', 100))
 
-# Maybe they wrote their own mysql backend that *is* mysql?
-COMPATIBLE_DATABASES = getattr(settings, 'POPULARITY_COMPATABILITY_OVERRIDE',None) or ('django.db.backends.mysql', )
+from backends import get_backend
+from bloom import get_existing
+from hll import HyperLogLog
+from dedup import get_repeat_filter
+from trending import record, get_trending
+from metrics import instrument, instrument_lazy, measure, measure_iterator, measuring
+from dialects import get_dialect, ADD, GREATEST, LOGADDEXP, REPLACE, DIALECTS, POPULARITY_COMPATABILITY_OVERRIDE
+
+# Settings for windowed popularity:
+# - POPULARITY_BUCKETS; when True, views are also counted per hour and per day
+# - POPULARITY_BUCKETS_HOURLY_RETENTION; timedelta for which hourly buckets are kept
+# - POPULARITY_BUCKETS_DAILY_RETENTION; timedelta for which daily buckets are kept
+
+POPULARITY_BUCKETS = bool(getattr(settings, 'POPULARITY_BUCKETS', False))
+POPULARITY_BUCKETS_HOURLY_RETENTION = getattr(settings, 'POPULARITY_BUCKETS_HOURLY_RETENTION', timedelta(days=2))
+POPULARITY_BUCKETS_DAILY_RETENTION = getattr(settings, 'POPULARITY_BUCKETS_DAILY_RETENTION', timedelta(days=90))
+
+# The score of a view is relative to POPULARITY_SCORE_EPOCH, which keeps the values small
+POPULARITY_SCORE_EPOCH = getattr(settings, 'POPULARITY_SCORE_EPOCH', datetime(2010, 1, 1))
+
+# Settings for sharded view counts:
+# - POPULARITY_SHARDS; dictionary with the number of ViewShards views are spread over
+#   for every object of a model, like {'news.article': 8}
+
+POPULARITY_SHARDS = getattr(settings, 'POPULARITY_SHARDS', None) or {}
+
+# Settings for unique viewers:
+# - POPULARITY_UNIQUE_VIEWS; when True, the number of unique viewers passed to
+#   add_view_for and friends is estimated in the sketch of every tracker
+
+POPULARITY_UNIQUE_VIEWS = bool(getattr(settings, 'POPULARITY_UNIQUE_VIEWS', False))
+
+# Settings for precomputed rankings:
+# - POPULARITY_RANKING_PROFILES; dictionary of named ranking profiles, each a dictionary 
+#   with the weights for select_ordering and optionally the 'charage' of the novelty,
+#   like {'frontpage': {'relevance': 1.0, 'random': 0.1, 'charage': 86400}}
+# - POPULARITY_RANKING_OVERLAP; number of seconds before the previous refresh from which
+#   trackers are scored again, for views written late by buffering counter backends
+
+POPULARITY_RANKING_PROFILES = getattr(settings, 'POPULARITY_RANKING_PROFILES', None) or {}
+POPULARITY_RANKING_OVERLAP = int(getattr(settings, 'POPULARITY_RANKING_OVERLAP', 300))
+
+def get_sketch(viewer):
+    """ Returns a HyperLogLog sketch with viewer, or None when viewer is None
+        or unique viewers are not counted. """
+    if viewer is None or not POPULARITY_UNIQUE_VIEWS:
+        return None
+    
+    sketch = HyperLogLog()
+    sketch.add(viewer)
+    
+    return sketch
+
+_shard_counts = None
+
+def get_shard_counts():
+    """ Returns a dictionary with the number of shards by content type id, 
+        for the models in POPULARITY_SHARDS. """
+    global _shard_counts
+    
+    if _shard_counts is None:
+        shard_counts = {}
+        for label, count in POPULARITY_SHARDS.iteritems():
+            app_label, model = label.lower().split('.')
+            ct = ContentType.objects.get_by_natural_key(app_label, model)
+            shard_counts[ct.pk] = int(count)
+        
+        _shard_counts = shard_counts
+    
+    return _shard_counts
+
+def logaddexp(a, b):
+    """ Returns log(exp(a) + exp(b)) without overflowing. """
+    if a < b:
+        a, b = b, a
+    
+    return a + log1p(exp(b - a))
+
+# Score of a tracker without views, practically log(0)
+NO_VIEWS_SCORE = -1e300
+
+def get_score(views, viewed):
+    """ Returns the score for a number of views at time viewed. The score of
+        a tracker is log(sum(2**(t/POPULARITY_CHARAGE))) over the times t of 
+        all its views. Scores of new views are added with logaddexp() and never
+        have to be changed as time passes, while ordering by score gives the 
+        same result as ordering by the number of views which count half as 
+        much after every POPULARITY_CHARAGE seconds. """
+    if views <= 0:
+        return NO_VIEWS_SCORE
+    
+    age = viewed - POPULARITY_SCORE_EPOCH
+    seconds = age.days * 86400 + age.seconds + age.microseconds / 1e6
+    
+    return log(views) + log(2) * seconds / POPULARITY_CHARAGE
+
+def hydrate(trackers):
+    """ Retrieves the content objects of trackers with a single in_bulk query
+        for every content type, instead of one query for every tracker. 
+        Returns a list of the trackers of which the object exists, in their
+        original order, and the number of trackers of which it was deleted. """
+    object_ids = {}
+    for tracker in trackers:
+        object_ids.setdefault(tracker.content_type_id, []).append(tracker.object_id)
+    
+    objects = {}
+    for content_type_id, ids in object_ids.iteritems():
+        model = ContentType.objects.get_for_id(content_type_id).model_class()
+        
+        if model:
+            for pk, obj in model._default_manager.in_bulk(ids).iteritems():
+                objects[(content_type_id, pk)] = obj
+    
+    hydrated = []
+    for tracker in trackers:
+        obj = objects.get((tracker.content_type_id, tracker.object_id))
+        
+        if obj is not None:
+            # The cache of the content_object GenericForeignKey
+            tracker._content_object_cache = obj
+            hydrated.append(tracker)
+    
+    missing = len(trackers) - len(hydrated)
+    if missing:
+        logging.debug('Skipped %d trackers of deleted objects.' % missing)
+    
+    return hydrated, missing
+
+# Database engines for which the select_* methods are available
+COMPATIBLE_DATABASES = tuple(POPULARITY_COMPATABILITY_OVERRIDE) + tuple([engine for engine, dialect in DIALECTS.items() if dialect.sql_age])
 
 class ViewTrackerQuerySet(models.query.QuerySet):
     _LOGSCALING = log(0.5)
@@ -45,22 +176,56 @@ class ViewTrackerQuerySet(models.query.QuerySet):
         super(self.__class__, self).__init__ (model, *args, **kwargs)
 
         self._DATABASE_ENGINE = settings.DATABASES.get(kwargs.get('using',None) or 'default')['ENGINE']
-        self._SQL_NOW = "'%s'"
-        self._SQL_AGE = 'TIMESTAMPDIFF(SECOND, added, %(now)s)'
-        self._SQL_RELVIEWS = '(views/%(maxviews)d)'
-        self._SQL_RELAGE = '(%(age)s/%(maxage)d)'
-        self._SQL_NOVELTY = '(%(factor)s * EXP(%(logscaling)s * %(age)s/%(charage)s) + %(offset)s)'
-        self._SQL_POPULARITY = '(views/%(age)s)'
-        self._SQL_RELPOPULARITY = '(%(popularity)s/%(maxpopularity)s)'
-        self._SQL_RANDOM = connection.ops.random_function_sql()
+        
+        # The dialect has the database specific SQL
+        self._dialect = get_dialect(kwargs.get('using',None))
+        
+        # Ids of the content types the trackers are limited to by get_for_models
+        self._content_types = None
+        
+        # Name under which the queries are measured, see instrument_lazy
+        self._metric = None
+        
+        self._SQL_NOW = self._dialect.sql_now
+        self._SQL_AGE = self._dialect.sql_age
+        self._SQL_RELVIEWS = self._dialect.divide('%(views)s', '%(maxviews)s')
+        self._SQL_RELAGE = self._dialect.divide('%(age)s', '%(maxage)s')
+        self._SQL_NOVELTY = '(%(factor)s * ' + self._dialect.sql_exp + '(%(logscaling)s * %(age)s/%(charage)s) + %(offset)s)'
+        self._SQL_POPULARITY = self._dialect.divide('%(views)s', '%(age)s')
+        self._SQL_RELPOPULARITY = self._dialect.divide('%(popularity)s', '%(maxpopularity)s')
+        self._SQL_RANDOM = self._dialect.sql_random
         self._SQL_RELEVANCE = '%(relpopularity)s * %(novelty)s'
-        self._SQL_ORDERING = '%(relview)f * %(relview_sql)s + \
-                              %(relage)f  * %(relage_sql)s + \
-                              %(novelty)f * %(novelty_sql)s + \
-                              %(relpopularity)f * %(relpopularity_sql)s + \
-                              %(random)f * %(random_sql)s + \
-                              %(relevance)f * %(relevance_sql)s + \
-                              %(offset)f'
+    
+    def _clone(self, *args, **kwargs):
+        clone = super(ViewTrackerQuerySet, self)._clone(*args, **kwargs)
+        clone._content_types = self._content_types
+        clone._metric = self._metric
+        return clone
+    
+    def iterator(self):
+        iterator = super(ViewTrackerQuerySet, self).iterator()
+        
+        if self._metric is None:
+            return iterator
+        
+        return measure_iterator(self._metric, iterator)
+    
+    def count(self):
+        if self._metric is None or measuring():
+            return super(ViewTrackerQuerySet, self).count()
+        
+        return measure(self._metric, super(ViewTrackerQuerySet, self).count)
+    
+    def __or__(self, other):
+        combined = super(ViewTrackerQuerySet, self).__or__(other)
+        
+        other_content_types = getattr(other, '_content_types', None)
+        if self._content_types is None or other_content_types is None:
+            combined._content_types = None
+        else:
+            combined._content_types = self._content_types | other_content_types
+        
+        return combined
     
     def _get_db_datetime(self, value=None):
         """ Retrieve an SQL-interpretable representation of the datetime value, or
@@ -70,10 +235,10 @@ class ViewTrackerQuerySet(models.query.QuerySet):
         if not value:
             value = datetime.now()
         
-        _SQL_NOW = self._SQL_NOW % connection.ops.value_to_db_datetime(value)
+        _SQL_NOW = self._SQL_NOW % self._dialect.connection.ops.value_to_db_datetime(value)
         return  _SQL_NOW
     
-    def _add_extra(self, field, sql):
+    def _add_extra(self, field, sql, params=None):
         """ Add the extra parameter 'field' with value 'sql' to the queryset (without
             removing previous parameters, as oppsoed to the normal .extra method). """
         assert self.query.can_filter(), \
@@ -81,9 +246,46 @@ class ViewTrackerQuerySet(models.query.QuerySet):
 
         logging.debug(sql)   
         clone = self._clone()
-        clone.query.add_extra({field:sql}, None, None, None, None, None)
+        clone.query.add_extra({field:sql}, params, None, None, None, None)
         return clone
+    
+    def _max_sql(self, relative_to, sql):
+        """ Returns the SQL and parameters of a subquery for the maximum value of 'sql'
+            in the QuerySet 'relative_to'. This way, normalized values are calculated 
+            in the same query as the values themselves. """
+        qs = relative_to.order_by().extra(select={'maximum' : 'MAX(%s)' % sql}).values('maximum')
+        
+        subquery, params = qs.query.get_compiler(using=qs.db).as_sql()
+        
+        return '(%s)' % subquery, list(params)
         
+    def _get_sharded(self):
+        """ Returns the ids of the content types in POPULARITY_SHARDS the 
+            trackers in the QuerySet can have; all of them, unless the 
+            QuerySet is limited to some models by get_for_models. """
+        shard_counts = get_shard_counts()
+        
+        if self._content_types is None:
+            return sorted(shard_counts)
+        
+        return sorted([content_type_id for content_type_id in shard_counts if content_type_id in self._content_types])
+    
+    def _get_views_sql(self):
+        """ Returns the SQL for the number of views, which includes the views 
+            in the ViewShards of the models in POPULARITY_SHARDS. """
+        sharded = self._get_sharded()
+        
+        if not sharded:
+            return 'views'
+        
+        return ('CASE WHEN %(trackers)s.content_type_id IN (%(sharded)s) THEN %(trackers)s.views + '
+                'COALESCE((SELECT SUM(%(shards)s.views) FROM %(shards)s WHERE %(shards)s.content_type_id = %(trackers)s.content_type_id '
+                'AND %(shards)s.object_id = %(trackers)s.object_id), 0) ELSE %(trackers)s.views END') % \
+                {'trackers' : self._dialect.quote(self.model._meta.db_table),
+                 'shards'   : self._dialect.quote(ViewShard._meta.db_table),
+                 'sharded'  : ', '.join([str(content_type_id) for content_type_id in sharded])}
+    
+    @instrument_lazy('queryset.select_age')
     def select_age(self):
         """ Adds age with regards to NOW to the QuerySet
             fields. """
@@ -93,6 +295,7 @@ class ViewTrackerQuerySet(models.query.QuerySet):
         
         return self._add_extra('age', _SQL_AGE)
         
+    @instrument_lazy('queryset.select_relviews')
     def select_relviews(self, relative_to=None):
         """ Adds 'relview', a normalized viewcount, to the QuerySet.
             The normalization occcurs relative to the maximum number of views
@@ -101,18 +304,22 @@ class ViewTrackerQuerySet(models.query.QuerySet):
             The relative number of views should always in the range [0, 1]. """
         assert self._DATABASE_ENGINE in COMPATIBLE_DATABASES, 'Database engine %s is not compatible with this functionality.'
         
-        if not relative_to:
+        if relative_to is None:
             relative_to = self
         
         assert relative_to.__class__ == self.__class__, \
                 'relative_to should be of type %s but is of type %s' % (self.__class__, relative_to.__class__)
             
-        maxviews = relative_to.aggregate(models.Max('views'))['views__max']
+        SQL_VIEWS = self._get_views_sql()
+        
+        # relative_to can have sharded trackers when the QuerySet has not
+        SQL_MAXVIEWS, params = self._max_sql(relative_to, relative_to._get_views_sql())
         
-        SQL_RELVIEWS = self._SQL_RELVIEWS % {'maxviews' : maxviews}
+        SQL_RELVIEWS = self._SQL_RELVIEWS % {'views' : SQL_VIEWS, 'maxviews' : SQL_MAXVIEWS}
         
-        return self._add_extra('relviews', SQL_RELVIEWS)
+        return self._add_extra('relviews', SQL_RELVIEWS, params)
 
+    @instrument_lazy('queryset.select_relage')
     def select_relage(self, relative_to=None):
         """ Adds 'relage', a normalized age, relative to the QuerySet.
             The normalization occcurs relative to the maximum age
@@ -121,7 +328,7 @@ class ViewTrackerQuerySet(models.query.QuerySet):
             The relative age should always in the range [0, 1]. """
         assert self._DATABASE_ENGINE in COMPATIBLE_DATABASES, 'Database engine %s is not compatible with this functionality.'
         
-        if not relative_to:
+        if relative_to is None:
             relative_to = self
 
         assert relative_to.__class__ == self.__class__, \
@@ -129,14 +336,15 @@ class ViewTrackerQuerySet(models.query.QuerySet):
 
         _SQL_AGE = self._SQL_AGE % {'now' : self._get_db_datetime() }
 
-        maxage = relative_to.extra(select={'maxage':'MAX(%s)' % _SQL_AGE}).values('maxage')[0]['maxage']
+        SQL_MAXAGE, params = self._max_sql(relative_to, _SQL_AGE)
 
         SQL_RELAGE = self._SQL_RELAGE % {'age'    : _SQL_AGE,
-                                         'maxage' : maxage}
+                                         'maxage' : SQL_MAXAGE}
 
-        return self._add_extra('relage', SQL_RELAGE)
+        return self._add_extra('relage', SQL_RELAGE, params)
 
 
+    @instrument_lazy('queryset.select_novelty')
     def select_novelty(self, minimum=0.0, charage=None):
         """ Compute novelty - this is the age muliplied by a characteristic time.
             After a this characteristic age, the novelty will be half its original
@@ -147,7 +355,7 @@ class ViewTrackerQuerySet(models.query.QuerySet):
         assert self._DATABASE_ENGINE in COMPATIBLE_DATABASES, 'Database engine %s is not compatible with this functionality.'
         
         offset = minimum
-        factor = 1/(1-offset)
+        factor = 1-offset
         
         # Characteristic age, default one hour
         # After this amount (in seconds) the novelty is exactly 0.5
@@ -164,16 +372,18 @@ class ViewTrackerQuerySet(models.query.QuerySet):
 
         return self._add_extra('novelty', SQL_NOVELTY)
     
+    @instrument_lazy('queryset.select_popularity')
     def select_popularity(self):
         """ Compute popularity, which is defined as: views/age. """
         assert self._DATABASE_ENGINE in COMPATIBLE_DATABASES, 'Database engine %s is not compatible with this functionality.'
         
         _SQL_AGE = self._SQL_AGE % {'now' : self._get_db_datetime() }
         
-        SQL_POPULARITY = self._SQL_POPULARITY % {'age' : _SQL_AGE }
+        SQL_POPULARITY = self._SQL_POPULARITY % {'age' : _SQL_AGE, 'views' : self._get_views_sql() }
 
         return self._add_extra('popularity', SQL_POPULARITY)
     
+    @instrument_lazy('queryset.select_relpopularity')
     def select_relpopularity(self, relative_to=None):
         """ Compute relative popularity, which is defined as: (views/age)/MAX(views/age).
             
@@ -181,7 +391,7 @@ class ViewTrackerQuerySet(models.query.QuerySet):
 
         assert self._DATABASE_ENGINE in COMPATIBLE_DATABASES, 'Database engine %s is not compatible with this functionality.'
         
-        if not relative_to:
+        if relative_to is None:
             relative_to = self
 
         assert relative_to.__class__ == self.__class__, \
@@ -189,30 +399,32 @@ class ViewTrackerQuerySet(models.query.QuerySet):
 
         _SQL_AGE = self._SQL_AGE % {'now' : self._get_db_datetime() }
 
-        SQL_POPULARITY = self._SQL_POPULARITY % {'age' : _SQL_AGE }
+        SQL_POPULARITY = self._SQL_POPULARITY % {'age' : _SQL_AGE, 'views' : self._get_views_sql() }
 
-        maxpopularity = relative_to.extra(select={'popularity' : SQL_POPULARITY}).aggregate(models.Max('popularity'))['popularity__max']
+        SQL_MAXPOPULARITY, params = self._max_sql(relative_to, self._SQL_POPULARITY % {'age' : _SQL_AGE, 'views' : relative_to._get_views_sql() })
         
         SQL_RELPOPULARITY = self._SQL_RELPOPULARITY % {'popularity'    : SQL_POPULARITY,
-                                                       'maxpopularity' : maxpopularity }
+                                                       'maxpopularity' : SQL_MAXPOPULARITY }
 
-        return self._add_extra('relpopularity', SQL_POPULARITY)
+        return self._add_extra('relpopularity', SQL_RELPOPULARITY, params)
     
+    @instrument_lazy('queryset.select_random')
     def select_random(self):
         """ Returns the original QuerySet with an extra field 'random' containing a random
             value in the range [0,1] to use for ordering.
         """
         assert self._DATABASE_ENGINE in COMPATIBLE_DATABASES, 'Database engine %s is not compatible with this functionality.'
         
-        SQL_RANDOM = self.RANDOM
+        SQL_RANDOM = self._SQL_RANDOM
         
         return self._add_extra('random', SQL_RANDOM)
     
-    def select_relevance(relative_to=None, minimum_novelty=0.1, charage_novelty=None):
+    @instrument_lazy('queryset.select_relevance')
+    def select_relevance(self, relative_to=None, minimum_novelty=0.1, charage_novelty=None):
         """ This adds the multiplication of novelty and relpopularity to the QuerySet, as 'relevance'. """
         assert self._DATABASE_ENGINE in COMPATIBLE_DATABASES, 'Database engine %s is not compatible with this functionality.'
         
-        if not relative_to:
+        if relative_to is None:
             relative_to = self
         
         assert relative_to.__class__ == self.__class__, \
@@ -220,12 +432,12 @@ class ViewTrackerQuerySet(models.query.QuerySet):
         
         _SQL_AGE = self._SQL_AGE % {'now' : self._get_db_datetime() }
         
-        SQL_POPULARITY = self._SQL_POPULARITY % {'age' : _SQL_AGE }
+        SQL_POPULARITY = self._SQL_POPULARITY % {'age' : _SQL_AGE, 'views' : self._get_views_sql() }
         
-        maxpopularity = relative_to.extra(select={'popularity' : SQL_POPULARITY}).aggregate(models.Max('popularity'))['popularity__max']
+        SQL_MAXPOPULARITY, params = self._max_sql(relative_to, self._SQL_POPULARITY % {'age' : _SQL_AGE, 'views' : relative_to._get_views_sql() })
         
         SQL_RELPOPULARITY = self._SQL_RELPOPULARITY % {'popularity'    : SQL_POPULARITY,
-                                                       'maxpopularity' : maxpopularity }
+                                                       'maxpopularity' : SQL_MAXPOPULARITY }
         
         # Characteristic age, default one hour
         # After this amount (in seconds) the novelty is exactly 0.5
@@ -233,7 +445,7 @@ class ViewTrackerQuerySet(models.query.QuerySet):
            charage_novelty = POPULARITY_CHARAGE
         
         offset = minimum_novelty
-        factor = 1/(1-offset)
+        factor = 1-offset
         
         _SQL_AGE = self._SQL_AGE % {'now' : self._get_db_datetime() }
         
@@ -246,9 +458,32 @@ class ViewTrackerQuerySet(models.query.QuerySet):
         SQL_RELEVANCE = self._SQL_RELEVANCE % {'novelty'       : SQL_NOVELTY,
                                                'relpopularity' : SQL_RELPOPULARITY }
 
-        return self._add_extra('relevance', SQL_RELEVANCE)
+        return self._add_extra('relevance', SQL_RELEVANCE, params)
 
-    def select_ordering(relview=0.0, relage=0.0, novelty=0.0, relpopularity=0.0, random=0.0, relevance=0.0, offset=0.0, charage_novelty=None, relative_to=None):
+    @instrument('queryset.get_maxima')
+    def get_maxima(self, relview=0.0, relage=0.0, novelty=0.0, relpopularity=0.0, random=0.0, relevance=0.0, offset=0.0):
+        """ Returns a dictionary with the maximum 'views', 'age' and 'popularity' 
+            in the QuerySet, as far as needed by select_ordering with the same 
+            weights, read with a single query. """
+        assert self._DATABASE_ENGINE in COMPATIBLE_DATABASES, 'Database engine %s is not compatible with this functionality.'
+        
+        _SQL_AGE = self._SQL_AGE % {'now' : self._get_db_datetime() }
+        
+        select = {}
+        if relview:
+            select['views'] = 'MAX(%s)' % self._get_views_sql()
+        if relage:
+            select['age'] = 'MAX(%s)' % _SQL_AGE
+        if relpopularity or relevance:
+            select['popularity'] = 'MAX(%s)' % (self._SQL_POPULARITY % {'age' : _SQL_AGE, 'views' : self._get_views_sql() })
+        
+        if not select:
+            return {}
+        
+        return self.order_by().extra(select=select).values(*select.keys())[0]
+    
+    @instrument_lazy('queryset.select_ordering')
+    def select_ordering(self, relview=0.0, relage=0.0, novelty=0.0, relpopularity=0.0, random=0.0, relevance=0.0, offset=0.0, charage_novelty=None, relative_to=None, maxima=None):
         """ Creates an 'ordering' field used for sorting the current QuerySet according to
             specified criteria, given by the parameters. 
             
@@ -257,10 +492,14 @@ class ViewTrackerQuerySet(models.query.QuerySet):
             
             Please do note that the relative age is the only value here that INCREASES over time so
             you might want to specify a NEGATIVE value here and use an offset, just to compensate. 
+            
+            Only the values with a weight are computed. The maxima of relative_to
+            are computed in subqueries, unless they are given in 'maxima', as 
+            returned by get_maxima for the same weights.
         """
         assert self._DATABASE_ENGINE in COMPATIBLE_DATABASES, 'Database engine %s is not compatible with this functionality.'
         
-        if not relative_to:
+        if relative_to is None:
             relative_to = self
         
         assert relative_to.__class__ == self.__class__, \
@@ -268,17 +507,17 @@ class ViewTrackerQuerySet(models.query.QuerySet):
         
         assert abs(relview+relage+novelty+relpopularity+random+relevance) > 0, 'You should at least give me something to order by!'
         
-        maxviews = relative_to.aggregate(models.Max('views'))['views__max']
+        if maxima is None:
+            maxima = {}
         
-        SQL_RELVIEWS = self._SQL_RELVIEWS % {'maxviews' : maxviews}
+        def max_sql(name, sql):
+            if name in maxima:
+                return '%s', [maxima[name]]
+            
+            return self._max_sql(relative_to, sql)
         
         _SQL_AGE = self._SQL_AGE % {'now' : self._get_db_datetime() }
         
-        maxage = relative_to_extra(select={'age':_SQL_AGE}).aggregate(Max('age'))['age__max']
-
-        SQL_RELAGE = self._SQL_RELAGE % {'age'    : _SQL_AGE,
-                                         'maxage' : maxage}
-
         # Characteristic age, default one hour
         # After this amount (in seconds) the novelty is exactly 0.5
         if not charage_novelty:
@@ -290,34 +529,184 @@ class ViewTrackerQuerySet(models.query.QuerySet):
                                             'charage'    : charage_novelty,
                                             'offset'     : 0.0, 
                                             'factor'     : 1.0 }
-                                            
-        SQL_POPULARITY = self._SQL_POPULARITY % {'age' : _SQL_AGE }
-
-        maxpopularity = relative_to.extra(select={'popularity':SQL_POPULARITY}).aggregate(Max('popularity'))['popularity__max']
-
-        SQL_RELPOPULARITY = self._SQL_RELPOPULARITY % {'popularity'    : SQL_POPULARITY,
-                                                       'maxpopularity' : maxpopularity }
         
-        SQL_RANDOM = self.RANDOM
+        # The weighted values, and the parameters in the order in which they appear in the SQL
+        terms = []
+        params = []
         
-        SQL_RELEVANCE = self._SQL_RELEVANCE % {'novelty'       : SQL_NOVELTY,
-                                               'relpopularity' : SQL_RELPOPULARITY }
-                                      
-        SQL_ORDERING = self._SQL_ORDERING % {'relview'           : relview,
-                                             'relage'            : relage,
-                                             'novelty'           : novelty,
-                                             'relpopularity'     : relpopularity,
-                                             'relevance'         : relevance,
-                                             'random'            : random,
-                                             'relview_sql'       : SQL_RELVIEWS,
-                                             'relage_sql'        : SQL_RELAGE,
-                                             'novelty_sql'       : SQL_NOVELTY,
-                                             'relpopularity_sql' : SQL_RELPOPULARITY,
-                                             'random_sql'        : SQL_RANDOM,
-                                             'relevance_sql'     : SQL_RELEVANCE }
-        
-        return self._add_extra('ordering', SQL_ORDERING)
+        if relview:
+            SQL_MAXVIEWS, maxviews_params = max_sql('views', relative_to._get_views_sql())
+            
+            terms.append((relview, self._SQL_RELVIEWS % {'views' : self._get_views_sql(), 'maxviews' : SQL_MAXVIEWS}))
+            params += maxviews_params
+        
+        if relage:
+            SQL_MAXAGE, maxage_params = max_sql('age', _SQL_AGE)
+            
+            terms.append((relage, self._SQL_RELAGE % {'age' : _SQL_AGE, 'maxage' : SQL_MAXAGE}))
+            params += maxage_params
+        
+        if novelty:
+            terms.append((novelty, SQL_NOVELTY))
+        
+        if relpopularity or relevance:
+            SQL_POPULARITY = self._SQL_POPULARITY % {'age' : _SQL_AGE, 'views' : self._get_views_sql() }
+            
+            SQL_MAXPOPULARITY, maxpopularity_params = max_sql('popularity', self._SQL_POPULARITY % {'age' : _SQL_AGE, 'views' : relative_to._get_views_sql() })
+            
+            SQL_RELPOPULARITY = self._SQL_RELPOPULARITY % {'popularity'    : SQL_POPULARITY,
+                                                           'maxpopularity' : SQL_MAXPOPULARITY }
+        
+        if relpopularity:
+            terms.append((relpopularity, SQL_RELPOPULARITY))
+            params += maxpopularity_params
+        
+        if random:
+            terms.append((random, self._SQL_RANDOM))
+        
+        if relevance:
+            terms.append((relevance, self._SQL_RELEVANCE % {'novelty'       : SQL_NOVELTY,
+                                                            'relpopularity' : SQL_RELPOPULARITY }))
+            params += maxpopularity_params
         
+        SQL_ORDERING = ' + '.join(['%f * %s' % term for term in terms] + ['%f' % offset])
+        
+        return self._add_extra('ordering', SQL_ORDERING, params)
+        
+    @instrument('queryset.get_top_ordering')
+    def get_top_ordering(self, limit=None, candidates=None, relview=0.0, relage=0.0, novelty=0.0, relpopularity=0.0, random=0.0, relevance=0.0, offset=0.0, charage_novelty=None):
+        """ Returns the trackers with the highest 'ordering' of select_ordering
+            with the given weights, without computing it for every tracker.
+            
+            Only the first `candidates` trackers (POPULARITY_CANDIDATES by 
+            default) by every weighted value are scored, which are read from 
+            the indexes on views, added and score; the maxima used for the 
+            relative values are read from the views and added indexes as well.
+            
+            Returns a tuple with a list of trackers, with their 'ordering', 
+            and whether the list is exact: whether it is certain no tracker 
+            which was not scored could be in it. This is checked with the 
+            threshold algorithm: the ordering of a tracker which is not a
+            candidate can be at most the sum of the weighted values of the
+            last candidates of every value. Relative popularity and relevance
+            are relative to the maximum popularity of the candidates, so the
+            list is only exact with their weights or random when all trackers
+            are candidates. """
+        assert abs(relview+relage+novelty+relpopularity+random+relevance) > 0, 'You should at least give me something to order by!'
+        
+        if not limit:
+            limit = POPULARITY_LISTSIZE
+        
+        if not candidates:
+            candidates = POPULARITY_CANDIDATES
+        
+        if not charage_novelty:
+            charage_novelty = POPULARITY_CHARAGE
+        
+        now = datetime.now()
+        qs = self.order_by()
+        
+        def seconds(value):
+            age = now - value
+            return age.days * 86400 + age.seconds + age.microseconds / 1e6
+        
+        maxima = qs.aggregate(maxviews=models.Max('views'), added=models.Min('added'))
+        maxviews = maxima['maxviews'] or 0
+        maxage = maxima['added'] and seconds(maxima['added']) or 0
+        
+        def divide(numerator, denominator):
+            # NULL when dividing by zero, as in SQL
+            if numerator is None or not denominator:
+                return None
+            return float(numerator) / denominator
+        
+        def get_novelty(age):
+            return exp(self._LOGSCALING * age / charage_novelty)
+        
+        # The values which are weighted, their orderings from high to low and 
+        # the value of a candidate with its views and age
+        values = []
+        if relview:
+            values.append((relview, relview > 0 and '-views' or 'views', lambda views, age: divide(views, maxviews)))
+        if relage:
+            values.append((relage, relage > 0 and 'added' or '-added', lambda views, age: divide(age, maxage)))
+        if novelty:
+            values.append((novelty, novelty > 0 and '-added' or 'added', lambda views, age: get_novelty(age)))
+        if relpopularity or relevance:
+            # The objects with many views recently, which is not exactly the popularity
+            values.append((None, '-score', None))
+        
+        complete = False
+        scored = {}
+        threshold = offset
+        for weight, ordering, value in values:
+            rows = list(qs.order_by(ordering).values_list('pk', 'views', 'added')[:candidates])
+            
+            for pk, views, added in rows:
+                scored[pk] = (views, seconds(added))
+            
+            if len(rows) < candidates:
+                complete = True
+            elif weight is not None and threshold is not None:
+                last = value(rows[-1][1], seconds(rows[-1][2]))
+                
+                if last is None:
+                    threshold = None
+                else:
+                    threshold += weight * last
+        
+        popularities = {}
+        for pk, (views, age) in scored.iteritems():
+            popularities[pk] = divide(views, age)
+        
+        maxpopularity = max([0] + [popularity for popularity in popularities.values() if popularity is not None])
+        
+        orderings = []
+        for pk, (views, age) in scored.iteritems():
+            terms = []
+            for weight, ordering, value in values:
+                if weight is not None:
+                    terms.append((weight, value(views, age)))
+            
+            if relpopularity or relevance:
+                relpopularity_value = divide(popularities[pk], maxpopularity)
+                
+                if relpopularity:
+                    terms.append((relpopularity, relpopularity_value))
+                if relevance and relpopularity_value is None:
+                    terms.append((relevance, None))
+                elif relevance:
+                    terms.append((relevance, relpopularity_value * get_novelty(age)))
+            
+            if random:
+                terms.append((random, uniform(0, 1)))
+            
+            if None in [term for weight, term in terms]:
+                # NULL, which comes last
+                continue
+            
+            orderings.append((sum([weight * term for weight, term in terms]) + offset, pk))
+        
+        orderings.sort(reverse=True)
+        orderings = orderings[:limit]
+        
+        trackers = dict([(tracker.pk, tracker) for tracker in self.filter(pk__in=[pk for ordering, pk in orderings]).order_by()])
+        
+        tracker_list = []
+        for ordering, pk in orderings:
+            trackers[pk].ordering = ordering
+            tracker_list.append(trackers[pk])
+        
+        if complete:
+            exact = True
+        elif relpopularity or relevance or random or get_shard_counts():
+            exact = False
+        else:
+            exact = threshold is not None and len(orderings) == limit and orderings[-1][0] >= threshold
+        
+        return tracker_list, exact
+    
+    @instrument_lazy('queryset.get_recently_viewed')
     def get_recently_viewed(self, limit=None):
         """ Returns the most recently viewed objects. """
         if not limit:
@@ -325,6 +714,7 @@ class ViewTrackerQuerySet(models.query.QuerySet):
             
         return self.order_by('-viewed')[:limit]
     
+    @instrument_lazy('queryset.get_recently_added')
     def get_recently_added(self, limit=None):
         """ Returns the objects with the most rcecent added. """
         if not limit:
@@ -332,24 +722,192 @@ class ViewTrackerQuerySet(models.query.QuerySet):
             
         return self.order_by('-added')[:limit]
     
-    def get_most_popular(self, limit=None):
-        """ Returns the most popular objects. """
+    @instrument_lazy('queryset.get_most_popular')
+    def get_most_popular(self, limit=None, mode='age', window=None):
+        """ Returns the most popular objects. 
+            
+            By default, popularity is the number of views divided by the age, 
+            which has to be calculated for every row. With mode='indexed' the 
+            objects are ordered by the stored score instead: the number of views
+            where every view counts half as much after POPULARITY_CHARAGE seconds.
+            This only has to read the first rows of the score index. 
+            
+            When a window (a timedelta) is given, the objects with the most views
+            in this period are returned, see get_most_viewed_in(). """
         if not limit:
             limit = POPULARITY_LISTSIZE
+        
+        if window is not None:
+            return self.get_most_viewed_in(window, limit)
+        
+        if mode == 'indexed':
+            return self.order_by('-score')[:limit]
+        
+        assert mode == 'age', 'Unknown popularity mode %s' % mode
             
         return self.select_popularity().order_by('-popularity')[:limit]
     
-    def get_most_viewed(self, limit=None):
-        """ Returns the most viewed objects. """
+    @instrument('queryset.get_most_viewed_in')
+    def get_most_viewed_in(self, window, limit=None):
+        """ Returns a list with the trackers with the most views in the last
+            'window' (a timedelta), counted from the hourly or - for windows
+            longer than POPULARITY_BUCKETS_HOURLY_RETENTION - daily buckets. 
+            Buckets partially in the window are counted completely. 
+            
+            The number of views in the window is available as 'window_views'. 
+            Requires POPULARITY_BUCKETS. """
+        if not limit:
+            limit = POPULARITY_LISTSIZE
+        
+        if window <= POPULARITY_BUCKETS_HOURLY_RETENTION:
+            resolution = ViewBucket.HOURLY
+        else:
+            resolution = ViewBucket.DAILY
+        
+        since = ViewBucket.get_start(datetime.now() - window, resolution)
+        
+        # Only count buckets of the objects in the current QuerySet
+        tracker_table = self._dialect.quote(self.model._meta.db_table)
+        bucket_table = self._dialect.quote(ViewBucket._meta.db_table)
+        trackers = self.order_by().extra(where=['%(trackers)s.content_type_id = %(buckets)s.content_type_id AND %(trackers)s.object_id = %(buckets)s.object_id' % 
+                                                {'trackers' : tracker_table, 'buckets' : bucket_table}]).values('pk')
+        trackers_sql, trackers_params = trackers.query.get_compiler(using=self.db).as_sql()
+        
+        buckets = ViewBucket.objects.using(self.db).filter(resolution=resolution, start__gte=since)
+        buckets = buckets.extra(where=['EXISTS (%s)' % trackers_sql], params=trackers_params)
+        
+        totals = buckets.values('content_type', 'object_id').annotate(window_views=models.Sum('views')).order_by('-window_views')[:limit]
+        
+        object_ids = {}
+        for total in totals:
+            object_ids.setdefault(total['content_type'], []).append(total['object_id'])
+        
+        trackers = {}
+        for content_type_id, ids in object_ids.iteritems():
+            for tracker in self.filter(content_type=content_type_id, object_id__in=ids).order_by():
+                trackers[(content_type_id, tracker.object_id)] = tracker
+        
+        tracker_list = []
+        for total in totals:
+            tracker = trackers.get((total['content_type'], total['object_id']))
+            
+            if tracker:
+                tracker.window_views = total['window_views']
+                tracker_list.append(tracker)
+        
+        return tracker_list
+    
+    @instrument_lazy('queryset.get_most_viewed')
+    def get_most_viewed(self, limit=None, unique=False):
+        """ Returns the most viewed objects, or with unique=True those with the
+            most unique viewers. When POPULARITY_SHARDS is set, the number of 
+            views including those in shards is available as 'total_views'. 
+            
+            The objects are read from the views index. When the QuerySet can
+            have trackers of sharded models, a list is returned instead: the 
+            top of the index and the trackers with shards are ordered by 
+            their total views in Python, as only those can get ahead. """
         if not limit:
             limit = POPULARITY_LISTSIZE
+        
+        if unique:
+            return self.order_by('-unique_views')[:limit]
+        
+        sharded = self._get_sharded()
+        
+        if not sharded:
+            qs = self
+            if get_shard_counts():
+                qs = qs._add_extra('total_views', self._get_views_sql())
             
-        return self.order_by('-views')[:limit]
+            return qs.order_by('-views')[:limit]
+        
+        trackers = {}
+        for tracker in self.order_by('-views')[:limit]:
+            trackers[(tracker.content_type_id, tracker.object_id)] = tracker
+        
+        # Only the shards of trackers in this QuerySet, with a subquery per model
+        shard_views = {}
+        for content_type_id in sharded:
+            object_ids = self.filter(content_type=content_type_id).order_by().values('object_id')
+            shards = ViewShard.objects.using(self.db).filter(content_type=content_type_id, object_id__in=object_ids).order_by()
+            
+            for shard in shards.values('content_type', 'object_id').annotate(shard_views=models.Sum('views')):
+                shard_views[(shard['content_type'], shard['object_id'])] = shard['shard_views']
+        
+        object_ids = {}
+        for content_type_id, object_id in shard_views:
+            if (content_type_id, object_id) not in trackers:
+                object_ids.setdefault(content_type_id, []).append(object_id)
+        
+        chunk_size = self._dialect.max_params - 1
+        for content_type_id, ids in object_ids.iteritems():
+            for start in xrange(0, len(ids), chunk_size):
+                for tracker in self.filter(content_type=content_type_id, object_id__in=ids[start:start + chunk_size]).order_by():
+                    trackers[(content_type_id, tracker.object_id)] = tracker
+        
+        for key, tracker in trackers.iteritems():
+            tracker.total_views = tracker.views + shard_views.get(key, 0)
+        
+        tracker_list = sorted(trackers.values(), key=lambda tracker: (-tracker.total_views, tracker.pk))
+        
+        return tracker_list[:limit]
+        
+    @instrument_lazy('queryset.ranked')
+    def ranked(self, profile, limit=None):
+        """ Returns the trackers with the highest score for the ranking profile
+            (see POPULARITY_RANKING_PROFILES), as stored by the last run of
+            the popularity_rank command, highest first. The score is available
+            as 'ranking'. Unlike select_ordering, only the precomputed scores 
+            are read; trackers which have not been scored yet are left out. """
+        assert profile in POPULARITY_RANKING_PROFILES, 'Unknown ranking profile %s' % profile
+        
+        if not limit:
+            limit = POPULARITY_LISTSIZE
+        
+        SQL_RANKING = '%s.score' % self._dialect.quote(RankingScore._meta.db_table)
+        
+        qs = self.filter(rankings__profile=profile).extra(select={'ranking' : SQL_RANKING})
+        
+        return qs.order_by('-ranking')[:limit]
+    
+    @instrument('queryset.get_trending_now')
+    def get_trending_now(self, model, limit=None):
+        """ Returns a list with the trackers of the objects of model viewed 
+            most in the last minutes, by this process, with views counting 
+            half after every POPULARITY_TRENDING_HALFLIFE seconds. The ranking
+            comes from memory (see popularity.trending); only the trackers are
+            retrieved, by object id. The decayed number of views is available
+            as 'trending_views'. Requires POPULARITY_TRENDING_SIZE. """
+        if not limit:
+            limit = POPULARITY_LISTSIZE
+        
+        ct = ContentType.objects.get_for_model(model)
         
+        top = get_trending(ct.pk, limit)
+        if not top:
+            return []
+        
+        trackers = {}
+        for tracker in self.filter(content_type=ct, object_id__in=[object_id for object_id, views in top]).order_by():
+            trackers[tracker.object_id] = tracker
+        
+        tracker_list = []
+        for object_id, views in top:
+            tracker = trackers.get(object_id)
+            
+            if tracker:
+                tracker.trending_views = views
+                tracker_list.append(tracker)
+        
+        return tracker_list
+    
+    @instrument_lazy('queryset.get_for_model')
     def get_for_model(self, model):
         """ Returns the objects and its views for a certain model. """
         return self.get_for_models([model])
     
+    @instrument_lazy('queryset.get_for_models')
     def get_for_models(self, models):
         """ Returns the objects and its views for specified models. """
 
@@ -357,8 +915,16 @@ class ViewTrackerQuerySet(models.query.QuerySet):
         for model in models:
             cts.append(ContentType.objects.get_for_model(model))
         
-        return self.filter(content_type__in=cts)
+        qs = self.filter(content_type__in=cts)
+        
+        content_types = set([ct.pk for ct in cts])
+        if self._content_types is not None:
+            content_types &= self._content_types
+        qs._content_types = content_types
+        
+        return qs
     
+    @instrument('queryset.get_for_object')
     def get_for_object(self, content_object, create=False):
         """ Gets the viewtracker for specified object, or creates one 
             if requested. """
@@ -372,46 +938,259 @@ class ViewTrackerQuerySet(models.query.QuerySet):
         
         return viewtracker
     
-    def get_for_objects(self, objects):
-        """ Gets the viewtrackers for specified objects, or creates them 
-            if requested. """
+    def _get_objects_filter(self, objects):
+        """ Returns a filter for the trackers of objects, with one 
+            object_id IN (...) clause for every content type, or None
+            if there are no objects. """
         
-        qs = self.none()
+        object_ids = {}
         for obj in objects:
-            ct = ContentType.objects.get_for_model(obj.__class__)
+            object_ids.setdefault(obj.__class__, []).append(obj.pk)
+        
+        q = None
+        for model, ids in object_ids.iteritems():
+            ct = ContentType.objects.get_for_model(model)
             
-            qs = qs | self.filter(content_type=ct, object_id=obj.pk)
+            if q is None:
+                q = models.Q(content_type=ct, object_id__in=ids)
+            else:
+                q = q | models.Q(content_type=ct, object_id__in=ids)
         
-        return self & qs
+        return q
     
+    @instrument_lazy('queryset.get_for_objects')
+    def get_for_objects(self, objects):
+        """ Gets the viewtrackers for specified objects. """
+        
+        q = self._get_objects_filter(objects)
+        
+        if q is None:
+            return self.none()
+        
+        return self.filter(q)
+    
+    @instrument('queryset.get_views_for_objects')
+    def get_views_for_objects(self, objects):
+        """ Returns a dictionary with the number of views for the specified
+            objects, keyed by (content_type_id, object_id). Objects without
+            a tracker are left out. """
+        
+        q = self._get_objects_filter(objects)
+        
+        if q is None:
+            return {}
+        
+        views = {}
+        for content_type_id, object_id, count in self.filter(q).order_by().values_list('content_type', 'object_id', 'views'):
+            views[(content_type_id, object_id)] = count
+        
+        shard_counts = get_shard_counts()
+        if [key for key in views if key[0] in shard_counts]:
+            shards = ViewShard.objects.using(self.db).filter(q).order_by().values('content_type', 'object_id')
+            for shard in shards.annotate(shard_views=models.Sum('views')):
+                key = (shard['content_type'], shard['object_id'])
+                views[key] = views.get(key, 0) + shard['shard_views']
+        
+        return views
+    
+    @instrument_lazy('queryset.get_for_queryset')
     def get_for_queryset(self, qs):
         """ Gets the viewtrackers for the objects in a specified queryset. """
         
         ct = ContentType.objects.get_for_model(qs.model)
             
-        return self.filter(content_type=ct, object_id__in=qs.values('pk'))
+        return self.filter(content_type=ct, object_id__in=qs.order_by().values('pk'))
+    
+    def apply_deltas(self, deltas):
+        """ Applies many view increments at once. `deltas` is an iterable of
+            (content_type_id, object_id, delta, viewed_at) tuples; increments for 
+            the same object are added up first. A HyperLogLog sketch of the 
+            viewers can be added to the tuples as fifth item, which is merged 
+            into the sketch of the tracker. 
+            
+            Trackers are created when they do not exist yet. The increments are 
+            written using a handful of multi-row INSERT ... ON DUPLICATE KEY UPDATE 
+            (MySQL) or INSERT ... ON CONFLICT (PostgreSQL, SQLite) statements, which
+            are atomic so no views get lost when multiple processes write at once.
+            
+            Returns the number of trackers updated or created. """
+        
+        merged = {}
+        buckets = {}
+        sketches = {}
+        for values in deltas:
+            content_type_id, object_id, delta, viewed = values[:4]
+            key = (int(content_type_id), int(object_id))
+            score = get_score(delta, viewed)
+            
+            if len(values) > 4 and values[4] is not None and POPULARITY_UNIQUE_VIEWS:
+                if key in sketches:
+                    sketches[key].merge(values[4])
+                else:
+                    sketches[key] = values[4].copy()
+            
+            if POPULARITY_BUCKETS:
+                for resolution in (ViewBucket.HOURLY, ViewBucket.DAILY):
+                    bucket = key + (resolution, ViewBucket.get_start(viewed, resolution))
+                    buckets[bucket] = buckets.get(bucket, 0) + delta
+            
+            if key in merged:
+                total, added, last, total_score = merged[key]
+                merged[key] = (total + delta, min(added, viewed), max(last, viewed), logaddexp(total_score, score))
+            else:
+                merged[key] = (delta, viewed, viewed, score)
+        
+        if not merged:
+            return 0
+        
+        dialect = get_dialect(self.db)
+        ops = dialect.connection.ops
+        shard_counts = get_shard_counts()
+        
+        rows = []
+        sharded_rows = []
+        shard_rows = []
+        for (content_type_id, object_id), (delta, added, viewed, score) in merged.iteritems():
+            if content_type_id in shard_counts:
+                # Views go to a random shard; the score and the time viewed 
+                # go to the tracker, so the indexes on them stay up to date
+                shard = randrange(shard_counts[content_type_id])
+                shard_rows.append((content_type_id, object_id, shard, delta, ops.value_to_db_datetime(viewed), NO_VIEWS_SCORE))
+                
+                delta = 0
+                target = sharded_rows
+            else:
+                target = rows
+            
+            # Sketches are merged into those of existing trackers later on
+            target.append((content_type_id, object_id, delta, 
+                           ops.value_to_db_datetime(added), 
+                           ops.value_to_db_datetime(viewed),
+                           score, '', 0))
+        
+        count = dialect.upsert(self.model._meta.db_table,
+                               ('content_type_id', 'object_id'),
+                               ('content_type_id', 'object_id', 'views', 'added', 'viewed', 'score', 'sketch', 'unique_views'),
+                               rows,
+                               (('views', ADD), ('viewed', GREATEST), ('score', LOGADDEXP)))
+        
+        if sharded_rows:
+            count += dialect.upsert(self.model._meta.db_table,
+                                    ('content_type_id', 'object_id'),
+                                    ('content_type_id', 'object_id', 'views', 'added', 'viewed', 'score', 'sketch', 'unique_views'),
+                                    sharded_rows,
+                                    (('viewed', GREATEST), ('score', LOGADDEXP)))
+            
+            dialect.upsert(ViewShard._meta.db_table,
+                           ('content_type_id', 'object_id', 'shard'),
+                           ('content_type_id', 'object_id', 'shard', 'views', 'viewed', 'score'),
+                           shard_rows,
+                           (('views', ADD), ('viewed', GREATEST)))
+        
+        if buckets:
+            rows = [bucket[:3] + (ops.value_to_db_datetime(bucket[3]), delta) for bucket, delta in buckets.iteritems()]
+            
+            dialect.upsert(ViewBucket._meta.db_table,
+                           ('content_type_id', 'object_id', 'resolution', 'start'),
+                           ('content_type_id', 'object_id', 'resolution', 'start', 'views'),
+                           rows,
+                           (('views', ADD), ))
+        
+        if sketches:
+            self._merge_sketches(dialect, sketches)
+        
+        logging.debug('Applied view deltas for %d objects.' % count)
+        
+        return count
+    
+    def _merge_sketches(self, dialect, sketches):
+        """ Merges sketches, a dictionary of HyperLogLog sketches by 
+            (content_type_id, object_id), into those of the trackers and 
+            updates their unique_views. The trackers are locked while they
+            are updated. """
+        table = dialect.quote(self.model._meta.db_table)
+        
+        # Within a transaction of the caller, the locks are held until it ends
+        managed = not transaction.is_managed(using=self.db)
+        if managed:
+            transaction.enter_transaction_management(using=self.db)
+            transaction.managed(True, using=self.db)
+        try:
+            cursor = dialect.connection.cursor()
+            
+            # In a fixed order, so concurrent writers do not deadlock
+            for (content_type_id, object_id), sketch in sorted(sketches.iteritems()):
+                cursor.execute('SELECT sketch FROM %s WHERE content_type_id = %%s AND object_id = %%s%s' % (table, dialect.sql_for_update),
+                               [content_type_id, object_id])
+                row = cursor.fetchone()
+                
+                if row and row[0]:
+                    sketch.merge(HyperLogLog.from_string(row[0]))
+                
+                cursor.execute('UPDATE %s SET sketch = %%s, unique_views = %%s WHERE content_type_id = %%s AND object_id = %%s' % table,
+                               [sketch.to_string(), sketch.count(), content_type_id, object_id])
+            
+            if managed:
+                transaction.commit(using=self.db)
+        except:
+            if managed:
+                transaction.rollback(using=self.db)
+            raise
+        finally:
+            if managed:
+                transaction.leave_transaction_management(using=self.db)
     
+    @instrument('queryset.get_object_list')
     def get_object_list(self):
-        """ Gets a list with all the objects tracked in the current queryset. """
+        """ Gets a list with all the objects tracked in the current queryset,
+            leaving out deleted objects. """
         
-        obj_list = []
-        for obj in self:
-            obj_list.append(obj.content_object)
+        trackers, missing = hydrate(list(self))
         
-        return obj_list
+        return [tracker.content_object for tracker in trackers]
     
+    @instrument('queryset.get_querysets')
     def get_querysets(self):
         """ Gets a list of all the querysets for the objects tracked in the current queryset. """
         
         qs_list = []
-        for ct_id in self.values('content_type').distinct():
+        for ct_id in self.order_by().values_list('content_type', flat=True).distinct():
             ct = ContentType.objects.get_for_id(ct_id)
-            qs_inner = self.filter(content_type=ct_id).values('object_id')
-            qs = ct.model_class().objects.filter(pk__in=qs_inner)
+            qs_inner = self.filter(content_type=ct_id).order_by().values('object_id')
+            qs = ct.model_class()._default_manager.filter(pk__in=qs_inner)
             
             qs_list.append(qs)
         
         return qs_list
+    
+    def iter_tracked(self, chunk_size=1000):
+        """ Iterates over (tracker, object) pairs for the trackers in the 
+            current queryset, in the order of their primary keys, leaving out
+            deleted objects. Trackers are retrieved chunk_size at a time, 
+            continuing after the last primary key of the previous chunk, and
+            their objects with one query per model for every chunk, so memory 
+            use does not depend on the number of trackers. """
+        
+        qs = self.order_by('pk')
+        last = None
+        
+        while True:
+            if last is None:
+                chunk = list(qs[:chunk_size])
+            else:
+                chunk = list(qs.filter(pk__gt=last)[:chunk_size])
+            
+            if not chunk:
+                return
+            
+            last = chunk[-1].pk
+            
+            trackers, missing = hydrate(chunk)
+            for tracker in trackers:
+                yield tracker, tracker.content_object
+            
+            if len(chunk) < chunk_size:
+                return
 
 class ViewTrackerManager(models.Manager):
     """ Manager methods to do stuff like:
@@ -444,12 +1223,21 @@ class ViewTrackerManager(models.Manager):
     def select_random(self, *args, **kwargs):
         return self.get_query_set().select_random(*args, **kwargs)
 
+    def select_relevance(self, *args, **kwargs):
+        return self.get_query_set().select_relevance(*args, **kwargs)
+
     def select_ordering(self, *args, **kwargs):
         return self.get_query_set().select_ordering(*args, **kwargs)
+    
+    def get_maxima(self, *args, **kwargs):
+        return self.get_query_set().get_maxima(*args, **kwargs)
 
     def get_recently_added(self, *args, **kwargs):
         return self.get_query_set().get_recently_added(*args, **kwargs)
     
+    def get_top_ordering(self, *args, **kwargs):
+        return self.get_query_set().get_top_ordering(*args, **kwargs)
+    
     def get_recently_viewed(self, *args, **kwargs):
         return self.get_query_set().get_recently_viewed(*args, **kwargs)
     
@@ -459,6 +1247,15 @@ class ViewTrackerManager(models.Manager):
     def get_most_popular(self, *args, **kwargs):
             return self.get_query_set().get_most_popular(*args, **kwargs)
     
+    def get_most_viewed_in(self, *args, **kwargs):
+        return self.get_query_set().get_most_viewed_in(*args, **kwargs)
+    
+    def ranked(self, *args, **kwargs):
+        return self.get_query_set().ranked(*args, **kwargs)
+    
+    def get_trending_now(self, *args, **kwargs):
+        return self.get_query_set().get_trending_now(*args, **kwargs)
+    
     def get_for_model(self, *args, **kwargs):
         return self.get_query_set().get_for_model(*args, **kwargs)
     
@@ -471,11 +1268,23 @@ class ViewTrackerManager(models.Manager):
     def get_for_objects(self, *args, **kwargs):
         return self.get_query_set().get_for_objects(*args, **kwargs)
     
+    def get_views_for_objects(self, *args, **kwargs):
+        return self.get_query_set().get_views_for_objects(*args, **kwargs)
+    
     def get_for_queryset(self, *args, **kwargs):
         return self.get_query_set().get_for_queryset(*args, **kwargs)
     
     def get_object_list(self, *args, **kwargs):
         return self.get_query_set().get_object_list(*args, **kwargs)
+    
+    def get_querysets(self, *args, **kwargs):
+        return self.get_query_set().get_querysets(*args, **kwargs)
+    
+    def iter_tracked(self, *args, **kwargs):
+        return self.get_query_set().iter_tracked(*args, **kwargs)
+    
+    def apply_deltas(self, *args, **kwargs):
+        return self.get_query_set().apply_deltas(*args, **kwargs)
 
 
 class ViewTracker(models.Model):
@@ -492,6 +1301,14 @@ class ViewTracker(models.Model):
     
     views = models.PositiveIntegerField(default=0)
     
+    # Time-decayed view count in log space, see get_score()
+    score = models.FloatField(default=NO_VIEWS_SCORE, db_index=True)
+    
+    # HyperLogLog sketch of the viewers and the number of unique viewers estimated 
+    # from it, when POPULARITY_UNIQUE_VIEWS is set
+    sketch = models.TextField(blank=True, default='')
+    unique_views = models.PositiveIntegerField(default=0, db_index=True)
+    
     objects = ViewTrackerManager()
     
     class Meta:
@@ -500,39 +1317,401 @@ class ViewTracker(models.Model):
         unique_together = ('content_type', 'object_id')
     
     def __unicode__(self):
-        return u"%s, %d views" % (self.content_object, self.views)
+        # Only use the content object when it has been retrieved already
+        if hasattr(self, '_content_object_cache'):
+            return u"%s, %d views" % (self.content_object, self.views)
+        
+        ct = ContentType.objects.get_for_id(self.content_type_id)
+        return u"%s %d, %d views" % (ct.model, self.object_id, self.views)
             
     @classmethod
-    def add_view_for(cls, content_object):
-        """ This increments the viewcount for a given object. """
+    @instrument('add_view_for')
+    def add_view_for(cls, content_object, viewer=None):
+        """ This increments the viewcount for a given object. The viewer, a
+            string identifying who viewed the object, is used for counting 
+            unique viewers when POPULARITY_UNIQUE_VIEWS is set.
+        
+            When a counter backend is configured (POPULARITY_COUNTER_BACKEND or
+            POPULARITY_BUFFERED), the view is passed on to the backend and None 
+            is returned instead of the tracker. None is returned as well when 
+            the view is dropped, as a repeated view by the same viewer within 
+            POPULARITY_DEDUP_WINDOW seconds. """
         
         ct = ContentType.objects.get_for_model(content_object)
         assert ct != ContentType.objects.get_for_model(cls), 'Cannot add ViewTracker for ViewTracker.'
         
-        qs = cls.objects.filter(content_type=ct, object_id=content_object.pk)
+        repeats = get_repeat_filter()
+        if viewer is not None and repeats and repeats.is_repeat(viewer, ct.pk, content_object.pk):
+            return None
+        
+        record(ct.pk, content_object.pk)
         
-        assert qs.count() == 0 or qs.count() == 1, 'More than one ViewTracker for object %s' % content_object
+        if not POPULARITY_UNIQUE_VIEWS:
+            viewer = None
         
-        rows = qs.update(views=F('views') + 1, viewed=datetime.now())
+        backend = get_backend()
+        if backend:
+            backend.incr(ct.pk, content_object.pk, viewer=viewer)
+            return None
         
-        # This is here mainly for compatibility reasons
-        if not rows:
-            qs.create(content_type=ct, object_id=content_object.pk, views=1, viewed=datetime.now())
-            logging.debug('ViewTracker created for object %s' % content_object)
+        # This creates the tracker if it doesn't exist yet
+        cls.objects.apply_deltas([(ct.pk, content_object.pk, 1, datetime.now(), get_sketch(viewer))])
+        
+        viewtracker = cls.objects.get(content_type=ct, object_id=content_object.pk)
+        logging.debug('Views updated to %d for %s' % (viewtracker.views, content_object))
+        
+        return viewtracker
+    
+    @classmethod
+    def add_view_by_id(cls, content_type_id, object_id, viewer=None):
+        """ Increments the viewcount for the object with the given content 
+            type and primary key, without retrieving the object. Whether the
+            object exists is checked against a Bloom filter of the primary 
+            keys of its model (see popularity.bloom); the model's DoesNotExist
+            is raised for unknown objects. Unlike add_view_for, the tracker 
+            is not returned. """
+        
+        ct = ContentType.objects.get_for_id(content_type_id)
+        model = ct.model_class()
+        
+        if not model or issubclass(model, cls):
+            raise ContentType.DoesNotExist('Cannot add views for content type %d.' % content_type_id)
+        
+        if not get_existing(ct, [object_id]):
+            raise model.DoesNotExist('%s %d does not exist.' % (model.__name__, object_id))
+        
+        repeats = get_repeat_filter()
+        if viewer is not None and repeats and repeats.is_repeat(viewer, ct.pk, object_id):
+            return
+        
+        record(ct.pk, object_id)
+        
+        if not POPULARITY_UNIQUE_VIEWS:
+            viewer = None
+        
+        backend = get_backend()
+        if backend:
+            backend.incr(ct.pk, object_id, viewer=viewer)
         else:
-            logging.debug('Views updated to %d for %s' % (qs[0].views, content_object))
+            cls.objects.apply_deltas([(ct.pk, object_id, 1, datetime.now(), get_sketch(viewer))])
+    
+    @classmethod
+    def add_views_for_ids(cls, views, viewer=None):
+        """ Adds views for a sequence of (content_type_id, object_id) pairs in
+            bulk, all by the same viewer; a pair occurring more than once counts
+            as multiple views. The objects are not checked for existence. 
+            Repeated views are dropped as in add_view_for. Returns the number 
+            of distinct objects viewed. """
+        
+        repeats = get_repeat_filter()
+        if viewer is not None and repeats:
+            views = [key for key in views if not repeats.is_repeat(viewer, *key)]
+        
+        counts = {}
+        for key in views:
+            counts[key] = counts.get(key, 0) + 1
+        
+        for (content_type_id, object_id), count in counts.iteritems():
+            record(content_type_id, object_id, count)
+        
+        now = datetime.now()
         
-        return qs[0]
+        if not POPULARITY_UNIQUE_VIEWS:
+            viewer = None
+        
+        backend = get_backend()
+        if backend:
+            for (content_type_id, object_id), count in counts.iteritems():
+                backend.incr(content_type_id, object_id, count, now, viewer)
+        else:
+            sketch = get_sketch(viewer)
+            cls.objects.apply_deltas([key + (count, now, sketch) for key, count in counts.iteritems()])
+        
+        logging.debug('Added views for %d objects.' % len(counts))
+        
+        return len(counts)
     
     @classmethod
-    def get_views_for(cls, content_object):
-        """ Gets the total number of views for content_object. """
+    @instrument('get_views_for')
+    def get_views_for(cls, content_object, include_pending=True):
+        """ Gets the total number of views for content_object, including
+            those in its ViewShards. Unless include_pending is False, views 
+            which the counter backend has not written to the database yet 
+            are added as well. """
+        
+        ct = ContentType.objects.get_for_model(content_object)
+        
+        views = 0
+        backend = get_backend()
+        if include_pending and backend:
+            views = backend.pending(ct.pk, content_object.pk)
+        
+        if ct.pk in get_shard_counts():
+            shards = ViewShard.objects.filter(content_type=ct, object_id=content_object.pk)
+            views += shards.aggregate(models.Sum('views'))['views__sum'] or 0
         
         """ If we don't have any views, return 0. """
         try:
             viewtracker = cls.objects.get_for_object(content_object)
         except ViewTracker.DoesNotExist:
-            return 0 
+            return views
+        
+        return viewtracker.views + views
+
+
+
+class ViewBucketManager(models.Manager):
+    """ Manager for ViewBuckets, which removes buckets which are no longer needed. """
+    
+    def compact(self, now=None):
+        """ Removes hourly buckets older than POPULARITY_BUCKETS_HOURLY_RETENTION
+            and daily buckets older than POPULARITY_BUCKETS_DAILY_RETENTION, 
+            with a single DELETE statement per resolution. Returns the number 
+            of buckets removed. """
+        if not now:
+            now = datetime.now()
+        
+        dialect = get_dialect(self.db)
+        ops = dialect.connection.ops
+        cursor = dialect.connection.cursor()
+        sql = 'DELETE FROM %s WHERE %s = %%s AND %s < %%s' % (dialect.quote(self.model._meta.db_table),
+                                                           dialect.quote('resolution'),
+                                                           dialect.quote('start'))
+        
+        removed = 0
+        for resolution, retention in ((ViewBucket.HOURLY, POPULARITY_BUCKETS_HOURLY_RETENTION),
+                                      (ViewBucket.DAILY, POPULARITY_BUCKETS_DAILY_RETENTION)):
+            cursor.execute(sql, [resolution, ops.value_to_db_datetime(now - retention)])
+            removed += cursor.rowcount
+        
+        transaction.commit_unless_managed(using=self.db)
+        
+        return removed
+
+
+class ViewBucket(models.Model):
+    """ The number of views of an object in an hour or a day, which makes 
+        it possible to find the objects viewed most in a recent period. """
+    
+    HOURLY = 3600
+    DAILY = 86400
+    
+    RESOLUTION_CHOICES = (
+        (HOURLY, 'hourly'),
+        (DAILY, 'daily'),
+    )
+    
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    
+    resolution = models.PositiveIntegerField(choices=RESOLUTION_CHOICES)
+    start = models.DateTimeField(db_index=True)
+    
+    views = models.PositiveIntegerField(default=0)
+    
+    objects = ViewBucketManager()
+    
+    class Meta:
+        unique_together = ('content_type', 'object_id', 'resolution', 'start')
+    
+    def __unicode__(self):
+        return u"%s #%d, %d views since %s" % (self.content_type, self.object_id, self.views, self.start)
+    
+    @classmethod
+    def get_start(cls, value, resolution):
+        """ Returns the start of the bucket containing datetime value. """
+        if resolution == cls.DAILY:
+            return value.replace(hour=0, minute=0, second=0, microsecond=0)
+        
+        assert resolution == cls.HOURLY, 'Unknown bucket resolution %s' % resolution
+        
+        return value.replace(minute=0, second=0, microsecond=0)
+
+class ViewShardManager(models.Manager):
+    """ Manager for ViewShards, which folds them into the ViewTrackers. """
+    
+    def fold(self, batch_size=1000):
+        """ Adds the views of all shards to their ViewTrackers and removes the 
+            shards, batch_size shards at a time, so the shards are only locked
+            briefly. Every batch is committed, unless a transaction is already 
+            managed by the caller. Returns the number of shards folded. """
+        dialect = get_dialect(self.db)
+        ops = dialect.connection.ops
+        table = dialect.quote(self.model._meta.db_table)
+        
+        managed = not transaction.is_managed(using=self.db)
+        
+        folded = 0
+        trackers = 0
+        last_pk = 0
+        while True:
+            if managed:
+                transaction.enter_transaction_management(using=self.db)
+                transaction.managed(True, using=self.db)
+            try:
+                cursor = dialect.connection.cursor()
+                cursor.execute('SELECT id, content_type_id, object_id, views, viewed, score FROM %s WHERE id > %%s ORDER BY id LIMIT %d%s' % 
+                               (table, batch_size, dialect.sql_for_update), [last_pk])
+                shards = cursor.fetchall()
+                
+                if shards:
+                    last_pk = shards[-1][0]
+                
+                if shards and dialect.sql_for_update:
+                    # The shards are locked, so they are removed at once
+                    cursor.execute('DELETE FROM %s WHERE id IN (%s)' % (table, ', '.join(['%s'] * len(shards))), 
+                                   [shard[0] for shard in shards])
+                    removed = shards
+                else:
+                    # Shards changed since they were selected are left for the next time
+                    removed = []
+                    for shard in shards:
+                        cursor.execute('DELETE FROM %s WHERE id = %%s AND views = %%s' % table, [shard[0], shard[3]])
+                        if cursor.rowcount:
+                            removed.append(shard)
+                
+                merged = {}
+                # The scores of the views were added to the trackers already
+                for pk, content_type_id, object_id, views, viewed, score in removed:
+                    key = (content_type_id, object_id)
+                    if key in merged:
+                        total, last = merged[key]
+                        merged[key] = (total + views, max(last, viewed))
+                    else:
+                        merged[key] = (views, viewed)
+                
+                rows = []
+                for (content_type_id, object_id), (views, viewed) in merged.iteritems():
+                    rows.append((content_type_id, object_id, views, 
+                                 ops.value_to_db_datetime(viewed), 
+                                 ops.value_to_db_datetime(viewed), 
+                                 NO_VIEWS_SCORE, '', 0))
+                
+                dialect.upsert(ViewTracker._meta.db_table,
+                               ('content_type_id', 'object_id'),
+                               ('content_type_id', 'object_id', 'views', 'added', 'viewed', 'score', 'sketch', 'unique_views'),
+                               rows,
+                               (('views', ADD), ('viewed', GREATEST)))
+                
+                if managed:
+                    transaction.commit(using=self.db)
+            except:
+                if managed:
+                    transaction.rollback(using=self.db)
+                raise
+            finally:
+                if managed:
+                    transaction.leave_transaction_management(using=self.db)
+            
+            folded += len(removed)
+            trackers += len(merged)
+            
+            if len(shards) < batch_size:
+                break
+        
+        logging.debug('Folded %d shards into %d tracker updates.' % (folded, trackers))
         
-        return viewtracker.views
+        return folded
 
+class ViewShard(models.Model):
+    """ Part of the views of an object of a model in POPULARITY_SHARDS. Views
+        of these objects are spread over several shards, so concurrent views
+        do not have to wait for the lock on a single ViewTracker row. """
+    
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.PositiveIntegerField()
+    
+    shard = models.PositiveSmallIntegerField()
+    
+    viewed = models.DateTimeField()
+    views = models.PositiveIntegerField(default=0)
+    # No longer used, the scores of the views are added to the ViewTracker
+    score = models.FloatField(default=NO_VIEWS_SCORE)
+    
+    objects = ViewShardManager()
+    
+    class Meta:
+        unique_together = ('content_type', 'object_id', 'shard')
+    
+    def __unicode__(self):
+        return u"%s #%d, shard %d, %d views" % (self.content_type, self.object_id, self.shard, self.views)
+
+class RankingScoreManager(models.Manager):
+    """ Manager for RankingScores, which computes them for the ViewTrackers. """
+    
+    def refresh(self, profile, full=False, chunk_size=1000):
+        """ Computes the score of the ranking profile for the ViewTrackers 
+            viewed since the previous refresh, or for all of them when full is
+            True, and stores them. Returns the number of scores written.
+            
+            The scores of other trackers are left alone, so their novelty and
+            relative values are those of the time they were computed; refresh
+            fully every now and then to let them age. Trackers whose ordering
+            is NULL, like those without views, get no score. """
+        assert profile in POPULARITY_RANKING_PROFILES, 'Unknown ranking profile %s' % profile
+        
+        weights = dict(POPULARITY_RANKING_PROFILES[profile])
+        charage = weights.pop('charage', None)
+        
+        started = datetime.now()
+        
+        trackers = ViewTracker.objects.db_manager(self.db).order_by()
+        changed = trackers
+        
+        if not full:
+            last = self.filter(profile=profile).aggregate(last=models.Max('computed'))['last']
+            
+            if last:
+                changed = trackers.filter(viewed__gte=last - timedelta(seconds=POPULARITY_RANKING_OVERLAP))
+        
+        # Normalized values are relative to all trackers, not only the changed ones,
+        # whose maxima are read once instead of by the query of every chunk
+        maxima = trackers.get_maxima(**weights)
+        scores = changed.select_ordering(charage_novelty=charage, relative_to=trackers, maxima=maxima, **weights)
+        
+        dialect = get_dialect(self.db)
+        computed = dialect.connection.ops.value_to_db_datetime(started)
+        
+        count = 0
+        last_pk = 0
+        while True:
+            chunk = list(scores.filter(pk__gt=last_pk).order_by('pk').values_list('pk', 'ordering')[:chunk_size])
+            
+            if not chunk:
+                break
+            
+            last_pk = chunk[-1][0]
+            
+            # The ordering is NULL when a maximum or an age is 0, which comes 
+            # last; these trackers are left out until they can be scored
+            unscored = [pk for pk, score in chunk if score is None]
+            if unscored:
+                self.filter(profile=profile, tracker__in=unscored).delete()
+            
+            count += dialect.upsert(self.model._meta.db_table,
+                                    ('tracker_id', 'profile'),
+                                    ('tracker_id', 'profile', 'score', 'computed'),
+                                    [(pk, profile, score, computed) for pk, score in chunk if score is not None],
+                                    (('score', REPLACE), ('computed', REPLACE)))
+        
+        logging.debug('Computed %d scores for ranking profile %s.' % (count, profile))
+        
+        return count
+
+class RankingScore(models.Model):
+    """ Precomputed score of a ViewTracker for a ranking profile in
+        POPULARITY_RANKING_PROFILES, read by ViewTracker.objects.ranked. """
+    
+    tracker = models.ForeignKey(ViewTracker, related_name='rankings')
+    profile = models.CharField(max_length=50, db_index=True)
+    
+    score = models.FloatField(db_index=True)
+    computed = models.DateTimeField()
+    
+    objects = RankingScoreManager()
+    
+    class Meta:
+        unique_together = ('tracker', 'profile')
+    
+    def __unicode__(self):
+        return u"%s, %s: %f" % (self.tracker, self.profile, self.score)
@@ -0,0 +1,178 @@
+# This file is part of django-popularity.
+#
+# django-popularity: A generic view- and popularity tracking pluggable for Django.
+# Copyright (C) 2008-2010 Mathijs de Bruin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" Scoring of trackers in Python with NumPy, for databases on which the
+    select_* methods of ViewTrackerQuerySet are not available or to combine
+    the scores with other signals. NumPy is optional; it is only needed for
+    this module. """
+
+from __future__ import with_statement
+
+from datetime import datetime
+from math import log
+
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from models import ViewShard, POPULARITY_CHARAGE, get_shard_counts
+from dialects import get_dialect
+
+class Scorer(object):
+    """ Computes the values of the select_* methods of ViewTrackerQuerySet for
+        the trackers in a QuerySet, the candidates, as NumPy arrays. Only the
+        columns needed are retrieved, with values_list, so no model instances
+        are created. As in SQL, relative values are relative to the maximum
+        over the candidates, and divisions by zero give NaN (NULL). """
+
+    _LOGSCALING = log(0.5)
+
+    def __init__(self, queryset, now=None):
+        if numpy is None:
+            raise ImproperlyConfigured('The scoring engine requires NumPy.')
+
+        if now is None:
+            now = datetime.now()
+
+        rows = list(queryset.order_by().values_list('pk', 'content_type', 'object_id', 'views', 'added'))
+
+        self.pks = numpy.array([row[0] for row in rows], dtype=numpy.int64)
+        self.views = numpy.array([row[3] for row in rows], dtype=numpy.float64)
+
+        added = numpy.array([row[4] for row in rows], dtype='datetime64[us]')
+        self._age = (numpy.datetime64(now, 'us') - added).astype(numpy.float64) / 1e6
+
+        shard_counts = get_shard_counts()
+        if shard_counts:
+            self._add_shard_views(queryset, rows, shard_counts)
+
+    def __len__(self):
+        return len(self.pks)
+
+    def _add_shard_views(self, queryset, rows, shard_counts):
+        """ Adds the views in the ViewShards of the candidates, like 
+            _get_views_sql does. """
+        indexes = {}
+        object_ids = {}
+        for index, row in enumerate(rows):
+            if row[1] in shard_counts:
+                indexes[(row[1], row[2])] = index
+                object_ids.setdefault(row[1], []).append(row[2])
+
+        chunk_size = get_dialect(queryset.db).max_params - 1
+        for content_type_id, ids in object_ids.iteritems():
+            for start in xrange(0, len(ids), chunk_size):
+                shards = ViewShard.objects.using(queryset.db).filter(content_type=content_type_id, object_id__in=ids[start:start + chunk_size]).order_by()
+
+                for object_id, views in shards.values_list('object_id', 'views'):
+                    self.views[indexes[(content_type_id, object_id)]] += views
+
+    def _divide(self, numerator, denominator):
+        """ Division which is NaN when dividing by zero, like dialect.divide. """
+        denominator = numpy.asarray(denominator, dtype=numpy.float64)
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            result = numpy.true_divide(numerator, denominator)
+
+        return numpy.where(denominator == 0, numpy.nan, result)
+
+    def _max(self, values):
+        """ Maximum ignoring NaN, like MAX() ignores NULL. """
+        if not len(values) or numpy.isnan(values).all():
+            return numpy.nan
+
+        return numpy.nanmax(values)
+
+    def age(self):
+        return self._age
+
+    def relviews(self):
+        return self._divide(self.views, self._max(self.views))
+
+    def relage(self):
+        return self._divide(self._age, self._max(self._age))
+
+    def novelty(self, minimum=0.0, charage=None):
+        if not charage:
+            charage = POPULARITY_CHARAGE
+
+        return (1 - minimum) * numpy.exp(self._LOGSCALING * self._age / charage) + minimum
+
+    def popularity(self):
+        return self._divide(self.views, self._age)
+
+    def relpopularity(self):
+        popularity = self.popularity()
+
+        return self._divide(popularity, self._max(popularity))
+
+    def random(self):
+        return numpy.random.random_sample(len(self))
+
+    def relevance(self, minimum_novelty=0.1, charage_novelty=None):
+        return self.relpopularity() * self.novelty(minimum_novelty, charage_novelty)
+
+    def ordering(self, relview=0.0, relage=0.0, novelty=0.0, relpopularity=0.0, random=0.0, relevance=0.0, offset=0.0, charage_novelty=None):
+        """ The weighted sum of select_ordering, with the same parameters.
+            Values which are not weighted are not computed. """
+        assert abs(relview+relage+novelty+relpopularity+random+relevance) > 0, 'You should at least give me something to order by!'
+
+        ordering = numpy.zeros(len(self)) + offset
+
+        # As in select_ordering, the novelty has no minimum here
+        if novelty or relevance:
+            novelty_values = self.novelty(0.0, charage_novelty)
+        if relpopularity or relevance:
+            relpopularity_values = self.relpopularity()
+
+        if relview:
+            ordering += relview * self.relviews()
+        if relage:
+            ordering += relage * self.relage()
+        if novelty:
+            ordering += novelty * novelty_values
+        if relpopularity:
+            ordering += relpopularity * relpopularity_values
+        if random:
+            ordering += random * self.random()
+        if relevance:
+            ordering += relevance * relpopularity_values * novelty_values
+
+        return ordering
+
+    def top(self, scores, limit):
+        """ Returns a list with the (pk, score) pairs of the trackers with the
+            highest scores, an array as returned by the other methods, highest
+            first. Trackers with a NaN score come last. Only the top is sorted. """
+        scores = numpy.where(numpy.isnan(scores), -numpy.inf, scores)
+
+        limit = min(limit, len(scores))
+        if limit <= 0:
+            return []
+
+        if limit < len(scores):
+            indexes = numpy.argpartition(-scores, limit - 1)[:limit]
+        else:
+            indexes = numpy.arange(len(scores))
+
+        indexes = indexes[numpy.argsort(-scores[indexes], kind='mergesort')]
+
+        return [(int(self.pks[index]), float(scores[index])) for index in indexes]
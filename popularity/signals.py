@@ -20,13 +20,15 @@ import django.dispatch
 
 from models import ViewTracker
 
-view = django.dispatch.Signal()
+view = django.dispatch.Signal(providing_args=['viewer'])
 
-def view_handler(signal, sender, **kwargs):
-    ViewTracker.add_view_for(sender)
+def view_handler(signal, sender, viewer=None, **kwargs):
+    ViewTracker.add_view_for(sender, viewer=viewer)
 
 view.connect(view_handler)
 
 # Use this in the following way:
 # from popularity.signals import view
 # view.send(myinstance)
+# or, to count unique viewers:
+# view.send(myinstance, viewer='user:%d' % request.user.pk)
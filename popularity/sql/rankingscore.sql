@@ -0,0 +1,3 @@
+-- Index for ViewTracker.objects.ranked(), which reads the highest scores
+-- of a single ranking profile.
+CREATE INDEX popularity_rankingscore_profile_score ON popularity_rankingscore (profile, score);
@@ -0,0 +1,13 @@
+-- Composite indexes for the getters of ViewTrackerQuerySet, which are run
+-- on the whole table or after get_for_model(): get_most_viewed (views and
+-- unique_views), get_recently_viewed (viewed), get_recently_added (added)
+-- and get_most_popular(mode='indexed') (score). With these, the first rows
+-- of an index are read instead of sorting all trackers of a model.
+CREATE INDEX popularity_viewtracker_ct_views ON popularity_viewtracker (content_type_id, views);
+CREATE INDEX popularity_viewtracker_ct_unique_views ON popularity_viewtracker (content_type_id, unique_views);
+CREATE INDEX popularity_viewtracker_ct_viewed ON popularity_viewtracker (content_type_id, viewed);
+CREATE INDEX popularity_viewtracker_ct_added ON popularity_viewtracker (content_type_id, added);
+CREATE INDEX popularity_viewtracker_ct_score ON popularity_viewtracker (content_type_id, score);
+CREATE INDEX popularity_viewtracker_views ON popularity_viewtracker (views);
+CREATE INDEX popularity_viewtracker_viewed ON popularity_viewtracker (viewed);
+CREATE INDEX popularity_viewtracker_added ON popularity_viewtracker (added);
@@ -20,17 +20,30 @@ from django import template
 from django.db.models import get_model
 
 from popularity.models import ViewTracker
+from popularity.leaderboards import get_leaderboard
+from popularity.metrics import instrument
 from django.contrib.contenttypes.models import ContentType
 
 register = template.Library()
 
 @register.filter
-def viewtrack(value):
+def viewtrack(value, mode=None):
     ''' Add reference to script for adding a view to an object's tracker. 
         Usage: {{ object|viewtrack }}
         This will be substituted by: 'add_view_for(content_type_id, object_id)'
+        
+        Usage: {{ object|viewtrack:"batch" }}
+        This will be substituted by: 'queue_view_for(content_type_id, object_id)',
+        for queueing views which are posted to the batch URL together.
     '''
     ct = ContentType.objects.get_for_model(value)
+    
+    if mode == 'batch':
+        return 'queue_view_for(%d,%d)' % (ct.pk, value.pk)
+    
+    if mode:
+        raise template.TemplateSyntaxError("viewtrack filter only accepts the argument 'batch'")
+    
     return 'add_view_for(%d,%d)' % (ct.pk, value.pk)
 
 def validate_template_tag_params(bits, arguments_count, keyword_positions):
@@ -56,6 +69,7 @@ class ViewsForObjectNode(template.Node):
         self.object = object
         self.context_var = context_var
 
+    @instrument('tag.views_for_object')
     def render(self, context):
         try:
             object = template.resolve_variable(self.object, context)
@@ -69,18 +83,22 @@ class ViewsForObjectsNode(template.Node):
         self.objects = objects
         self.var_name = var_name
 
+    @instrument('tag.views_for_objects')
     def render(self, context):
         try:
             objects = template.resolve_variable(self.objects, context)
         except template.VariableDoesNotExist:
             return ''
 
-        queryset = ViewTracker.objects.get_for_objects(objects)
-        view_dict = {}
-        for row in queryset:
-            view_dict[row.object_id] = row.views
+        view_dict = ViewTracker.objects.get_views_for_objects(objects)
+        
+        content_types = {}
         for object in objects:
-            object.__setattr__(self.var_name, view_dict.get(object.id,0))
+            if object.__class__ not in content_types:
+                content_types[object.__class__] = ContentType.objects.get_for_model(object.__class__).pk
+            
+            views = view_dict.get((content_types[object.__class__], object.pk), 0)
+            object.__setattr__(self.var_name, views)
         return ''
 
 class MostPopularForModelNode(template.Node):
@@ -89,11 +107,12 @@ class MostPopularForModelNode(template.Node):
         self.context_var = context_var
         self.limit = limit
 
+    @instrument('tag.most_popular_for_model')
     def render(self, context):
         model = get_model(*self.model.split('.'))
         if model is None:
             raise TemplateSyntaxError('most_popular_for_model tag was given an invalid model: %s' % self.model)
-        context[self.context_var] = ViewTracker.objects.get_for_model(model=model).get_most_popular(limit=self.limit)
+        context[self.context_var] = get_leaderboard('most_popular', model, self.limit)
         return ''
 
 class MostViewedForModelNode(template.Node):
@@ -102,11 +121,12 @@ class MostViewedForModelNode(template.Node):
         self.context_var = context_var
         self.limit = limit
 
+    @instrument('tag.most_viewed_for_model')
     def render(self, context):
         model = get_model(*self.model.split('.'))
         if model is None:
             raise TemplateSyntaxError('most_viewed_for_model tag was given an invalid model: %s' % self.model)
-        context[self.context_var] = ViewTracker.objects.get_for_model(model=model).get_most_viewed(limit=self.limit)
+        context[self.context_var] = get_leaderboard('most_viewed', model, self.limit)
         return ''
 
 class RecentlyViewedForModelNode(template.Node):
@@ -115,11 +135,12 @@ class RecentlyViewedForModelNode(template.Node):
         self.context_var = context_var
         self.limit = limit
 
+    @instrument('tag.recently_viewed_for_model')
     def render(self, context):
         model = get_model(*self.model.split('.'))
         if model is None:
             raise TemplateSyntaxError('recently_viewed_for_model tag was given an invalid model: %s' % self.model)
-        context[self.context_var] = ViewTracker.objects.get_for_model(model=model).get_recently_viewed(limit=self.limit)
+        context[self.context_var] = get_leaderboard('recently_viewed', model, self.limit)
         return ''
 
 class RecentlyAddedForModelNode(template.Node):
@@ -128,11 +149,26 @@ class RecentlyAddedForModelNode(template.Node):
         self.context_var = context_var
         self.limit = limit
 
+    @instrument('tag.recently_added_for_model')
     def render(self, context):
         model = get_model(*self.model.split('.'))
         if model is None:
             raise TemplateSyntaxError('recently_added_for_model tag was given an invalid model: %s' % self.model)
-        context[self.context_var] = ViewTracker.objects.get_for_model(model=model).get_recently_added(limit=self.limit)
+        context[self.context_var] = get_leaderboard('recently_added', model, self.limit)
+        return ''
+
+class TrendingNowForModelNode(template.Node):
+    def __init__(self, model, context_var, limit=None):
+        self.model = model
+        self.context_var = context_var
+        self.limit = limit
+
+    @instrument('tag.trending_now_for_model')
+    def render(self, context):
+        model = get_model(*self.model.split('.'))
+        if model is None:
+            raise template.TemplateSyntaxError('trending_now_for_model tag was given an invalid model: %s' % self.model)
+        context[self.context_var] = ViewTracker.objects.get_trending_now(model, self.limit)
         return ''
 
 # Tags
@@ -247,3 +283,25 @@ def recently_added_for_model(parser, token):
     else:
         validate_template_tag_params(bits, 3, {2:'as'})
         return RecentlyAddedForModelNode(bits[1], bits[3])
+
+@register.tag
+def trending_now_for_model(parser, token):
+    """
+    Retrieves the ViewTrackers for the instances of the given model viewed most
+    in the last minutes, as counted in memory by this process. Requires
+    settings.POPULARITY_TRENDING_SIZE. If the limit is not given it will use 
+    settings.POPULARITY_LISTSIZE
+
+    Example usage::
+
+        {% trending_now_for_model main.model_name as trending_models %}
+        {% trending_now_for_model main.model_name as trending_models limit 20 %}
+
+    """
+    bits = token.contents.split()
+    if len(bits) > 4:
+        validate_template_tag_params(bits, 5, {2:'as', 4:'limit'})
+        return TrendingNowForModelNode(bits[1], bits[3], int(bits[5]))
+    else:
+        validate_template_tag_params(bits, 3, {2:'as'})
+        return TrendingNowForModelNode(bits[1], bits[3])
@@ -20,12 +20,13 @@ import random
 import unittest
 
 from time import sleep
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from django.template import Context, Template
 from django.contrib.contenttypes.models import ContentType
 
 from popularity.models import *
+from popularity.signals import view
 
 REPEAT_COUNT = 3
 MAX_SECONDS = 2
@@ -44,7 +45,44 @@ class TestObject(models.Model):
 import popularity
 popularity.register(TestObject)
 
-class PopularityTestCase(unittest.TestCase):
+class TrackerTestCase(unittest.TestCase):
+    """ Starts without trackers, with `num_objects` new TestObjects, and
+        counts the queries run by the code under test. """
+    
+    num_objects = 3
+    
+    def setUp(self):
+        TestObject.objects.all().delete()
+        ViewTracker.objects.all().delete()
+        
+        self.objs = [TestObject.objects.create(title='Obj %d' % i) for i in xrange(self.num_objects)]
+        self.ct = ContentType.objects.get_for_model(TestObject)
+    
+    def get_queries(self, func, *args, **kwargs):
+        """ Calls func and returns its result and the queries it ran. """
+        from django.conf import settings
+        from django.db import connection
+        
+        old_debug = settings.DEBUG
+        settings.DEBUG = True
+        try:
+            connection.queries = []
+            
+            result = func(*args, **kwargs)
+            
+            return result, list(connection.queries)
+        finally:
+            settings.DEBUG = old_debug
+    
+    def assertNumQueries(self, num, func, *args, **kwargs):
+        """ Asserts that func runs num queries and returns its result. """
+        result, queries = self.get_queries(func, *args, **kwargs)
+        
+        self.assertEqual(len(queries), num, '\n'.join([query['sql'] for query in queries]))
+        
+        return result
+
+class PopularityTestCase(TrackerTestCase):
     def random_view(self):
         ViewTracker.add_view_for(random.choice(self.objs))
         
@@ -103,8 +141,7 @@ class PopularityTestCase(unittest.TestCase):
                 self.assert_(tracker.viewed > tracker.added)
     
     def testAge(self):
-        from django.conf import settings
-        if settings.DATABASE_ENGINE == 'mysql':
+        if ViewTracker.objects.all()._DATABASE_ENGINE in COMPATIBLE_DATABASES:
             for i in xrange(0,REPEAT_COUNT):
                 new = TestObject(title='Obj q')
                 new.save()
@@ -157,8 +194,7 @@ class PopularityTestCase(unittest.TestCase):
                     
     
     def testRelviews(self):
-        from django.conf import settings
-        if settings.DATABASE_ENGINE == 'mysql':
+        if ViewTracker.objects.all()._DATABASE_ENGINE in COMPATIBLE_DATABASES:
             for i in xrange(0,REPEAT_COUNT):
                 self.random_view()
                 
@@ -173,8 +209,7 @@ class PopularityTestCase(unittest.TestCase):
                     self.assertAlmostEquals(float(obj.relviews), relviews_expected, 3, 'views=%d, relviews=%f, expected=%f' % (obj.views, obj.relviews, relviews_expected))
     
     def testNovelty(self):
-        from django.conf import settings
-        if settings.DATABASE_ENGINE == 'mysql':
+        if ViewTracker.objects.all()._DATABASE_ENGINE in COMPATIBLE_DATABASES:
             new = TestObject(title='Obj q')
             new.save()
             
@@ -190,8 +225,7 @@ class PopularityTestCase(unittest.TestCase):
             self.assertAlmostEquals(float(novelty), 0.5, 1, 'novelty=%f != 0.5' % novelty)
     
     def testRelage(self):
-        from django.conf import settings
-        if settings.DATABASE_ENGINE == 'mysql':
+        if ViewTracker.objects.all()._DATABASE_ENGINE in COMPATIBLE_DATABASES:
             for x in xrange(REPEAT_COUNT):
                 new = TestObject(title='Obj q')
                 new.save()
@@ -199,7 +233,7 @@ class PopularityTestCase(unittest.TestCase):
                 viewtracker = ViewTracker.add_view_for(new)
         
                 relage = ViewTracker.objects.select_relage()
-                youngest = relage.order_by('relage')[0]
+                youngest = relage.order_by('relage', '-pk')[0]
         
                 self.assertEqual(viewtracker, youngest)
                 self.assertAlmostEquals(float(youngest.relage), 0.0, 2)
@@ -216,8 +250,7 @@ class PopularityTestCase(unittest.TestCase):
         """ Very simple test for relative counts: just
             checks whether the value is between 0 and 1. 
         """
-        from django.conf import settings
-        if settings.DATABASE_ENGINE == 'mysql':
+        if ViewTracker.objects.all()._DATABASE_ENGINE in COMPATIBLE_DATABASES:
             for x in xrange(REPEAT_COUNT):
                 new = TestObject(title='Obj q')
                 new.save()
@@ -234,10 +267,42 @@ class PopularityTestCase(unittest.TestCase):
 
                 self.assert_(tracker.relage >= 0.)
                 self.assert_(tracker.relage <= 1.)
+    
+    def testOrdering(self):
+        if ViewTracker.objects.all()._DATABASE_ENGINE in COMPATIBLE_DATABASES:
+            for x in xrange(REPEAT_COUNT):
+                self.random_view()
+            
+            ordered = ViewTracker.objects.select_ordering(relview=1.0).order_by('-ordering', '-views')
+            viewed = ViewTracker.objects.order_by('-views')
+            
+            self.assertEqual([tracker.views for tracker in ordered], [tracker.views for tracker in viewed])
+            
+            for tracker in ViewTracker.objects.select_relevance().select_random():
+                self.assert_(tracker.relevance >= 0.)
+                self.assert_(tracker.relevance <= 1.)
+                
+                self.assert_(tracker.random >= 0.)
+                self.assert_(tracker.random <= 1.)
+    
+    def testOrderingQueries(self):
+        if ViewTracker.objects.all()._DATABASE_ENGINE in COMPATIBLE_DATABASES:
+            self.random_view()
+            
+            ct = ContentType.objects.get_for_model(TestObject)
+            
+            def get_trackers():
+                qs = ViewTracker.objects.filter(content_type=ct)
+                trackers = list(qs.select_ordering(relview=1.0, relage=-1.0, novelty=1.0, relpopularity=1.0, relevance=1.0, offset=1.0, 
+                                                   relative_to=ViewTracker.objects.filter(content_type=ct)).order_by('-ordering'))
+                trackers += list(qs.select_relviews().select_relage().select_relpopularity().select_relevance())
+            
+            # One query for each list
+            self.assertNumQueries(2, get_trackers)
 
         
 
-class TemplateTagsTestCase(unittest.TestCase):        
+class TemplateTagsTestCase(TrackerTestCase):
     def setUp(self):
         TestObject.objects.all().delete()
         ViewTracker.objects.all().delete()
@@ -279,6 +344,24 @@ class TemplateTagsTestCase(unittest.TestCase):
         for obj in c['objs']:
             self.assertEqual(obj.view_count, views[obj])
 
+    def testViewsForObjectsQueries(self):
+        # An object of another model with the same primary key
+        other = ContentType.objects.get_for_model(TestObject)
+        ViewTracker.add_view_for(other)
+        
+        objs = self.objs + [other]
+        
+        # One query, whatever the number of objects
+        views = self.assertNumQueries(1, ViewTracker.objects.get_views_for_objects, objs)
+        
+        ct = ContentType.objects.get_for_model(TestObject)
+        for obj in self.objs:
+            self.assertEqual(views[(ct.pk, obj.pk)], obj.pk)
+        
+        self.assertEqual(views[(ContentType.objects.get_for_model(ContentType).pk, other.pk)], 1)
+        self.assertEqual(ViewTracker.objects.get_for_objects(objs).count(), len(objs))
+        self.assertEqual(ViewTracker.objects.get_views_for_objects([]), {})
+
     def testMostPopularForModel(self):
         t = Template('{% load popularity_tags %}{% most_popular_for_model popularity.TestObject as popular_objs %}')
         c = Context({})
@@ -392,4 +475,1306 @@ class TemplateTagsTestCase(unittest.TestCase):
             res = t.render(c)
             
             self.assertEqual(res, 'add_view_for(%d,%d)' % (ct.pk, myobject.pk))
-        
\ No newline at end of file
+            
+            t = Template('{% load popularity_tags %}{{ myobject|viewtrack:"batch" }}')
+            res = t.render(c)
+            
+            self.assertEqual(res, 'queue_view_for(%d,%d)' % (ct.pk, myobject.pk))
+
+class BatchViewTestCase(TrackerTestCase):
+    def setUp(self):
+        super(BatchViewTestCase, self).setUp()
+        
+        # Filters are built in threads, which do not share the test database
+        from popularity import bloom
+        bloom.rebuild_filter(self.ct)
+    
+    def post(self, views):
+        from django.http import HttpRequest
+        from django.utils import simplejson
+        from popularity.views import add_views_for
+        
+        request = HttpRequest()
+        request.method = 'POST'
+        request.POST = {'views': simplejson.dumps(views)}
+        
+        return add_views_for(request)
+    
+    def testAddViewsFor(self):
+        a, b, c = self.objs
+        missing = c.pk + 1000
+        
+        response = self.post([[self.ct.pk, a.pk], [self.ct.pk, a.pk], [self.ct.pk, b.pk], 
+                              [self.ct.pk, missing], [self.ct.pk + 1000, a.pk]])
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(ViewTracker.get_views_for(a), 2)
+        self.assertEqual(ViewTracker.get_views_for(b), 1)
+        self.assertEqual(ViewTracker.get_views_for(c), 0)
+        self.assertFalse(ViewTracker.objects.filter(content_type=self.ct, object_id=missing).exists())
+    
+    def testInvalid(self):
+        self.assertEqual(self.post('no list').status_code, 400)
+        self.assertEqual(self.post([[self.ct.pk]]).status_code, 400)
+        self.assertEqual(self.post({'12' : 1}).status_code, 400)
+        self.assertEqual(self.post(['12']).status_code, 400)
+        
+        from django.http import HttpRequest
+        from popularity.views import add_views_for
+        
+        request = HttpRequest()
+        request.method = 'GET'
+        self.assertEqual(add_views_for(request).status_code, 405)
+
+class AddViewByIdTestCase(TrackerTestCase):
+    num_objects = 10
+    
+    def setUp(self):
+        super(AddViewByIdTestCase, self).setUp()
+        
+        from popularity import bloom
+        self.old_start_rebuild = bloom._start_rebuild
+        
+        # Filters are built in threads, which do not share the test database
+        self.started = []
+        bloom._start_rebuild = self.started.append
+    
+    def tearDown(self):
+        from popularity import bloom
+        
+        bloom._start_rebuild = self.old_start_rebuild
+        bloom._rebuilding.clear()
+    
+    def testBloomFilter(self):
+        from popularity.bloom import BloomFilter
+        
+        bloom = BloomFilter(1000, 0.01)
+        for i in xrange(1000):
+            bloom.add(i)
+        
+        for i in xrange(1000):
+            self.assert_(i in bloom)
+        
+        false_positives = len([i for i in xrange(1000, 11000) if i in bloom])
+        self.assert_(false_positives < 300, 'Too many false positives: %d' % false_positives)
+    
+    def testAddViewById(self):
+        from popularity import bloom
+        
+        obj = self.objs[0]
+        missing = max([o.pk for o in self.objs]) + 1000
+        
+        bloom.rebuild_filter(self.ct)
+        
+        def add_views():
+            ViewTracker.add_view_by_id(self.ct.pk, obj.pk)
+            ViewTracker.add_view_by_id(self.ct.pk, obj.pk)
+        
+        # The viewed model's table is not queried
+        for query in self.get_queries(add_views)[1]:
+            self.assert_('popularity_testobject' not in query['sql'], query['sql'])
+        
+        self.assertEqual(ViewTracker.get_views_for(obj), 2)
+        
+        self.assertRaises(TestObject.DoesNotExist, ViewTracker.add_view_by_id, self.ct.pk, missing)
+        self.assertRaises(ContentType.DoesNotExist, ViewTracker.add_view_by_id, 
+                          ContentType.objects.get_for_model(ViewTracker).pk, obj.pk)
+        
+        # Objects created after the filter was built are known as well
+        new = TestObject.objects.create(title='New')
+        ViewTracker.add_view_by_id(self.ct.pk, new.pk)
+        self.assertEqual(ViewTracker.get_views_for(new), 1)
+    
+    def testRebuild(self):
+        from popularity import bloom
+        
+        obj = self.objs[0]
+        missing = max([o.pk for o in self.objs]) + 1000
+        
+        bloom._filters.pop(self.ct.pk, None)
+        
+        # Until the first filter is built, IDs are checked in the database
+        self.assertEqual(bloom.get_filter(self.ct), None)
+        self.assertEqual(bloom.get_existing(self.ct, [obj.pk, missing]), set([obj.pk]))
+        self.assertEqual(self.started, [self.ct])
+        
+        old = bloom.rebuild_filter(self.ct)
+        self.assert_(bloom.get_filter(self.ct) is old)
+        
+        # A stale filter is used until the new one is built, which is started once
+        bloom._filters[self.ct.pk] = (0, old)
+        self.assert_(bloom.get_filter(self.ct) is old)
+        self.assert_(bloom.get_filter(self.ct) is old)
+        self.assertEqual(self.started, [self.ct, self.ct])
+        
+        new = bloom.rebuild_filter(self.ct)
+        self.assert_(bloom.get_filter(self.ct) is new)
+        self.assertEqual(len(self.started), 2)
+
+class HydrateTestCase(TrackerTestCase):
+    num_objects = 10
+    
+    def setUp(self):
+        super(HydrateTestCase, self).setUp()
+        
+        for obj in self.objs:
+            ViewTracker.add_view_for(obj)
+        
+        # A tracker of an object which no longer exists
+        self.missing = max([o.pk for o in self.objs]) + 1000
+        ViewTracker.objects.apply_deltas([(self.ct.pk, self.missing, 100, datetime.now())])
+    
+    def testHydrate(self):
+        trackers = list(ViewTracker.objects.filter(content_type=self.ct).order_by('-views', 'object_id'))
+        
+        def get_objects():
+            hydrated, missing = hydrate(trackers)
+            objects = [tracker.content_object for tracker in hydrated]
+            names = [unicode(tracker) for tracker in trackers]
+            
+            return missing, objects, names
+        
+        # One query for the single content type
+        missing, objects, names = self.assertNumQueries(1, get_objects)
+        
+        self.assertEqual(missing, 1)
+        self.assertEqual(objects, sorted(self.objs, key=lambda obj: obj.pk))
+        self.assertEqual(names[0], u'testobject %d, 100 views' % self.missing)
+        self.assertEqual(names[1], u'Obj 0, 1 views')
+    
+    def testGetObjectList(self):
+        objects = ViewTracker.objects.filter(content_type=self.ct).order_by('object_id').get_object_list()
+        
+        self.assertEqual(objects, sorted(self.objs, key=lambda obj: obj.pk))
+
+    def testIterTracked(self):
+        # 11 trackers in 4 chunks, with a query for the objects of each
+        pairs = self.assertNumQueries(8, list, ViewTracker.objects.filter(content_type=self.ct).iter_tracked(chunk_size=3))
+        
+        self.assertEqual([obj for tracker, obj in pairs], sorted(self.objs, key=lambda obj: obj.pk))
+        for tracker, obj in pairs:
+            self.assertEqual(tracker.object_id, obj.pk)
+    
+    def testGetQuerysets(self):
+        querysets = ViewTracker.objects.filter(content_type=self.ct).get_querysets()
+        
+        self.assertEqual(len(querysets), 1)
+        self.assertEqual(list(querysets[0].order_by('pk')), sorted(self.objs, key=lambda obj: obj.pk))
+
+class ViewBufferTestCase(TrackerTestCase):
+    def testFork(self):
+        from popularity.buffer import ViewBuffer
+        
+        buffer = ViewBuffer(interval=0)
+        for i in xrange(3):
+            buffer.add(self.ct.pk, self.objs[0].pk)
+        
+        # As seen by a child process, the views are left to the parent
+        buffer._pid = -1
+        self.assertEqual(buffer.pending(self.ct.pk, self.objs[0].pk), 0)
+        self.assertEqual(buffer.flush(), 0)
+        
+        buffer.add(self.ct.pk, self.objs[0].pk)
+        self.assertEqual(buffer.flush(), 1)
+        self.assertEqual(ViewTracker.get_views_for(self.objs[0]), 1)
+    
+    def testFlush(self):
+        from popularity.buffer import ViewBuffer
+        
+        buffer = ViewBuffer(interval=0)
+        for obj in self.objs:
+            for i in xrange(obj.pk):
+                buffer.add(self.ct.pk, obj.pk)
+        
+        for obj in self.objs:
+            self.assertEqual(ViewTracker.get_views_for(obj), 0)
+            self.assertEqual(buffer.pending(self.ct.pk, obj.pk), obj.pk)
+        
+        self.assertEqual(buffer.flush(), len(self.objs))
+        
+        for obj in self.objs:
+            self.assertEqual(ViewTracker.get_views_for(obj), obj.pk)
+            self.assertEqual(buffer.pending(self.ct.pk, obj.pk), 0)
+        
+        buffer.add(self.ct.pk, self.objs[0].pk, count=5)
+        buffer.flush()
+        
+        self.assertEqual(ViewTracker.get_views_for(self.objs[0]), self.objs[0].pk + 5)
+    
+    def testSizeThreshold(self):
+        from popularity.buffer import ViewBuffer
+        
+        buffer = ViewBuffer(interval=0, size=2)
+        buffer.add(self.ct.pk, self.objs[0].pk)
+        buffer.add(self.ct.pk, self.objs[0].pk)
+        
+        self.assertEqual(ViewTracker.get_views_for(self.objs[0]), 0)
+        
+        buffer.add(self.ct.pk, self.objs[1].pk)
+        
+        self.assertEqual(ViewTracker.get_views_for(self.objs[0]), 2)
+        self.assertEqual(ViewTracker.get_views_for(self.objs[1]), 1)
+    
+    def testBufferedAddViewFor(self):
+        from popularity import backends
+        
+        backends._backend = backends.BufferedCounterBackend()
+        try:
+            for obj in self.objs:
+                self.assertEqual(ViewTracker.add_view_for(obj), None)
+            
+            for obj in self.objs:
+                self.assertEqual(ViewTracker.get_views_for(obj, include_pending=False), 0)
+                self.assertEqual(ViewTracker.get_views_for(obj), 1)
+            
+            self.assertEqual(backends.get_backend().reconcile(), len(self.objs))
+            
+            for obj in self.objs:
+                self.assertEqual(ViewTracker.get_views_for(obj, include_pending=False), 1)
+                self.assertEqual(ViewTracker.get_views_for(obj), 1)
+        finally:
+            backends._backend = None
+
+class CacheCounterBackendTestCase(TrackerTestCase):
+    def setUp(self):
+        from django.core.cache import get_cache
+        from popularity import backends
+        
+        super(CacheCounterBackendTestCase, self).setUp()
+        
+        self.backend = backends.CacheCounterBackend(cache=get_cache('locmem://'))
+        backends._backend = self.backend
+    
+    def tearDown(self):
+        from popularity import backends
+        
+        backends._backend = None
+    
+    def testReconcile(self):
+        for obj in self.objs:
+            for i in xrange(obj.pk):
+                view.send(obj)
+        
+        for obj in self.objs:
+            self.assertEqual(ViewTracker.get_views_for(obj, include_pending=False), 0)
+            self.assertEqual(ViewTracker.get_views_for(obj), obj.pk)
+        
+        self.assertEqual(self.backend.reconcile(), len(self.objs))
+        
+        for obj in self.objs:
+            self.assertEqual(ViewTracker.get_views_for(obj, include_pending=False), obj.pk)
+            self.assertEqual(ViewTracker.get_views_for(obj), obj.pk)
+        
+        self.assertEqual(self.backend.reconcile(), 0)
+        
+        ViewTracker.add_view_for(self.objs[0])
+        self.assertEqual(self.backend.reconcile(), 1)
+        self.assertEqual(ViewTracker.get_views_for(self.objs[0], include_pending=False), self.objs[0].pk + 1)
+
+    def testConcurrentRegistration(self):
+        obj = self.objs[0]
+
+        # As if another process allocated a slot but did not set it yet
+        self.backend._add(self.backend._counter_key(self.ct.pk, obj.pk), 1)
+        self.backend.cache.add(self.backend._registered_key(self.ct.pk, obj.pk), 1)
+        slot = self.backend._add('%s:slots' % self.backend.prefix, 1)
+
+        ViewTracker.add_view_for(self.objs[1])
+
+        self.assertEqual(self.backend.reconcile(), 0)
+
+        self.backend.cache.set(self.backend._slot_key(slot), (self.ct.pk, obj.pk))
+
+        self.assertEqual(self.backend.reconcile(), 2)
+        self.assertEqual(ViewTracker.get_views_for(obj, include_pending=False), 1)
+        self.assertEqual(ViewTracker.get_views_for(self.objs[1], include_pending=False), 1)
+
+class QueueCounterBackendTestCase(TrackerTestCase):
+    def tearDown(self):
+        from popularity import backends
+        
+        backends._backend = None
+    
+    def get_backend(self, **kwargs):
+        """ Returns a QueueCounterBackend without workers, as the in-memory 
+            test database is not shared between threads. """
+        import os
+        from popularity import backends
+        
+        backend = backends.QueueCounterBackend(**kwargs)
+        backend._pid = os.getpid()
+        backends._backend = backend
+        
+        return backend
+    
+    def testReconcile(self):
+        backend = self.get_backend(batch=2)
+        
+        for obj in self.objs:
+            for i in xrange(obj.pk):
+                view.send(obj)
+        
+        for obj in self.objs:
+            self.assertEqual(ViewTracker.get_views_for(obj, include_pending=False), 0)
+            self.assertEqual(ViewTracker.get_views_for(obj), obj.pk)
+        
+        backend.reconcile()
+        
+        for obj in self.objs:
+            self.assertEqual(ViewTracker.get_views_for(obj, include_pending=False), obj.pk)
+            self.assertEqual(ViewTracker.get_views_for(obj), obj.pk)
+        
+        self.assertEqual(backend.reconcile(), 0)
+    
+    def testOverflow(self):
+        backend = self.get_backend(size=2, overflow='drop')
+        
+        for i in xrange(5):
+            view.send(self.objs[0])
+        
+        self.assertEqual(backend.dropped, 3)
+        self.assertEqual(ViewTracker.get_views_for(self.objs[0]), 2)
+        
+        self.assertEqual(backend.reconcile(), 1)
+        self.assertEqual(ViewTracker.get_views_for(self.objs[0], include_pending=False), 2)
+        
+        from django.core.exceptions import ImproperlyConfigured
+        from popularity.backends import QueueCounterBackend
+        
+        self.assertRaises(ImproperlyConfigured, QueueCounterBackend, overflow='ignore')
+    
+    def testFork(self):
+        backend = self.get_backend()
+        
+        view.send(self.objs[0])
+        
+        # As if forked after queueing
+        backend._pid = -1
+        
+        self.assertEqual(backend.reconcile(), 0)
+        self.assertEqual(backend.queue.qsize(), 0)
+        self.assertEqual(ViewTracker.get_views_for(self.objs[0]), 0)
+
+class ApplyDeltasTestCase(TrackerTestCase):
+    num_objects = 5
+    
+    def testApplyDeltas(self):
+        ViewTracker.add_view_for(self.objs[0])
+        
+        now = datetime.now()
+        deltas = []
+        for obj in self.objs:
+            deltas.append((self.ct.pk, obj.pk, obj.pk, now))
+            deltas.append((self.ct.pk, obj.pk, 1, now))
+        
+        self.assertEqual(ViewTracker.objects.apply_deltas(deltas), len(self.objs))
+        
+        self.assertEqual(ViewTracker.get_views_for(self.objs[0]), self.objs[0].pk + 2)
+        for obj in self.objs[1:]:
+            self.assertEqual(ViewTracker.get_views_for(obj), obj.pk + 1)
+        
+        self.assertEqual(ViewTracker.objects.apply_deltas([]), 0)
+    
+    def testChunks(self):
+        from popularity.dialects import get_dialect
+        
+        dialect = get_dialect()
+        size = dialect.chunk_size(('content_type_id', 'object_id', 'views', 'added', 'viewed'))
+        
+        now = datetime.now()
+        deltas = [(self.ct.pk, object_id, 1, now) for object_id in xrange(1, 2 * size + 2)]
+        
+        self.assertEqual(ViewTracker.objects.apply_deltas(deltas), 2 * size + 1)
+        self.assertEqual(ViewTracker.objects.filter(content_type=self.ct).count(), 2 * size + 1)
+        
+        ViewTracker.objects.apply_deltas(deltas)
+        self.assertEqual(ViewTracker.objects.filter(content_type=self.ct, views=2).count(), 2 * size + 1)
+
+    def testDialect(self):
+        from popularity.dialects import get_dialect
+        
+        # Created once, not for every QuerySet
+        dialect = get_dialect()
+        self.assert_(get_dialect('default') is dialect)
+        self.assert_(ViewTracker.objects.filter(views=1).order_by('pk')._dialect is dialect)
+    
+    def testFallbackConflict(self):
+        from django.db import connection
+        from popularity.dialects import BaseDialect, ADD
+
+        middle = self.objs[2]
+        ViewTracker.add_view_for(middle)
+
+        class Cursor(object):
+            """ Skips the first UPDATE of the middle object, as if it was
+                inserted by somebody else right after it. """
+            skipped = False
+
+            def __init__(self, cursor):
+                self.cursor = cursor
+                self.rowcount = 0
+
+            def execute(self, sql, params):
+                if sql.startswith('UPDATE') and params[-1] == middle.pk and not Cursor.skipped:
+                    Cursor.skipped = True
+                    self.rowcount = 0
+                    return
+
+                self.cursor.execute(sql, params)
+                self.rowcount = self.cursor.rowcount
+
+        class Connection(object):
+            def cursor(self):
+                return Cursor(connection.cursor())
+
+            def __getattr__(self, name):
+                return getattr(connection, name)
+
+        now = connection.ops.value_to_db_datetime(datetime.now())
+        rows = [(self.ct.pk, obj.pk, 1, now, now, 0.0, '', 0) for obj in self.objs]
+
+        # All rows fit in a single chunk, committed after the conflict
+        dialect = BaseDialect(Connection(), 'default')
+        self.assertEqual(dialect.upsert(ViewTracker._meta.db_table, ('content_type_id', 'object_id'),
+                                        ('content_type_id', 'object_id', 'views', 'added', 'viewed', 'score', 'sketch', 'unique_views'),
+                                        rows, [('views', ADD)]), len(self.objs))
+
+        self.assertTrue(Cursor.skipped)
+        self.assertEqual(ViewTracker.get_views_for(middle), 2)
+        for obj in self.objs[:2] + self.objs[3:]:
+            self.assertEqual(ViewTracker.get_views_for(obj), 1)
+
+class UniqueViewsTestCase(TrackerTestCase):
+    num_objects = 2
+    
+    def setUp(self):
+        from popularity import models
+        
+        super(UniqueViewsTestCase, self).setUp()
+        
+        self.old_unique = models.POPULARITY_UNIQUE_VIEWS
+        models.POPULARITY_UNIQUE_VIEWS = True
+    
+    def tearDown(self):
+        from popularity import backends, buffer, models
+        
+        models.POPULARITY_UNIQUE_VIEWS = self.old_unique
+        backends._backend = None
+        buffer._buffer = None
+    
+    def testTransaction(self):
+        from django.db import transaction
+        
+        @transaction.commit_on_success
+        def view():
+            obj = TestObject.objects.create(title='Rolled back')
+            ViewTracker.add_view_for(obj, viewer='a')
+            
+            raise ValueError
+        
+        self.assertRaises(ValueError, view)
+        
+        # Merging the sketch does not commit the transaction of the caller
+        self.assertEqual(TestObject.objects.filter(title='Rolled back').count(), 0)
+        
+        ViewTracker.add_view_for(self.objs[0], viewer='a')
+        self.assertEqual(ViewTracker.objects.get_for_object(self.objs[0]).unique_views, 1)
+    
+    def testHyperLogLog(self):
+        from popularity.hll import HyperLogLog
+        
+        a = HyperLogLog()
+        b = HyperLogLog()
+        for i in xrange(5000):
+            a.add('viewer %d' % i)
+            b.add('viewer %d' % (i + 2500))
+        
+        self.assert_(abs(a.count() - 5000) < 500, a.count())
+        
+        a.merge(b)
+        self.assert_(abs(a.count() - 7500) < 750, a.count())
+        
+        self.assertEqual(HyperLogLog.from_string(a.to_string()).registers, a.registers)
+        self.assertEqual(HyperLogLog().count(), 0)
+    
+    def testUniqueViews(self):
+        obj = self.objs[0]
+        
+        for viewer in ('a', 'b', 'a', 'c', 'a'):
+            view.send(obj, viewer=viewer)
+        ViewTracker.add_view_for(obj)
+        
+        tracker = ViewTracker.objects.get_for_object(obj)
+        self.assertEqual(tracker.views, 6)
+        self.assertEqual(tracker.unique_views, 3)
+        
+        ViewTracker.add_view_for(self.objs[1], viewer='a')
+        self.assertEqual([t.object_id for t in ViewTracker.objects.get_most_viewed(unique=True)[:2]], 
+                         [obj.pk, self.objs[1].pk])
+    
+    def testBuffered(self):
+        from popularity import backends, buffer
+        
+        buffer._buffer = buffer.ViewBuffer(interval=0, size=1000)
+        backends._backend = backends.BufferedCounterBackend()
+        
+        obj = self.objs[0]
+        for viewer in ('a', 'b', 'a'):
+            ViewTracker.add_view_for(obj, viewer=viewer)
+        buffer._buffer.flush()
+        
+        for viewer in ('b', 'c'):
+            ViewTracker.add_view_for(obj, viewer=viewer)
+        buffer._buffer.flush()
+        
+        tracker = ViewTracker.objects.get_for_object(obj)
+        self.assertEqual(tracker.views, 5)
+        self.assertEqual(tracker.unique_views, 3)
+
+class RepeatFilterTestCase(TrackerTestCase):
+    num_objects = 2
+    
+    def setUp(self):
+        from popularity import dedup
+        
+        super(RepeatFilterTestCase, self).setUp()
+        
+        self.filter = dedup.RepeatFilter(window=60, capacity=1000, error_rate=0.001)
+        dedup._filter = self.filter
+    
+    def tearDown(self):
+        from popularity import dedup
+        
+        dedup._filter = None
+    
+    def testRepeatedViews(self):
+        a, b = self.objs
+        
+        for viewer in ('x', 'y', 'x', 'x'):
+            view.send(a, viewer=viewer)
+        view.send(b, viewer='x')
+        
+        # Views without a viewer are always counted
+        view.send(a)
+        
+        self.assertEqual(ViewTracker.get_views_for(a), 3)
+        self.assertEqual(ViewTracker.get_views_for(b), 1)
+        
+        from popularity import bloom
+        bloom.rebuild_filter(self.ct)
+        
+        ViewTracker.add_views_for_ids([(self.ct.pk, a.pk), (self.ct.pk, b.pk)], viewer='z')
+        ViewTracker.add_view_by_id(self.ct.pk, a.pk, viewer='z')
+        self.assertEqual(ViewTracker.get_views_for(a), 4)
+        self.assertEqual(ViewTracker.get_views_for(b), 2)
+        
+        stats = self.filter.stats()
+        self.assertEqual(stats['checked'], 8)
+        self.assertEqual(stats['dropped'], 3)
+        self.assert_(0 < stats['false_positive_rate'] < 0.001)
+        self.assert_(stats['memory'] < 10000)
+        
+        # After one rotation the viewer is still in the previous filter
+        self.filter._started -= 60
+        view.send(a, viewer='x')
+        self.assertEqual(ViewTracker.get_views_for(a), 4)
+        
+        # After the window, the views count again
+        self.filter._started -= 120
+        view.send(a, viewer='x')
+        self.assertEqual(ViewTracker.get_views_for(a), 5)
+    
+    def testCapacity(self):
+        for i in xrange(5000):
+            self.filter.is_repeat('viewer %d' % i, self.ct.pk, 1)
+        
+        # Filling up starts new generations, which keeps false positives rare
+        self.assert_(self.filter.dropped < 10, self.filter.dropped)
+        self.assert_(self.filter.stats()['false_positive_rate'] <= 0.002)
+
+class TrendingTestCase(TrackerTestCase):
+    num_objects = 5
+    
+    def setUp(self):
+        from popularity import trending
+        
+        super(TrendingTestCase, self).setUp()
+        
+        trending.POPULARITY_TRENDING_SIZE = 5
+    
+    def tearDown(self):
+        from popularity import trending
+        
+        trending.POPULARITY_TRENDING_SIZE = 0
+        trending._trackers.clear()
+    
+    def testSpaceSaving(self):
+        from popularity.trending import SpaceSaving
+        
+        counter = SpaceSaving(size=2, halflife=60)
+        counter.add(1, 5)
+        counter.add(2, 2)
+        counter.add(3)
+        
+        # The least viewed object is replaced, inheriting its count
+        self.assertEqual([object_id for object_id, views in counter.top(2)], [1, 3])
+        self.assertAlmostEqual(counter.top(1)[0][1], 5, 2)
+        
+        # Older views count less
+        counter._landmark -= 60
+        self.assertAlmostEqual(counter.top(1)[0][1], 2.5, 2)
+        
+        # New views would weigh 2**401, so the counters are rescaled first
+        counter._landmark -= 60 * 400
+        counter.add(1)
+        self.assert_(max(counter._counters.values()) < 100)
+        self.assertAlmostEqual(counter._counters[1], 1, 2)
+        self.assertAlmostEqual(counter.top(1)[0][1], 1, 2)
+        self.assertEqual([object_id for object_id, views in counter.top(2)], [1, 3])
+        
+        # 2**1200 does not fit in a float; the old views are forgotten
+        counter._landmark -= 60 * 1200
+        self.assertEqual([views for object_id, views in counter.top(2)], [0, 0])
+        counter.add(3)
+        self.assertEqual([object_id for object_id, views in counter.top(2)], [3, 1])
+        self.assertAlmostEqual(counter.top(1)[0][1], 1, 2)
+    
+    def testTrendingNow(self):
+        for obj, count in zip(self.objs, (1, 4, 2, 6, 3)):
+            for i in xrange(count):
+                ViewTracker.add_view_for(obj)
+        
+        ViewTracker.add_views_for_ids([(self.ct.pk, self.objs[0].pk)] * 6)
+        
+        trending = self.assertNumQueries(1, ViewTracker.objects.get_trending_now, TestObject, 2)
+        
+        self.assertEqual([tracker.content_object for tracker in trending], [self.objs[0], self.objs[3]])
+        self.assertAlmostEqual(trending[0].trending_views, 7, 1)
+        
+        t = Template('{% load popularity_tags %}{% trending_now_for_model popularity.TestObject as trending limit 1 %}')
+        c = Context({})
+        t.render(c)
+        self.assertEqual([tracker.object_id for tracker in c['trending']], [self.objs[0].pk])
+
+class RankingTestCase(TrackerTestCase):
+    def setUp(self):
+        from popularity import models
+        
+        super(RankingTestCase, self).setUp()
+        
+        for obj, count in zip(self.objs, (2, 5, 3)):
+            for i in xrange(count):
+                ViewTracker.add_view_for(obj)
+        
+        models.POPULARITY_RANKING_PROFILES = {'views' : {'relview' : 1.0}, 
+                                              'fresh' : {'novelty' : 1.0, 'relview' : 0.1, 'charage' : 60}}
+        models.POPULARITY_RANKING_OVERLAP = 0
+    
+    def tearDown(self):
+        from popularity import models
+        
+        models.POPULARITY_RANKING_PROFILES = {}
+        models.POPULARITY_RANKING_OVERLAP = 300
+    
+    def testRanked(self):
+        from django.core.management import call_command
+        from popularity.models import RankingScore
+        
+        call_command('popularity_rank', verbosity=0)
+        self.assertEqual(RankingScore.objects.count(), 6)
+        
+        ranked = self.assertNumQueries(1, list, ViewTracker.objects.ranked('views', 2))
+        
+        self.assertEqual([tracker.content_object for tracker in ranked], [self.objs[1], self.objs[2]])
+        self.assertAlmostEqual(ranked[0].ranking, 1.0)
+        
+        # Only the trackers viewed since the previous refresh are scored again
+        for i in xrange(5):
+            ViewTracker.add_view_for(self.objs[0])
+        
+        self.assertEqual(RankingScore.objects.refresh('views'), 1)
+        
+        # The other scores are still relative to the old maximum
+        rankings = dict([(tracker.object_id, tracker.ranking) for tracker in ViewTracker.objects.ranked('views')])
+        self.assertAlmostEqual(rankings[self.objs[0].pk], 1.0)
+        self.assertAlmostEqual(rankings[self.objs[1].pk], 1.0)
+        
+        self.assertEqual(RankingScore.objects.refresh('views', full=True), 3)
+        self.assertEqual([tracker.content_object for tracker in ViewTracker.objects.ranked('views')], [self.objs[0], self.objs[1], self.objs[2]])
+        self.assertEqual(ViewTracker.objects.get_for_model(TestObject).ranked('fresh').count(), 3)
+    
+    def testMaxima(self):
+        from popularity.models import RankingScore
+        
+        # Values without a weight are left out
+        sql = str(ViewTracker.objects.select_ordering(relview=1.0).query)
+        self.assertEqual(sql.count('MAX('), 1, sql)
+        
+        count, queries = self.get_queries(RankingScore.objects.refresh, 'views', full=True, chunk_size=1)
+        self.assertEqual(count, 3)
+        
+        # The maximum is read once, not by every chunk
+        self.assertEqual(len([query for query in queries if 'MAX(' in query['sql']]), 1)
+        
+        rankings = dict([(tracker.object_id, tracker.ranking) for tracker in ViewTracker.objects.ranked('views')])
+        self.assertEqual(rankings, {self.objs[0].pk : 0.4, self.objs[1].pk : 1.0, self.objs[2].pk : 0.6})
+    
+    def testWithoutViews(self):
+        from popularity.models import RankingScore
+        
+        self.assertEqual(RankingScore.objects.refresh('views', full=True), 3)
+        
+        # Relative to a maximum of 0 views, the ordering is NULL
+        ViewTracker.objects.update(views=0)
+        
+        self.assertEqual(RankingScore.objects.refresh('views', full=True), 0)
+        self.assertEqual(RankingScore.objects.filter(profile='views').count(), 0)
+        self.assertEqual(list(ViewTracker.objects.ranked('views')), [])
+
+class QueryPlanTestCase(TrackerTestCase):
+    """ Checks that the getters read the indexes in popularity/sql in order,
+        instead of reading and sorting all trackers. """
+    
+    num_objects = 0
+    
+    def setUp(self):
+        from popularity import models
+        
+        super(QueryPlanTestCase, self).setUp()
+        
+        other = ContentType.objects.get_for_model(ContentType)
+        now = datetime.now()
+        
+        deltas = [(self.ct.pk, i, i % 7 + 1, now - timedelta(minutes=i)) for i in xrange(1, 201)]
+        deltas += [(other.pk, i, 1, now) for i in xrange(1, 51)]
+        ViewTracker.objects.apply_deltas(deltas)
+        
+        models.POPULARITY_RANKING_PROFILES = {'views' : {'relview' : 1.0}}
+        models.RankingScore.objects.refresh('views')
+        
+        from popularity.dialects import get_dialect
+        self.dialect = get_dialect()
+    
+    def tearDown(self):
+        from popularity import models
+        
+        models.POPULARITY_RANKING_PROFILES = {}
+        models._shard_counts = None
+    
+    def _is_sorted_scan(self, qs):
+        from popularity.dialects import PostgreSQLDialect
+        
+        sql, params = qs.query.get_compiler(using=qs.db).as_sql()
+        
+        cursor = self.dialect.connection.cursor()
+        if isinstance(self.dialect, PostgreSQLDialect):
+            # Tables this small are scanned anyway, unless that is made very expensive
+            cursor.execute('SET enable_seqscan = off')
+        try:
+            plan = self.dialect.explain(sql, params)
+        finally:
+            if isinstance(self.dialect, PostgreSQLDialect):
+                cursor.execute('SET enable_seqscan = on')
+        
+        return self.dialect.is_sorted_scan(plan), '%s\n%s' % (sql % tuple(params), '\n'.join(plan))
+    
+    def testGetters(self):
+        if not self.dialect.sql_explain:
+            return
+        
+        # Make sure sorting is detected at all
+        sorted_scan, plan = self._is_sorted_scan(ViewTracker.objects.order_by('sketch'))
+        self.assert_(sorted_scan, plan)
+        
+        for qs in (ViewTracker.objects.all(), ViewTracker.objects.get_for_model(TestObject)):
+            for getter in (qs.get_most_viewed(),
+                           qs.get_most_viewed(unique=True),
+                           qs.get_recently_viewed(),
+                           qs.get_recently_added(),
+                           qs.get_most_popular(mode='indexed'),
+                           qs.ranked('views')):
+                sorted_scan, plan = self._is_sorted_scan(getter)
+                self.failIf(sorted_scan, plan)
+    
+    def testShardedGetters(self):
+        from popularity import models
+        
+        # Another model is sharded
+        models._shard_counts = {ContentType.objects.get_for_model(ContentType).pk: 4}
+        
+        qs = ViewTracker.objects.get_for_model(TestObject).get_most_viewed()
+        self.failIf('CASE' in str(qs.query), qs.query)
+        
+        if self.dialect.sql_explain:
+            sorted_scan, plan = self._is_sorted_scan(qs)
+            self.failIf(sorted_scan, plan)
+
+class BenchmarkTestCase(unittest.TestCase):
+    def tearDown(self):
+        ViewTracker.objects.all().delete()
+    
+    def testRun(self):
+        from popularity import benchmarks
+        
+        results = benchmarks.run([20, 50], repeat=2, views=10)
+        
+        self.assertEqual(ViewTracker.objects.count(), 50)
+        
+        names = [name for name, function, count in benchmarks.get_benchmarks()]
+        self.assertEqual([result['benchmark'] for result in results], names * 2)
+        self.assertEqual([result['rows'] for result in results], [20] * len(names) + [50] * len(names))
+        
+        for result in results:
+            self.assert_(0 <= result['min_ms'] <= result['median_ms'] <= result['max_ms'])
+        
+        results = benchmarks.run([10], repeat=1, names=['get_most_viewed'])
+        self.assertEqual([result['benchmark'] for result in results], ['get_most_viewed'])
+
+class MetricsTestCase(TrackerTestCase):
+    num_objects = 1
+    
+    def setUp(self):
+        from popularity import metrics
+        
+        super(MetricsTestCase, self).setUp()
+        
+        self.obj = self.objs[0]
+        
+        self.sink = metrics.MemorySink(size=10)
+        metrics._sink = self.sink
+    
+    def tearDown(self):
+        from popularity import metrics
+        
+        metrics._sink = None
+    
+    def testMemorySink(self):
+        for i in xrange(3):
+            ViewTracker.add_view_for(self.obj)
+        
+        self.assertEqual(ViewTracker.get_views_for(self.obj), 3)
+        
+        t = Template('{% load popularity_tags %}{% views_for_object obj as views %}{% most_viewed_for_model popularity.TestObject as viewed %}')
+        t.render(Context({'obj' : self.obj}))
+        
+        qs = ViewTracker.objects.select_relviews()
+        self.failIf(self.sink.stats().has_key('queryset.select_relviews'))
+        
+        self.assertEqual(qs.count(), 1)
+        list(qs.get_most_viewed())
+        
+        stats = self.sink.stats()
+        
+        self.assertEqual(stats['add_view_for']['count'], 3)
+        self.assert_(stats['add_view_for']['p50_queries'] >= 1)
+        self.assert_(0 <= stats['add_view_for']['p50_ms'] <= stats['add_view_for']['p99_ms'])
+        
+        # Getters which return a QuerySet are measured when it is used
+        self.assertEqual(stats['queryset.get_most_viewed']['count'], 1)
+        self.assertEqual(stats['queryset.get_most_viewed']['p99_queries'], 1)
+        self.assertEqual(stats['queryset.select_relviews']['count'], 1)
+        self.assertEqual(stats['queryset.select_relviews']['p99_queries'], 1)
+        
+        # Queries of QuerySets used by measured calls are only measured as part of those
+        ViewTracker.objects.get_for_model(TestObject).get_object_list()
+        self.failIf(self.sink.stats().has_key('queryset.get_for_model'))
+        self.assertEqual(self.sink.stats()['queryset.get_object_list']['p99_queries'], 2)
+        
+        self.assertEqual(stats['tag.views_for_object']['p50_queries'], stats['get_views_for']['p50_queries'])
+        self.assertEqual(stats['get_views_for']['count'], 2)
+        self.assertEqual(stats['tag.most_viewed_for_model']['count'], 1)
+        
+        for i in xrange(20):
+            ViewTracker.get_views_for(self.obj)
+        self.assertEqual(self.sink.stats()['get_views_for']['count'], 10)
+    
+    def testStatsdSink(self):
+        import socket
+        from popularity.metrics import StatsdSink
+        
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        try:
+            sink = StatsdSink('127.0.0.1', server.getsockname()[1], 'test')
+            sink.timing('add_view_for', 1.5, 2)
+            
+            data = server.recv(1024)
+        finally:
+            server.close()
+        
+        self.assertEqual(data, 'test.add_view_for:1.500000|ms\ntest.add_view_for.queries:2|ms')
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class ScorerTestCase(TrackerTestCase):
+    num_objects = 0
+    
+    def setUp(self):
+        super(ScorerTestCase, self).setUp()
+        
+        now = datetime.now()
+        
+        ViewTracker.objects.apply_deltas([(self.ct.pk, i, i % 5 + 1, now - timedelta(hours=i)) for i in xrange(1, 51)])
+        
+        # The added time of the trackers
+        for tracker in ViewTracker.objects.all():
+            ViewTracker.objects.filter(pk=tracker.pk).update(added=now - timedelta(hours=tracker.object_id + 1))
+    
+    def testScores(self):
+        if numpy is None:
+            return
+        
+        from popularity.scoring import Scorer
+        
+        qs = ViewTracker.objects.all()
+        scorer = Scorer(qs)
+        
+        self.assertEqual(len(scorer), 50)
+        
+        index = dict([(pk, i) for i, pk in enumerate(scorer.pks)])
+        
+        def compare(values, qs, field):
+            for pk, value in qs.values_list('pk', field):
+                self.assertAlmostEqual(values[index[pk]], value, 3)
+        
+        compare(scorer.relviews(), qs.select_relviews(), 'relviews')
+        compare(scorer.relage(), qs.select_relage(), 'relage')
+        compare(scorer.novelty(0.2, 7200), qs.select_novelty(0.2, 7200), 'novelty')
+        compare(scorer.relpopularity(), qs.select_relpopularity(), 'relpopularity')
+        compare(scorer.relevance(), qs.select_relevance(), 'relevance')
+        
+        weights = {'relview' : 0.5, 'novelty' : 0.3, 'relevance' : 1.0, 'offset' : 0.1}
+        compare(scorer.ordering(**weights), qs.select_ordering(**weights), 'ordering')
+        
+        top = scorer.top(scorer.ordering(**weights), 5)
+        ordered = qs.select_ordering(**weights).order_by('-ordering').values_list('pk', 'ordering')[:5]
+        self.assertEqual([pk for pk, score in top], [pk for pk, ordering in ordered])
+        self.assertEqual(len(scorer.top(scorer.relviews(), 100)), 50)
+
+class TopOrderingTestCase(TrackerTestCase):
+    num_objects = 0
+    
+    def setUp(self):
+        super(TopOrderingTestCase, self).setUp()
+        
+        now = datetime.now()
+        
+        # Distinct numbers of views and ages, so there are no ties
+        generator = random.Random(1)
+        views = generator.sample(xrange(1, 1000), 300)
+        ages = generator.sample(xrange(1, 10000), 300)
+        
+        ViewTracker.objects.apply_deltas([(self.ct.pk, i + 1, views[i], now) for i in xrange(300)])
+        
+        for tracker in ViewTracker.objects.all():
+            ViewTracker.objects.filter(pk=tracker.pk).update(added=now - timedelta(minutes=ages[tracker.object_id - 1]))
+    
+    def _get_expected(self, limit, **weights):
+        return [tracker.pk for tracker in ViewTracker.objects.select_ordering(**weights).order_by('-ordering')[:limit]]
+    
+    def testExact(self):
+        trackers, exact = self.assertNumQueries(3, ViewTracker.objects.get_top_ordering, 10, 20, relview=1.0)
+        
+        self.assert_(exact)
+        self.assertEqual([tracker.pk for tracker in trackers], self._get_expected(10, relview=1.0))
+        
+        expected = ViewTracker.objects.select_ordering(relview=1.0).get(pk=trackers[0].pk).ordering
+        self.assertAlmostEqual(trackers[0].ordering, expected)
+        
+        # Whenever the result is exact, it is the same as that of select_ordering
+        for weights in ({'relview' : 1.0, 'novelty' : 0.5}, 
+                        {'relview' : 0.2, 'relage' : -0.5, 'offset' : 1.0}, 
+                        {'novelty' : 1.0, 'charage_novelty' : 60000}):
+            for candidates in (10, 50, 150):
+                trackers, exact = ViewTracker.objects.get_top_ordering(10, candidates, **weights)
+                
+                if exact:
+                    self.assertEqual([tracker.pk for tracker in trackers], self._get_expected(10, **weights))
+        
+        trackers, exact = ViewTracker.objects.get_top_ordering(10, 150, relview=1.0, novelty=0.5)
+        self.assert_(exact)
+    
+    def testApproximate(self):
+        trackers, exact = ViewTracker.objects.get_top_ordering(10, 20, relevance=1.0)
+        self.failIf(exact)
+        self.assertEqual(len(trackers), 10)
+        
+        trackers, exact = ViewTracker.objects.get_top_ordering(10, 20, relview=1.0, random=0.1)
+        self.failIf(exact)
+        
+        # With all trackers as candidates, the result is always exact
+        weights = {'relview' : 1.0, 'relpopularity' : 1.0, 'relevance' : 2.0}
+        trackers, exact = ViewTracker.objects.get_top_ordering(10, 1000, **weights)
+        self.assert_(exact)
+        self.assertEqual([tracker.pk for tracker in trackers], self._get_expected(10, **weights))
+
+class ScoreTestCase(TrackerTestCase):
+    def testScore(self):
+        from datetime import timedelta
+        from math import log
+        from popularity.models import get_score, logaddexp, POPULARITY_CHARAGE
+        
+        now = datetime.now()
+        
+        self.assertAlmostEqual(get_score(2, now) - get_score(1, now), log(2))
+        self.assertAlmostEqual(get_score(1, now) - get_score(1, now - timedelta(seconds=POPULARITY_CHARAGE)), log(2))
+        self.assertAlmostEqual(logaddexp(get_score(1, now), get_score(1, now)), get_score(2, now))
+        
+        # Many old views, a few recent ones and some views in between
+        ViewTracker.objects.apply_deltas([(self.ct.pk, self.objs[0].pk, 100, now - timedelta(seconds=10*POPULARITY_CHARAGE))])
+        ViewTracker.objects.apply_deltas([(self.ct.pk, self.objs[1].pk, 3, now)])
+        ViewTracker.objects.apply_deltas([(self.ct.pk, self.objs[2].pk, 1, now - timedelta(seconds=POPULARITY_CHARAGE)),
+                                          (self.ct.pk, self.objs[2].pk, 1, now)])
+        ViewTracker.objects.apply_deltas([(self.ct.pk, self.objs[2].pk, 1, now)])
+        
+        tracker = ViewTracker.objects.get_for_object(self.objs[2])
+        self.assertAlmostEqual(tracker.score, logaddexp(get_score(1, now - timedelta(seconds=POPULARITY_CHARAGE)), get_score(2, now)))
+        
+        popular = ViewTracker.objects.get_for_model(TestObject).get_most_popular(mode='indexed')
+        self.assertEqual([tracker.object_id for tracker in popular], 
+                         [self.objs[1].pk, self.objs[2].pk, self.objs[0].pk])
+
+    def testFarApart(self):
+        from django.db import connection
+        from popularity.models import get_score, NO_VIEWS_SCORE
+        from popularity.dialects import BaseDialect, PostgreSQLDialect, MySQLDialect, LOGADDEXP
+        
+        # Trackers without views do not count as viewed on the epoch
+        tracker = ViewTracker.objects.get_for_object(self.objs[0], create=True)
+        self.assertEqual(tracker.score, NO_VIEWS_SCORE)
+        
+        now = datetime.now()
+        ViewTracker.objects.apply_deltas([(self.ct.pk, self.objs[0].pk, 1, now - timedelta(days=100))])
+        ViewTracker.objects.apply_deltas([(self.ct.pk, self.objs[0].pk, 1, now)])
+        
+        tracker = ViewTracker.objects.get_for_object(self.objs[0])
+        self.assertAlmostEqual(tracker.score, get_score(1, now))
+        
+        # EXP() is only evaluated for values close to each other
+        for dialect_class in (BaseDialect, PostgreSQLDialect, MySQLDialect):
+            dialect = dialect_class(connection, 'default')
+            sql = dialect.logaddexp('a', 'b')
+            
+            self.assert_(sql.startswith('CASE WHEN ABS(a - b) > 700 THEN '), sql)
+            self.assertEqual(dialect._update_params(LOGADDEXP), dialect.logaddexp('score', '%s').count('%s'))
+
+class ViewShardTestCase(TrackerTestCase):
+    def setUp(self):
+        from popularity import models
+        
+        super(ViewShardTestCase, self).setUp()
+        
+        ViewShard.objects.all().delete()
+        
+        models._shard_counts = {self.ct.pk: 4}
+    
+    def tearDown(self):
+        from popularity import models
+        
+        models._shard_counts = None
+    
+    def testShards(self):
+        a, b, c = self.objs
+        
+        for i in xrange(20):
+            ViewTracker.add_view_for(a)
+        for i in xrange(5):
+            ViewTracker.add_view_for(b)
+        
+        # The views of the tracker rows are not updated, their score is
+        tracker = ViewTracker.objects.get_for_object(a)
+        self.assertEqual(tracker.views, 0)
+        self.assertAlmostEqual(tracker.score, get_score(20, tracker.viewed), 2)
+        self.assert_(1 < ViewShard.objects.filter(object_id=a.pk).count() <= 4)
+        
+        self.assertEqual([tracker.object_id for tracker in ViewTracker.objects.get_recently_viewed(2)], [b.pk, a.pk])
+        
+        self.assertEqual(ViewTracker.get_views_for(a), 20)
+        self.assertEqual(ViewTracker.objects.get_views_for_objects(self.objs), 
+                         {(self.ct.pk, a.pk): 20, (self.ct.pk, b.pk): 5, (self.ct.pk, c.pk): 0})
+        
+        most_viewed = list(ViewTracker.objects.get_for_model(TestObject).get_most_viewed())
+        self.assertEqual([tracker.object_id for tracker in most_viewed[:2]], [a.pk, b.pk])
+        self.assertEqual(most_viewed[0].total_views, 20)
+        
+        if ViewTracker.objects.all()._DATABASE_ENGINE in COMPATIBLE_DATABASES:
+            relviews = ViewTracker.objects.get_for_model(TestObject).select_relviews()
+            self.assertEqual(relviews.get(object_id=b.pk).relviews, 0.25)
+            
+            # Relative to the sharded trackers of another model
+            other = ContentType.objects.get_for_model(ContentType)
+            ViewTracker.objects.apply_deltas([(other.pk, 1, 10, datetime.now())])
+            relviews = ViewTracker.objects.get_for_model(ContentType).select_relviews(relative_to=ViewTracker.objects.all())
+            self.assertEqual(relviews.get(object_id=1).relviews, 0.5)
+    
+    def testFold(self):
+        a = self.objs[0]
+        
+        for i in xrange(20):
+            ViewTracker.add_view_for(a)
+        
+        shards = ViewShard.objects.count()
+        self.assertEqual(ViewShard.objects.fold(), shards)
+        self.assertEqual(ViewShard.objects.count(), 0)
+        
+        tracker = ViewTracker.objects.get_for_object(a)
+        self.assertEqual(tracker.views, 20)
+        self.assertAlmostEqual(tracker.score, get_score(20, tracker.viewed), 2)
+        self.assertEqual(ViewTracker.get_views_for(a), 20)
+    
+    def testFoldBatches(self):
+        from django.db import transaction
+        
+        a, b, c = self.objs
+        
+        for obj in self.objs:
+            for i in xrange(12):
+                ViewTracker.add_view_for(obj)
+        
+        shards = ViewShard.objects.count()
+        self.assertEqual(ViewShard.objects.fold(batch_size=2), shards)
+        self.assertEqual(ViewShard.objects.count(), 0)
+        
+        for obj in self.objs:
+            self.assertEqual(ViewTracker.objects.get_for_object(obj).views, 12)
+        
+        @transaction.commit_on_success
+        def fold():
+            TestObject.objects.create(title='Rolled back')
+            ViewShard.objects.fold(batch_size=2)
+            
+            raise ValueError
+        
+        ViewTracker.add_view_for(a)
+        self.assertRaises(ValueError, fold)
+        
+        # Folding does not commit the transaction of the caller
+        self.assertEqual(TestObject.objects.filter(title='Rolled back').count(), 0)
+        self.assertEqual(ViewShard.objects.count(), 1)
+    
+    def testMostViewed(self):
+        a, b, c = self.objs
+        
+        ViewTracker.objects.apply_deltas([(self.ct.pk, b.pk, 10, datetime.now())])
+        
+        for i in xrange(20):
+            ViewTracker.add_view_for(a)
+        
+        # Sharded views count, also for trackers not in the top of the index
+        most_viewed = ViewTracker.objects.get_most_viewed(limit=1)
+        self.assertEqual([(tracker.object_id, tracker.total_views) for tracker in most_viewed], [(a.pk, 20)])
+        
+        most_viewed = ViewTracker.objects.get_for_model(TestObject).get_most_viewed(limit=3)
+        self.assertEqual([tracker.object_id for tracker in most_viewed], [a.pk, b.pk, c.pk])
+        
+        # Only the shards of the trackers in the QuerySet are read
+        most_viewed = ViewTracker.objects.get_for_model(TestObject).exclude(object_id=a.pk).get_most_viewed(limit=3)
+        self.assertEqual([tracker.object_id for tracker in most_viewed], [b.pk, c.pk])
+
+class ViewBucketTestCase(TrackerTestCase):
+    def setUp(self):
+        from popularity import models
+        
+        super(ViewBucketTestCase, self).setUp()
+        
+        ViewBucket.objects.all().delete()
+        
+        models.POPULARITY_BUCKETS = True
+    
+    def tearDown(self):
+        from popularity import models
+        
+        models.POPULARITY_BUCKETS = False
+    
+    def testWindow(self):
+        from datetime import timedelta
+        
+        now = datetime.now()
+        
+        # The first object was popular a long time ago, the second one last week
+        ViewTracker.objects.apply_deltas([(self.ct.pk, self.objs[0].pk, 100, now - timedelta(days=30)),
+                                          (self.ct.pk, self.objs[1].pk, 10, now - timedelta(days=5)),
+                                          (self.ct.pk, self.objs[2].pk, 2, now)])
+        ViewTracker.add_view_for(self.objs[2])
+        
+        # Old hourly buckets are removed
+        self.assertEqual(ViewBucket.objects.compact(), 2)
+        
+        self.assertEqual(ViewBucket.objects.filter(resolution=ViewBucket.HOURLY).count(), 1)
+        self.assertEqual(ViewBucket.objects.filter(resolution=ViewBucket.DAILY).count(), 3)
+        
+        popular = ViewTracker.objects.get_for_model(TestObject).get_most_popular(window=timedelta(days=1))
+        self.assertEqual([(tracker.object_id, tracker.window_views) for tracker in popular], [(self.objs[2].pk, 3)])
+        
+        popular = ViewTracker.objects.get_most_popular(window=timedelta(days=7))
+        self.assertEqual([(tracker.object_id, tracker.window_views) for tracker in popular], 
+                         [(self.objs[1].pk, 10), (self.objs[2].pk, 3)])
+        
+        popular = ViewTracker.objects.get_for_model(ContentType).get_most_popular(window=timedelta(days=7))
+        self.assertEqual(popular, [])
+        
+        ViewBucket.objects.compact(now=now + timedelta(days=70))
+        
+        self.assertEqual(ViewBucket.objects.filter(resolution=ViewBucket.HOURLY).count(), 0)
+        self.assertEqual(ViewBucket.objects.filter(resolution=ViewBucket.DAILY).count(), 2)
+
+class LeaderboardTestCase(TrackerTestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        from popularity import leaderboards
+        
+        super(LeaderboardTestCase, self).setUp()
+        
+        for i, obj in enumerate(self.objs):
+            for j in xrange(i + 1):
+                ViewTracker.add_view_for(obj)
+        
+        cache.clear()
+        leaderboards.POPULARITY_LEADERBOARD_TIMEOUT = 60
+    
+    def tearDown(self):
+        from popularity import leaderboards
+        
+        leaderboards.POPULARITY_LEADERBOARD_TIMEOUT = 0
+    
+    def testCache(self):
+        from popularity.leaderboards import get_leaderboard
+        
+        viewed = get_leaderboard('most_viewed', TestObject, 2)
+        self.assertEqual([tracker.object_id for tracker in viewed], [self.objs[2].pk, self.objs[1].pk])
+        
+        for i in xrange(5):
+            ViewTracker.add_view_for(self.objs[0])
+        
+        viewed = get_leaderboard('most_viewed', TestObject, 2)
+        self.assertEqual([tracker.object_id for tracker in viewed], [self.objs[2].pk, self.objs[1].pk])
+        
+        t = Template('{% load popularity_tags %}{% most_viewed_for_model popularity.TestObject as viewed_objs limit 2 %}')
+        c = Context({})
+        t.render(c)
+        self.assertEqual([tracker.object_id for tracker in c['viewed_objs']], [self.objs[2].pk, self.objs[1].pk])
+        
+        viewed = get_leaderboard('most_viewed', TestObject, 3)
+        self.assertEqual([tracker.object_id for tracker in viewed], [self.objs[0].pk, self.objs[2].pk, self.objs[1].pk])
+    
+    def testStale(self):
+        from time import time
+        from popularity.leaderboards import get_leaderboard, cache
+        
+        key = 'popularity:leaderboard:most_viewed:all:2'
+        
+        viewed = get_leaderboard('most_viewed', limit=2)
+        
+        # Expire the list while another process is refreshing it
+        cache.set(key, (time() - 1, viewed))
+        cache.add(key + ':refresh', 1)
+        
+        self.assertEqual(self.assertNumQueries(0, get_leaderboard, 'most_viewed', limit=2), viewed)
+        
+        cache.delete(key + ':refresh')
+        get_leaderboard('most_viewed', limit=2)
+        self.assert_(cache.get(key)[0] > time())
@@ -0,0 +1,136 @@
+# This file is part of django-popularity.
+#
+# django-popularity: A generic view- and popularity tracking pluggable for Django.
+# Copyright (C) 2008-2010 Mathijs de Bruin
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+""" In-process tracking of the objects viewed most in the last minutes,
+    answered from memory instead of the database. """
+
+import threading
+
+from time import time
+from math import log
+
+# Settings for trending objects:
+# - POPULARITY_TRENDING_SIZE; number of objects tracked per model, 0 disables tracking
+# - POPULARITY_TRENDING_HALFLIFE; number of seconds after which a view counts half
+
+from django.conf import settings
+POPULARITY_TRENDING_SIZE = int(getattr(settings, 'POPULARITY_TRENDING_SIZE', 0))
+POPULARITY_TRENDING_HALFLIFE = float(getattr(settings, 'POPULARITY_TRENDING_HALFLIFE', 300))
+
+class SpaceSaving(object):
+    """ Approximate top of the most viewed objects, in `size` counters, with
+        views counting half after every `halflife` seconds.
+
+        When all counters are taken, the object with the lowest count is
+        replaced by the newly viewed one, which inherits its count (the
+        Space-Saving algorithm). Objects with a decayed count above the
+        lowest count are never missed. Decay is applied by weighting new views
+        with 2**(t/halflife) instead of decreasing all counters. """
+
+    # Weights are rescaled when they would exceed this value
+    MAX_WEIGHT = 1e100
+    MAX_EXPONENT = log(MAX_WEIGHT, 2)
+
+    def __init__(self, size=None, halflife=None):
+        if size is None:
+            size = POPULARITY_TRENDING_SIZE
+        if halflife is None:
+            halflife = POPULARITY_TRENDING_HALFLIFE
+
+        self.size = size
+        self.halflife = halflife
+
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._landmark = time()
+
+    def _weight(self, now):
+        """ Returns the weight of a view at time now, which is at most 
+            MAX_WEIGHT. Should be called with the lock held. """
+        exponent = (now - self._landmark) / self.halflife
+
+        if exponent > self.MAX_EXPONENT:
+            # Move the landmark to now, so weights start at 1 again; after
+            # a long time without views the counters simply become 0
+            for key in self._counters:
+                self._counters[key] *= 2.0 ** -exponent
+
+            self._landmark = now
+            exponent = 0
+
+        return 2.0 ** exponent
+
+    def add(self, object_id, count=1):
+        now = time()
+
+        self._lock.acquire()
+        try:
+            weight = count * self._weight(now)
+
+            if object_id in self._counters:
+                self._counters[object_id] += weight
+            elif len(self._counters) < self.size:
+                self._counters[object_id] = weight
+            else:
+                smallest = min(self._counters, key=self._counters.get)
+                self._counters[object_id] = self._counters.pop(smallest) + weight
+        finally:
+            self._lock.release()
+
+    def top(self, limit):
+        """ Returns a list with up to `limit` (object_id, views) pairs with
+            the highest decayed number of views, highest first. """
+        self._lock.acquire()
+        try:
+            factor = self._weight(time())
+            counters = self._counters.items()
+        finally:
+            self._lock.release()
+
+        counters.sort(key=lambda counter: counter[1], reverse=True)
+
+        return [(object_id, weight / factor) for object_id, weight in counters[:limit]]
+
+_trackers = {}
+_trackers_lock = threading.Lock()
+
+def record(content_type_id, object_id, count=1):
+    """ Adds `count` views of an object, when POPULARITY_TRENDING_SIZE is set. """
+    if not POPULARITY_TRENDING_SIZE:
+        return
+
+    tracker = _trackers.get(content_type_id)
+
+    if tracker is None:
+        _trackers_lock.acquire()
+        try:
+            tracker = _trackers.setdefault(content_type_id, SpaceSaving())
+        finally:
+            _trackers_lock.release()
+
+    tracker.add(object_id, count)
+
+def get_trending(content_type_id, limit):
+    """ Returns a list with up to `limit` (object_id, views) pairs for the
+        objects of a content type viewed most recently in this process. """
+    tracker = _trackers.get(content_type_id)
+
+    if tracker is None:
+        return []
+
+    return tracker.top(limit)
@@ -18,8 +18,9 @@
 
 from django.conf.urls.defaults import *
 
-from views import add_view_for
+from views import add_view_for, add_views_for
 
 urlpatterns = patterns('',
     url(r'^(?P<content_type_id>\d+)/(?P<object_id>\d+)/$', add_view_for, name="popularity-add-view-for"),
+    url(r'^batch/$', add_views_for, name="popularity-add-views-for"),
 )
\ No newline at end of file
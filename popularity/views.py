@@ -19,17 +19,93 @@
 import logging
 
 from django.contrib.contenttypes.models import ContentType
-from django.http import HttpResponse
+from django.core.exceptions import ObjectDoesNotExist
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseNotAllowed
+from django.utils import simplejson
 
 from models import ViewTracker
+from bloom import get_existing
+from metrics import instrument
 
+# Maximum number of views accepted by add_views_for in a single request
+from django.conf import settings
+POPULARITY_BATCH_SIZE = int(getattr(settings, 'POPULARITY_BATCH_SIZE', 100))
+
+def _get_viewer(request):
+    """ Returns a string identifying the viewer of the request, for counting
+        unique viewers: the user, the session or else the IP address. """
+    if hasattr(request, 'user') and request.user.is_authenticated():
+        return 'user:%d' % request.user.pk
+    
+    # The session's key would create a new session
+    session_key = request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+    if session_key:
+        return 'session:%s' % session_key
+    
+    return 'ip:%s' % request.META.get('REMOTE_ADDR', '')
+
+@instrument('view.add_view_for')
 def add_view_for(request, content_type_id, object_id):
-    ct = ContentType.objects.get(pk=content_type_id)
-    myobject = ct.get_object_for_this_type(pk=object_id)
+    try:
+        ViewTracker.add_view_by_id(int(content_type_id), int(object_id), viewer=_get_viewer(request))
+    except ObjectDoesNotExist:
+        raise Http404
+    
+    logging.debug('Added view for object %s of content type %s through web.', object_id, content_type_id)
+    
+    return HttpResponse()
+
+def _get_existing(views):
+    """ Returns the (content_type_id, object_id) pairs in views of which the
+        object exists, according to the filters of popularity.bloom. """
+    object_ids = {}
+    for content_type_id, object_id in views:
+        object_ids.setdefault(content_type_id, set()).add(object_id)
+    
+    existing = set()
+    for content_type_id, ids in object_ids.iteritems():
+        try:
+            ct = ContentType.objects.get_for_id(content_type_id)
+        except ContentType.DoesNotExist:
+            continue
+        
+        model = ct.model_class()
+        if not model or issubclass(model, ViewTracker):
+            continue
+        
+        for object_id in get_existing(ct, ids):
+            existing.add((content_type_id, object_id))
+    
+    return [key for key in views if key in existing]
+
+@instrument('view.add_views_for')
+def add_views_for(request):
+    """ Adds views for a batch of objects, POSTed as a JSON list of
+        [content_type_id, object_id] pairs in the `views` field or as the
+        request body. Views for objects which do not exist are ignored. """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    
+    data = request.POST.get('views') or request.raw_post_data
+    
+    try:
+        pairs = simplejson.loads(data)
+        
+        # Objects and strings would be unpacked as their keys or characters
+        if not isinstance(pairs, list) or [pair for pair in pairs if not isinstance(pair, list)]:
+            raise TypeError
+        
+        views = [(int(content_type_id), int(object_id)) for content_type_id, object_id in pairs]
+    except (ValueError, TypeError):
+        return HttpResponseBadRequest('Expected a list of [content_type_id, object_id] pairs.')
+    
+    if len(views) > POPULARITY_BATCH_SIZE:
+        return HttpResponseBadRequest('At most %d views can be added at once.' % POPULARITY_BATCH_SIZE)
+    
+    existing = _get_existing(views)
     
-    logging.debug('Adding view for %s through web.', myobject)
+    logging.debug('Adding %d views through web, ignoring %d.', len(existing), len(views) - len(existing))
     
-    ViewTracker.add_view_for(myobject)
+    ViewTracker.add_views_for_ids(existing, viewer=_get_viewer(request))
     
     return HttpResponse()
-    
\ No newline at end of file
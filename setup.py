@@ -31,7 +31,9 @@ setup(
     author = 'Mathijs de Bruin',
     author_email = 'drbob@dokterbob.net',
     url = 'http://github.com/dokterbob/django-popularity',
-    packages = ['popularity', 'popularity.templatetags',],
+    packages = ['popularity', 'popularity.templatetags', 
+                'popularity.management', 'popularity.management.commands',],
+    package_data = {'popularity': ['sql/*.sql']},
     include_package_data = True,
     classifiers = ['Development Status :: 4 - Beta',
                    'Environment :: Web Environment',